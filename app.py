@@ -8,18 +8,18 @@ import math
 from io import BytesIO
 from urllib.parse import urlparse
 from urllib.request import urlopen, Request
-from openpyxl.utils import get_column_letter
-from mail_ingestion import ingest_invoices_from_email, is_mail_ingestion_configured
+from line_item_diff import diff_line_items, line_item_changes_to_edits
+from archive import archive_summary, archived_vendor_totals
+from mail_state import list_daemon_statuses
+from mail_retry import queue_stats as retry_queue_stats
+from crm_sync import is_enabled as crm_sync_enabled, outbox_stats as crm_outbox_stats
+from risk_engine import check_math, score_invoice
 from database import (
-    upload_file, 
-    save_invoice_record, 
-    fetch_all_invoices, 
-    fetch_all_invoice_edits,
-    fetch_all_invoice_audits,
-    fetch_all_vendors,
-    is_duplicate, 
-    log_edit,
-    get_vendor_average,
+    upload_blob, 
+    save_invoice_transaction,
+    load_dashboard_context,
+    load_transparency_export,
+    fetch_all_invoices,
     fetch_invoice_edits,
     compute_document_hash,
     is_duplicate_hash
@@ -40,8 +40,8 @@ with st.sidebar:
     # API Key Status Display
     st.header("🔑 API Status")
     try:
-        st.caption(f"Total Keys: {len(processor.API_KEYS)}")
-        for i in range(len(processor.API_KEYS)):
+        st.caption(f"Total Keys: {len(processor.get_api_keys())}")
+        for i in range(len(processor.get_api_keys())):
             if i in processor.failed_keys:
                 st.error(f"Key #{i+1}: ❌ Quota Exceeded")
             elif i == processor.current_key_index:
@@ -112,10 +112,7 @@ def hydrate_invoice_session_data(row):
 
 # --- 🧠 Logic Engine ---
 def validate_math(invoice_total, line_items_df):
-    if line_items_df.empty: return False, 0.0, invoice_total
-    calculated_sum = line_items_df['total_price'].sum()
-    diff = round(abs(invoice_total - calculated_sum), 2)
-    return diff == 0, calculated_sum, diff
+    return check_math(invoice_total, line_items_df.to_dict("records"))
 
 # --- 🧹 JSON SANITIZATION HELPER ---
 def sanitize_json(obj):
@@ -198,6 +195,8 @@ def _autofit_worksheet(worksheet, dataframe):
     if dataframe.empty:
         return
 
+    from openpyxl.utils import get_column_letter
+
     for idx, col in enumerate(dataframe.columns):
         try:
             max_value_len = dataframe[col].astype(str).str.len().max()
@@ -334,8 +333,29 @@ def export_full_transparency_workbook(invoices, edits, audits, vendors):
     return output.getvalue()
 
 # --- 📊 EXCEL EXPORT HELPER ---
+def prepare_ops_dataframe(invoices):
+    """Invoice rows as the Operations Control Center shows and exports them."""
+    df = pd.DataFrame(invoices)
+    if 'created_at' in df.columns:
+        df['created_at'] = pd.to_datetime(df['created_at']).dt.tz_localize(None)
+    
+    for col in ['confidence_score', 'risk_score', 'total_amount']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    if 'approval_stage' in df.columns and 'created_at' in df.columns:
+        now = pd.Timestamp.now()
+        df['days_pending'] = (now - df['created_at']).dt.days
+        df.loc[df['approval_stage'] == "APPROVED", 'days_pending'] = 0
+
+    if 'approval_timestamp' in df.columns:
+        df['approval_timestamp'] = pd.to_datetime(df['approval_timestamp'], errors='coerce').dt.tz_localize(None)
+    return df
+
 def export_to_excel(dataframe, filename="export"):
     """Convert DataFrame to Excel file and return as bytes."""
+    from openpyxl.utils import get_column_letter
+
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         dataframe.to_excel(writer, sheet_name='Invoices', index=False)
@@ -357,6 +377,8 @@ def export_to_excel(dataframe, filename="export"):
 # --- 📊 INVOICE EXPORT WITH LINE ITEMS ---
 def export_invoice_with_items(invoice_summary, line_items_df):
     """Export invoice summary and line items to Excel with multiple sheets."""
+    from openpyxl.utils import get_column_letter
+
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         # Sheet 1: Invoice Summary
@@ -437,22 +459,24 @@ def save_and_log(vendor, date, total, cur, df, status, original_data, reason, ro
     # ✅ FIX: Extract ID correctly to ensure UPDATE instead of INSERT
     invoice_id = original_data.get("id")
     
+    edits = []
+    if vendor != original_data.get("vendor_name"):
+        edits.append({"field_name": "Vendor", "old_value": original_data.get("vendor_name"), "new_value": vendor})
+    if str(total) != str(original_data.get("total_amount")):
+        edits.append({"field_name": "Total", "old_value": original_data.get("total_amount"), "new_value": total})
+    if date != original_data.get("invoice_date"):
+        edits.append({"field_name": "Date", "old_value": original_data.get("invoice_date"), "new_value": date})
+
+    # Cell-level line item history (row, column, old, new)
+    edits.extend(line_item_changes_to_edits(
+        diff_line_items(original_data.get("line_items", []), df.to_dict("records"))
+    ))
+
+    # Invoice, vendor stats, audit row and edits are written in one transaction
     clean_final_data = sanitize_json(final_data)
-    saved = save_invoice_record(clean_final_data, st.session_state['url'], role, invoice_id=invoice_id)
-    
+    saved = save_invoice_transaction(clean_final_data, st.session_state['url'], role, invoice_id=invoice_id, edits=edits)
+
     if saved:
-        invoice_id = saved['id']
-        if vendor != original_data.get("vendor_name"):
-            log_edit(invoice_id, "Vendor", original_data.get("vendor_name"), vendor)
-        if str(total) != str(original_data.get("total_amount")):
-            log_edit(invoice_id, "Total", original_data.get("total_amount"), total)
-        if date != original_data.get("invoice_date"):
-            log_edit(invoice_id, "Date", original_data.get("invoice_date"), date)
-            
-        original_items = pd.DataFrame(original_data.get("line_items", []))
-        if not original_items.empty and not df.equals(original_items):
-            log_edit(invoice_id, "Line Items", "Original AI Table", "User Modified Table")
-            
         st.toast(f"Invoice moved to {stage} stage!", icon="✅")
         time.sleep(1)
         del st.session_state['data']
@@ -472,10 +496,16 @@ def get_vendor_stats(vendor_name, all_invoices):
         return None
         
     v_data['invoice_date'] = pd.to_datetime(v_data['invoice_date'], errors='coerce')
-        
+
+    # Archived invoices count too; their totals come from the archive index
+    archived = archived_vendor_totals().get(vendor_name) or {"count": 0, "total_amount": 0.0}
+    amounts = pd.to_numeric(v_data['total_amount'], errors='coerce').fillna(0)
+    count = len(v_data) + archived["count"]
+
     stats = {
-        "count": len(v_data),
-        "avg_amount": v_data['total_amount'].mean(),
+        "count": count,
+        "archived_count": archived["count"],
+        "avg_amount": (amounts.sum() + archived["total_amount"]) / count,
         "last_invoice": v_data['invoice_date'].max(),
         "flagged_count": len(v_data[v_data['risk_level'] == 'HIGH']) if 'risk_level' in v_data.columns else 0
     }
@@ -496,7 +526,8 @@ with st.sidebar:
                 document_hash = compute_document_hash(file_bytes)
                 if is_duplicate_hash(document_hash):
                     st.warning("Potential duplicate detected (same document hash found).")
-                public_url = upload_file(file_bytes, uploaded_file.name, uploaded_file.type)
+                uploaded_file.seek(0)
+                public_url = upload_blob(uploaded_file, uploaded_file.type, file_name=uploaded_file.name, document_hash=document_hash)
                 if public_url:
                     data = processor.process_invoice(file_bytes, uploaded_file.type)
                     if not data:
@@ -517,7 +548,62 @@ with st.sidebar:
 
     st.markdown("---")
     st.header("2. Mailbox Ingestion")
+    # Background daemon (python -m mail_ingestion serve) or supervised mailbox workers, if any have run
+    for daemon_status in list_daemon_statuses():
+        totals = daemon_status.get("totals", {})
+        label = f"Mail daemon {daemon_status['worker']}" if daemon_status.get("worker") else "Mail daemon"
+        if daemon_status.get("stale"):
+            age_minutes = (daemon_status.get("age_seconds") or 0) / 60
+            st.warning(f"⚠️ {label} not responding (last heartbeat {age_minutes:.0f} min ago)")
+        elif daemon_status.get("state") == "stopped":
+            st.caption(f"⏹️ {label} stopped")
+        elif daemon_status.get("state") == "reconnecting":
+            st.warning(f"🔌 {label} reconnecting: {daemon_status.get('last_error')}")
+        else:
+            mode = "IMAP IDLE" if daemon_status.get("mode") == "idle" else "polling"
+            st.success(
+                f"🟢 {label} {daemon_status.get('state')} ({mode}) | "
+                f"Ingested {totals.get('ingested', 0)} since start"
+            )
+        last_run = daemon_status.get("last_run")
+        if last_run:
+            st.caption(
+                f"Last run: {last_run.get('status')} at {str(last_run.get('finished_at'))[:19].replace('T', ' ')} UTC | "
+                f"Scanned {last_run.get('messages_scanned', 0)} | Ingested {last_run.get('ingested', 0)} | "
+                f"Failed {last_run.get('failed', 0)}"
+            )
+    # Failed attachments waiting for a retry (python -m mail_ingestion retry)
+    retry_stats = retry_queue_stats()
+    if retry_stats["pending"] or retry_stats["dead"]:
+        stages = ", ".join(f"{stage} {count}" for stage, count in sorted(retry_stats["by_stage"].items()))
+        st.caption(
+            f"🔁 Retry queue: {retry_stats['pending']} pending ({retry_stats['due']} due)"
+            + (f" | {stages}" if stages else "")
+        )
+        if retry_stats["dead"]:
+            st.warning(
+                f"☠️ {retry_stats['dead']} attachment(s) gave up after repeated failures "
+                f"(last error: {retry_stats['dead_error']}). Re-queue with `python -m mail_ingestion retry --requeue-dead`"
+            )
+    # CRM webhook outbox (python crm_sync.py stats)
+    if crm_sync_enabled():
+        crm_stats = crm_outbox_stats()
+        lag = crm_stats["oldest_pending_seconds"]
+        st.caption(
+            f"📤 CRM outbox: {crm_stats['pending']} pending"
+            + (f" (oldest {lag:,.0f}s)" if lag is not None else "")
+            + f" | {crm_stats['delivered']} delivered | {crm_stats['failed_batches']} failed batches"
+        )
+        if crm_stats["dead"]:
+            st.warning(
+                f"☠️ {crm_stats['dead']} CRM event(s) gave up after repeated failures "
+                f"(last error: {crm_stats['last_error']}). Re-queue with `python crm_sync.py requeue`"
+            )
+
     if can_upload():
+        # Imported here so dashboards that cannot ingest never load the IMAP/AI stack
+        from mail_ingestion import ingest_invoices_from_email, is_mail_ingestion_configured
+
         configured, config_msg = is_mail_ingestion_configured()
         if configured:
             st.success("✅ IMAP Configured")
@@ -549,25 +635,39 @@ with st.sidebar:
                 f"Skipped by type: {ingest.get('skipped_by_type', 0)} | "
                 f"Skipped by size: {ingest.get('skipped_by_size', 0)}"
             )
+        if ingest.get('skipped_by_rule'):
+            st.caption(
+                "Skipped by rule: "
+                + " | ".join(f"{rule} {count}" for rule, count in sorted(ingest['skipped_by_rule'].items()))
+            )
+        timings = ingest.get('stage_timings') or {}
+        if timings.get('wall'):
+            st.caption(
+                " | ".join(
+                    f"{stage} {timings[stage]['seconds']:.1f}s"
+                    for stage in ('fetch', 'extract', 'upload', 'save') if stage in timings
+                ) + f" | wall {timings['wall']['seconds']:.1f}s"
+            )
         errors = ingest.get('errors', [])[:3]
         if errors:
             st.warning("Ingestion errors:\n- " + "\n- ".join(errors))
 
-# --- Pre-fetch invoices ---
-all_invoices_data = fetch_all_invoices()
+# --- Pre-fetch dashboard data (queries run in parallel) ---
+dashboard_context = load_dashboard_context()
+all_invoices_data = dashboard_context["invoices"]
+# Counts, averages and SLA figures come pre-aggregated from the database
+metrics = dashboard_context["metrics"]
 
 # --- 🔎 WORKFLOW TRANSPARENCY (ALL ROLES) ---
-if all_invoices_data:
+if metrics["total_invoices"]:
     st.markdown("---")
     st.markdown("### 🔎 Workflow Transparency")
 
-    transparency_df = pd.DataFrame(all_invoices_data)
-    transparency_df['source'] = transparency_df.apply(get_invoice_source, axis=1)
-
-    total_invoices = len(transparency_df)
-    active_invoices = len(transparency_df[transparency_df['approval_stage'].isin(["UPLOADED", "REVIEWED"])]) if 'approval_stage' in transparency_df.columns else 0
-    approved_invoices = len(transparency_df[transparency_df['approval_stage'] == "APPROVED"]) if 'approval_stage' in transparency_df.columns else 0
-    rejected_invoices = len(transparency_df[transparency_df['approval_stage'] == "REJECTED"]) if 'approval_stage' in transparency_df.columns else 0
+    stage_counts = metrics["stage_counts"]
+    total_invoices = metrics["total_invoices"]
+    active_invoices = stage_counts.get("UPLOADED", 0) + stage_counts.get("REVIEWED", 0)
+    approved_invoices = stage_counts.get("APPROVED", 0)
+    rejected_invoices = stage_counts.get("REJECTED", 0)
 
     w1, w2, w3, w4 = st.columns(4)
     w1.metric("Total", total_invoices)
@@ -575,60 +675,58 @@ if all_invoices_data:
     w3.metric("Approved", approved_invoices)
     w4.metric("Rejected", rejected_invoices)
 
-    if 'approval_stage' in transparency_df.columns:
-        source_stage = transparency_df.groupby(['source', 'approval_stage']).size().unstack(fill_value=0)
+    if metrics["source_stage_counts"]:
+        source_stage = (
+            pd.DataFrame.from_dict(metrics["source_stage_counts"], orient="index")
+            .fillna(0).astype(int).sort_index().sort_index(axis=1)
+        )
+        source_stage.index.name = "source"
+        source_stage.columns.name = "approval_stage"
         st.caption("Source vs Approval Stage")
         st.dataframe(source_stage, use_container_width=True)
 
+    archived = archive_summary()
+    if archived["total_invoices"]:
+        st.caption(
+            f"🗄️ Archive: {archived['total_invoices']} finished invoices "
+            f"({archived['first_month']} to {archived['last_month']}) are kept out of the live table "
+            f"and the counts above; exports include them."
+        )
+
     st.markdown("### 📥 Full Transparency Export (All Users)")
-    all_edits = fetch_all_invoice_edits()
-    all_audits = fetch_all_invoice_audits()
-    all_vendors = fetch_all_vendors()
-    transparency_excel = export_full_transparency_workbook(
-        all_invoices_data,
-        all_edits,
-        all_audits,
-        all_vendors
-    )
+    # Workbooks are built only when the button is clicked (keeps openpyxl off the startup path);
+    # edits, audits and vendors are fetched only then too
+    def _transparency_workbook():
+        export = load_transparency_export()
+        return export_full_transparency_workbook(
+            export["invoices"], export["invoice_edits"], export["invoice_audits"], export["vendors"]
+        )
+
     st.download_button(
         label="📊 Download Full Transparency Workbook (EXCEL)",
-        data=transparency_excel,
+        data=_transparency_workbook,
         file_name=f"invoice_transparency_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
-    st.caption("Includes invoices, workflow view, line items, invoice edits, invoice audits, vendors, and flattened AI extraction fields.")
+    st.caption("Includes invoices (live and archived), workflow view, line items, invoice edits, invoice audits, vendors, and flattened AI extraction fields.")
 
 # --- 📊 SYSTEM HEALTH SUMMARY ---
-if all_invoices_data:
+if metrics["total_invoices"]:
     st.markdown("---")
     st.markdown("### 🏥 System Health Summary")
     
-    df_health = pd.DataFrame(all_invoices_data)
-    
     try:
-        api_keys_remaining = len(processor.API_KEYS) - len(processor.failed_keys)
+        api_keys_remaining = len(processor.get_api_keys()) - len(processor.failed_keys)
     except:
         api_keys_remaining = 0
     
-    avg_confidence = df_health['confidence_score'].mean() if 'confidence_score' in df_health.columns and not df_health.empty else 0.0
-    
-    high_risk_pending = len(df_health[
-        (df_health['risk_level'] == 'HIGH') & 
-        (df_health['approval_stage'].isin(["UPLOADED", "REVIEWED"]))
-    ]) if 'risk_level' in df_health.columns and not df_health.empty else 0
-    
-    avg_approval_time = 0
-    if 'approval_timestamp' in df_health.columns and 'created_at' in df_health.columns:
-        approved_df = df_health[df_health['approval_stage'] == 'APPROVED'].copy()
-        if not approved_df.empty:
-            approved_df['approval_timestamp'] = pd.to_datetime(approved_df['approval_timestamp'], errors='coerce')
-            approved_df['created_at'] = pd.to_datetime(approved_df['created_at'], errors='coerce')
-            approved_df['approval_hours'] = (approved_df['approval_timestamp'] - approved_df['created_at']).dt.total_seconds() / 3600
-            avg_approval_time = approved_df['approval_hours'].mean() if not approved_df.empty else 0
+    avg_confidence = metrics["avg_confidence"] or 0.0
+    high_risk_pending = metrics["high_risk_pending"]
+    avg_approval_time = metrics["approval_hours"]["avg"] or 0
     
     h1, h2, h3, h4 = st.columns(4)
     try:
-        h1.metric("🔑 API Keys Available", f"{api_keys_remaining}/{len(processor.API_KEYS)}", delta=f"{len(processor.failed_keys)} exhausted")
+        h1.metric("🔑 API Keys Available", f"{api_keys_remaining}/{len(processor.get_api_keys())}", delta=f"{len(processor.failed_keys)} exhausted")
     except:
         h1.metric("🔑 API Keys Available", "N/A")
     
@@ -707,10 +805,9 @@ if 'data' in st.session_state:
             )
         
         with down_col2:
-            excel_data = export_invoice_with_items(invoice_export, line_items_df)
             st.download_button(
                 label="📊 Download as EXCEL",
-                data=excel_data,
+                data=lambda summary=dict(invoice_export), items=line_items_df.copy(): export_invoice_with_items(summary, items),
                 file_name=f"invoice_{data.get('vendor_name', 'unknown').replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
@@ -724,7 +821,10 @@ if 'data' in st.session_state:
             if v_stats:
                 with st.expander(f"🏢 Vendor Insights: {vendor_name}", expanded=False):
                     vc1, vc2, vc3, vc4 = st.columns(4)
-                    vc1.metric("Total Invoices", v_stats['count'])
+                    vc1.metric(
+                        "Total Invoices", v_stats['count'],
+                        help=f"Includes {v_stats['archived_count']} archived" if v_stats['archived_count'] else None
+                    )
                     vc2.metric("Avg Amount", f"${v_stats['avg_amount']:,.2f}")
                     vc3.metric("Flagged History", v_stats['flagged_count'])
                     vc4.write(f"**Last Seen:**\n{v_stats['last_invoice']}")
@@ -825,35 +925,22 @@ if 'data' in st.session_state:
             tc3.metric("Difference", "$0.00", delta="Matched")
 
         st.markdown("### 🚦 Risk Analysis")
-        duplicate_found = is_duplicate(vendor, date, extracted_total, exclude_id=data.get("id"))
-        
-        risk_score = 0
-        risk_reasons = []
-        confidence = data.get("confidence_score", 1.0)
-        
-        if confidence < 0.7:
-            risk_score += 20
-            risk_reasons.append(f"Low AI Confidence ({int(confidence*100)}%)")
-        if not math_valid:
-            risk_score += 30
-            risk_reasons.append(f"Math Mismatch (Diff: {diff})")
-        if duplicate_found:
-            risk_score += 40
-            risk_reasons.append("Duplicate Invoice Detected")
-        
-        vendor_avg = get_vendor_average(vendor)
-        if vendor_avg and extracted_total > (vendor_avg * 2):
-            risk_score += 25
-            risk_reasons.append(f"Amount > 2x Vendor Avg (${vendor_avg:.2f})")
-        
-        if risk_score >= 60:
-            risk_level = "HIGH"
+        # One duplicate query; the vendor profile comes from the engine's cache
+        risk = score_invoice({
+            "id": data.get("id"),
+            "vendor_name": vendor,
+            "invoice_date": date,
+            "total_amount": extracted_total,
+            "confidence_score": data.get("confidence_score", 1.0),
+            "line_items": edited_df.to_dict("records"),
+        })
+        risk_score, risk_level, risk_reasons = risk["risk_score"], risk["risk_level"], risk["risk_reasons"]
+
+        if risk_level == "HIGH":
             st.error(f"🚨 **HIGH RISK INVOICE** (Score: {risk_score})")
-        elif risk_score >= 30:
-            risk_level = "MEDIUM"
+        elif risk_level == "MEDIUM":
             st.warning(f"⚠ **MEDIUM RISK INVOICE** (Score: {risk_score})")
         else:
-            risk_level = "LOW"
             st.success(f"✅ **LOW RISK INVOICE** (Score: {risk_score})")
 
         if risk_reasons:
@@ -1032,36 +1119,18 @@ if user_role in ["FINANCE_MANAGER", "AUDITOR"]:
     st.markdown("---")
     st.subheader("📈 Operations Control Center")
 
-    if all_invoices_data:
-        df = pd.DataFrame(all_invoices_data)
-        if 'created_at' in df.columns:
-            df['created_at'] = pd.to_datetime(df['created_at']).dt.tz_localize(None)
-        
-        for col in ['confidence_score', 'risk_score', 'total_amount']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-
+    if metrics["total_invoices"]:
         st.markdown("### 🚨 Operational Alerts")
         alerts = []
         
-        if 'risk_level' in df.columns and 'approval_stage' in df.columns:
-            high_risk_pending = df[(df['risk_level'] == "HIGH") & (df['approval_stage'].isin(["UPLOADED", "REVIEWED"]))]
-            if len(high_risk_pending) > 0:
-                alerts.append(f"🔴 **{len(high_risk_pending)} HIGH RISK** invoices require attention")
-
-        if 'confidence_score' in df.columns:
-            low_conf = df[df['confidence_score'] < 0.7]
-            if len(low_conf) > 0:
-                alerts.append(f"⚠ **{len(low_conf)}** invoices have AI confidence below 70%")
-
-        if 'approval_stage' in df.columns:
-            now = pd.Timestamp.now()
-            df['days_pending'] = (now - df['created_at']).dt.days
-            df.loc[df['approval_stage'] == "APPROVED", 'days_pending'] = 0
-            
-            sla_breach_review = df[(df['approval_stage'] == "REVIEWED") & (df['days_pending'] > 3)]
-            if len(sla_breach_review) > 0:
-                alerts.append(f"⏱ **{len(sla_breach_review)} SLA BREACHES:** Invoices in review > 72 hours")
+        if metrics["high_risk_pending"] > 0:
+            alerts.append(f"🔴 **{metrics['high_risk_pending']} HIGH RISK** invoices require attention")
+
+        if metrics["low_confidence"] > 0:
+            alerts.append(f"⚠ **{metrics['low_confidence']}** invoices have AI confidence below 70%")
+
+        if metrics["sla_breaches"] > 0:
+            alerts.append(f"⏱ **{metrics['sla_breaches']} SLA BREACHES:** Invoices in review > 72 hours")
 
         if alerts:
             for alert in alerts:
@@ -1072,34 +1141,29 @@ if user_role in ["FINANCE_MANAGER", "AUDITOR"]:
         st.markdown("---")
         st.markdown("### ⏱ SLA Performance Metrics")
         
-        if 'approval_timestamp' in df.columns:
-            df['approval_timestamp'] = pd.to_datetime(df['approval_timestamp'], errors='coerce').dt.tz_localize(None)
-            approved_df = df[df['approval_stage'] == "APPROVED"].copy()
+        approval_hours = metrics["approval_hours"]
+        if approval_hours["count"]:
+            avg_approval_time = approval_hours["avg"]
             
-            if not approved_df.empty:
-                approved_df['approval_time_hours'] = (
-                    approved_df['approval_timestamp'] - approved_df['created_at']
-                ).dt.total_seconds() / 3600
-                avg_approval_time = approved_df['approval_time_hours'].mean()
-                
-                c1, c2, c3 = st.columns(3)
-                delta_color = "inverse" if avg_approval_time > 48 else "normal"
-                c1.metric("Avg Approval Time", f"{avg_approval_time:.1f} hrs", delta_color=delta_color)
-                c2.metric("Fastest Approval", f"{approved_df['approval_time_hours'].min():.1f} hrs")
-                c3.metric("Slowest Approval", f"{approved_df['approval_time_hours'].max():.1f} hrs")
-            else:
-                st.info("No approved invoices yet to calculate SLA metrics.")
+            c1, c2, c3 = st.columns(3)
+            delta_color = "inverse" if avg_approval_time > 48 else "normal"
+            c1.metric("Avg Approval Time", f"{avg_approval_time:.1f} hrs", delta_color=delta_color)
+            c2.metric("Fastest Approval", f"{approval_hours['min']:.1f} hrs")
+            c3.metric("Slowest Approval", f"{approval_hours['max']:.1f} hrs")
+        else:
+            st.info("No approved invoices yet to calculate SLA metrics.")
         
         st.markdown("### 📊 Analytics Overview")
         chart1, chart2 = st.columns(2)
         with chart1:
             st.markdown("#### 🚨 Risk Distribution")
-            if 'risk_level' in df.columns:
-                st.bar_chart(df['risk_level'].value_counts(), color="#FF4B4B")
+            if metrics["risk_counts"]:
+                risk_counts = pd.Series(metrics["risk_counts"], name="count").sort_values(ascending=False)
+                st.bar_chart(risk_counts, color="#FF4B4B")
         with chart2:
             st.markdown("#### 🔄 Approval Funnel")
-            if 'approval_stage' in df.columns:
-                stage_counts = df['approval_stage'].value_counts().reindex(
+            if metrics["stage_counts"]:
+                stage_counts = pd.Series(metrics["stage_counts"], name="count").reindex(
                     ["UPLOADED", "REVIEWED", "APPROVED", "REJECTED"], fill_value=0
                 )
                 st.bar_chart(stage_counts)
@@ -1107,23 +1171,34 @@ if user_role in ["FINANCE_MANAGER", "AUDITOR"]:
         chart3, chart4 = st.columns(2)
         with chart3:
             st.markdown("#### 🏢 Top Vendors")
-            if 'vendor_name' in df.columns:
-                top_vendors = df.groupby("vendor_name")["total_amount"].sum().sort_values(ascending=False).head(5)
+            if metrics["top_vendors"]:
+                top_vendors = pd.DataFrame(metrics["top_vendors"]).set_index("vendor_name")["total_amount"]
                 st.bar_chart(top_vendors)
         with chart4:
             st.markdown("#### 🤖 AI Confidence Trend")
-            if 'confidence_score' in df.columns:
-                st.line_chart(df.set_index("created_at").resample("D")["confidence_score"].mean())
+            if metrics["confidence_trend"]:
+                trend = pd.DataFrame(metrics["confidence_trend"])
+                trend["day"] = pd.to_datetime(trend["day"])
+                st.line_chart(trend.set_index("day").resample("D")["avg_confidence"].mean())
 
         st.markdown("---")
         st.markdown("### 📄 Export Reports")
         
+        # Report DataFrames are only built when a download is requested
+        def _approved_report():
+            df = prepare_ops_dataframe(all_invoices_data)
+            return df[df['approval_stage'] == "APPROVED"] if 'approval_stage' in df.columns else df.iloc[0:0]
+
+        def _risk_report():
+            df = prepare_ops_dataframe(all_invoices_data)
+            risk_cols = ['vendor_name', 'total_amount', 'risk_score', 'risk_level', 'confidence_score', 'flag_reason']
+            return df[[c for c in risk_cols if c in df.columns]]
+
         # ✅ DOWNLOAD ALL INVOICES (EXCEL)
         st.subheader("📥 Download All Invoices")
-        excel_all = export_to_excel(df)
         st.download_button(
             label="📊 Download All Invoices (EXCEL)",
-            data=excel_all,
+            data=lambda: export_to_excel(prepare_ops_dataframe(fetch_all_invoices(include_archived=True))),
             file_name=f"all_invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
@@ -1132,35 +1207,36 @@ if user_role in ["FINANCE_MANAGER", "AUDITOR"]:
         st.subheader("📋 Filtered Reports (CSV & EXCEL)")
         
         exp1, exp2 = st.columns(2)
-        if 'approval_stage' in df.columns:
-            approved_report = df[df['approval_stage'] == "APPROVED"]
-            csv_approved = approved_report.to_csv(index=False).encode('utf-8')
-            exp1.download_button("📥 Download Approved Invoices (CSV)", csv_approved, "approved_invoices.csv", "text/csv")
-            
-            excel_approved = export_to_excel(approved_report, "approved_invoices")
-            exp2.download_button(
-                "📊 Download Approved Invoices (EXCEL)", 
-                excel_approved, 
-                f"approved_invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+        exp1.download_button(
+            "📥 Download Approved Invoices (CSV)",
+            lambda: _approved_report().to_csv(index=False).encode('utf-8'),
+            "approved_invoices.csv",
+            "text/csv"
+        )
+        exp2.download_button(
+            "📊 Download Approved Invoices (EXCEL)", 
+            lambda: export_to_excel(_approved_report(), "approved_invoices"), 
+            f"approved_invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
 
         exp3, exp4 = st.columns(2)
-        risk_cols = ['vendor_name', 'total_amount', 'risk_score', 'risk_level', 'confidence_score', 'flag_reason']
-        valid_risk = [c for c in risk_cols if c in df.columns]
-        risk_report = df[valid_risk]
-        csv_risk = risk_report.to_csv(index=False).encode('utf-8')
-        exp3.download_button("📥 Download Risk Report (CSV)", csv_risk, "risk_report.csv", "text/csv")
-        
-        excel_risk = export_to_excel(risk_report, "risk_report")
+        exp3.download_button(
+            "📥 Download Risk Report (CSV)",
+            lambda: _risk_report().to_csv(index=False).encode('utf-8'),
+            "risk_report.csv",
+            "text/csv"
+        )
         exp4.download_button(
             "📊 Download Risk Report (EXCEL)",
-            excel_risk,
+            lambda: export_to_excel(_risk_report(), "risk_report"),
             f"risk_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
             "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
         st.markdown("### 📋 Recent Transactions")
+        # Invoices arrive newest first, so only the rows shown are converted
+        df = prepare_ops_dataframe(all_invoices_data[:10])
         if 'days_pending' in df.columns:
             df['sla_status'] = df['days_pending'].apply(lambda x: "🚨 BREACH" if x > 3 else "On Track")
         
@@ -0,0 +1,398 @@
+"""Hot/cold tiering for invoices.
+
+Finished invoices (AUDITED / REJECTED) older than ARCHIVE_AFTER_DAYS move out of
+the live invoices table into gzip-compressed JSON Lines partitions, one per
+month of created_at:
+
+    <INVOICE_ARCHIVE_DIR>/invoices/2024-01/part-20240501T020000123456.jsonl.gz
+    <INVOICE_ARCHIVE_DIR>/invoices/2024-01/keys-20240501T020000234567.json
+    <INVOICE_ARCHIVE_DIR>/index.json
+
+index.json is the compact summary: per-partition files, row and stage
+counts, and per-vendor totals. The archived ids and the document hashes /
+business keys that the duplicate checks still need after the rows have left
+the live table are kept per partition in its keys file, so a run rewrites
+only the keys of the months it touched.
+
+Every run writes complete part and keys files (temp file + rename) and only
+then points index.json at them, so readers never see a half-written file and
+a run that dies early leaves the previous state intact.
+
+Run it as a periodic job:
+
+    python archive.py                       # uses ARCHIVE_AFTER_DAYS (default 90)
+    python archive.py --older-than-days 30 --dry-run
+"""
+import argparse
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import database
+
+
+ARCHIVE_STAGES = ("AUDITED", "REJECTED")
+INDEX_VERSION = 2
+
+_index_lock = threading.Lock()
+_index_cache = {"path": None, "mtime": None, "index": None, "hashes": None, "keys": None}
+_shard_cache = {}  # keys file -> shard; keys files are never rewritten in place
+
+
+def archive_dir():
+    return Path(os.getenv("INVOICE_ARCHIVE_DIR", "local_data/archive"))
+
+
+def archive_after_days():
+    return max(0, int(os.getenv("ARCHIVE_AFTER_DAYS", "90")))
+
+
+def _index_path():
+    return archive_dir() / "index.json"
+
+
+def _empty_index():
+    return {"version": INDEX_VERSION, "partitions": {}, "vendors": {}}
+
+
+def _empty_shard():
+    return {"ids": set(), "document_hashes": set(), "business_keys": set()}
+
+
+def _business_key(vendor_name, invoice_date, total_amount):
+    try:
+        amount = float(total_amount) if total_amount is not None else None
+    except (TypeError, ValueError):
+        amount = None
+    return [vendor_name, invoice_date, amount]
+
+
+def _partition_of(record):
+    created_at = str(record.get("created_at") or "")
+    return created_at[:7] if len(created_at) >= 7 else "undated"
+
+
+# --- INDEX ---
+def load_archive_index():
+    """Returns the summary index (cached until index.json changes on disk)."""
+    path = _index_path()
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        with _index_lock:
+            _index_cache.update({"path": None, "mtime": None, "index": None, "hashes": None, "keys": None})
+        return _empty_index()
+
+    with _index_lock:
+        if _index_cache["path"] == path and _index_cache["mtime"] == mtime:
+            return _index_cache["index"]
+        try:
+            index = json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"Archive Index Error: {e}")
+            return _empty_index()
+        _index_cache.update({"path": path, "mtime": mtime, "index": index, "hashes": None, "keys": None})
+        return index
+
+
+def _write_index(index):
+    path = _index_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def _read_shard(relative):
+    data = json.loads((archive_dir() / relative).read_text(encoding="utf-8"))
+    return {
+        "ids": set(data.get("ids", [])),
+        "document_hashes": set(data.get("document_hashes", [])),
+        "business_keys": {tuple(key) for key in data.get("business_keys", [])},
+    }
+
+
+def _write_shard(partition, name, shard):
+    """Writes a partition's keys to a new keys file and points the partition at
+    it; returns the keys file it replaces, to be removed once the index is saved."""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    relative = f"invoices/{name}/keys-{stamp}.json"
+    data = {
+        "ids": sorted(shard["ids"], key=str),
+        "document_hashes": sorted(shard["document_hashes"]),
+        "business_keys": sorted((list(key) for key in shard["business_keys"]), key=json.dumps),
+    }
+    path = archive_dir() / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp_path, path)
+    previous = partition.get("keys_file")
+    partition["keys_file"] = relative
+    return previous
+
+
+def _duplicate_sets():
+    """(document hashes, business keys) over all partitions, rebuilt when the
+    index changes; keys files already read are reused."""
+    index = load_archive_index()
+    with _index_lock:
+        if _index_cache["index"] is index and _index_cache["hashes"] is not None:
+            return _index_cache["hashes"], _index_cache["keys"]
+        # A version 1 index still holds the lists itself
+        hashes = set(index.get("document_hashes", []))
+        keys = {tuple(key) for key in index.get("business_keys", [])}
+        wanted = set()
+        for partition in index.get("partitions", {}).values():
+            relative = partition.get("keys_file")
+            if not relative:
+                continue
+            wanted.add(relative)
+            if relative not in _shard_cache:
+                try:
+                    _shard_cache[relative] = _read_shard(relative)
+                except Exception as e:
+                    print(f"Archive Index Error: {e}")
+                    continue
+            hashes |= _shard_cache[relative]["document_hashes"]
+            keys |= _shard_cache[relative]["business_keys"]
+        for relative in set(_shard_cache) - wanted:
+            del _shard_cache[relative]
+        if _index_cache["index"] is index:
+            _index_cache.update({"hashes": hashes, "keys": keys})
+        return hashes, keys
+
+
+def is_archived_hash(document_hash):
+    """True when an archived invoice has this document hash."""
+    if not document_hash:
+        return False
+    return document_hash in _duplicate_sets()[0]
+
+
+def is_archived_duplicate(vendor_name, invoice_date, total_amount):
+    """True when an archived invoice has the same Vendor, Date and Amount."""
+    return tuple(_business_key(vendor_name, invoice_date, total_amount)) in _duplicate_sets()[1]
+
+
+def archive_summary():
+    """Totals for display: archived row count, stage counts and month range."""
+    index = load_archive_index()
+    partitions = index.get("partitions", {})
+    stage_counts = {}
+    for partition in partitions.values():
+        for stage, count in partition.get("stage_counts", {}).items():
+            stage_counts[stage] = stage_counts.get(stage, 0) + count
+    months = sorted(name for name in partitions if name != "undated")
+    return {
+        "total_invoices": sum(p.get("rows", 0) for p in partitions.values()),
+        "stage_counts": stage_counts,
+        "first_month": months[0] if months else None,
+        "last_month": months[-1] if months else None,
+    }
+
+
+def archived_vendor_totals():
+    """{vendor_name: {"count", "total_amount"}} over archived invoices, for the
+    vendor statistics that would otherwise only see the live tier."""
+    return load_archive_index().get("vendors", {})
+
+
+# --- READS ---
+def iter_archived_invoices(months=None):
+    """Yields archived invoice rows, oldest partition first."""
+    index = load_archive_index()
+    for name in sorted(index.get("partitions", {})):
+        if months and name not in months:
+            continue
+        # Only indexed part files are read; a part left by a run that died
+        # before updating the index is ignored and its rows re-archived.
+        for relative in index["partitions"][name]["files"]:
+            with gzip.open(archive_dir() / relative, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def fetch_archived_invoices(months=None):
+    """All archived invoice rows as a list."""
+    try:
+        return list(iter_archived_invoices(months))
+    except Exception as e:
+        print(f"Archive Read Error: {e}")
+        return []
+
+
+# --- ARCHIVE JOB ---
+def archive_invoices(older_than_days=None, batch_size=500, dry_run=False):
+    """Moves AUDITED/REJECTED invoices older than the cutoff into the archive.
+
+    Rows are written (and fsynced) to their partition and recorded in the
+    index before they are deleted from the live table, so an interrupted run
+    never loses data; ids already in the index are not archived twice.
+    """
+    days = archive_after_days() if older_than_days is None else max(0, int(older_than_days))
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    created_before = cutoff.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "+00:00"
+    result = {"status": "ok", "cutoff": created_before, "archived": 0, "deleted": 0, "partitions": {}, "errors": []}
+
+    repository = database.get_repository()
+    index = json.loads(json.dumps(load_archive_index()))  # private copy to mutate
+
+    if dry_run:
+        # Nothing is deleted, so only one batch can be inspected
+        rows = repository.fetch_archivable_invoices(ARCHIVE_STAGES, created_before, limit=batch_size)
+        for row in rows:
+            name = _partition_of(row)
+            result["partitions"][name] = result["partitions"].get(name, 0) + 1
+        result["archived"] = len(rows)
+        result["status"] = "dry_run" if len(rows) < batch_size else "dry_run_partial"
+        return result
+
+    try:
+        shards = _load_shards(index)
+    except Exception as e:
+        result["status"] = "error"
+        result["errors"].append(f"Archive index read failed: {e}")
+        return result
+    archived_ids = set().union(*(shard["ids"] for shard in shards.values()))
+
+    while True:
+        rows = repository.fetch_archivable_invoices(ARCHIVE_STAGES, created_before, limit=batch_size)
+        if not rows:
+            break
+
+        by_partition = {}
+        for row in rows:
+            if row.get("id") in archived_ids:
+                continue  # left over from an interrupted run; just delete it
+            by_partition.setdefault(_partition_of(row), []).append(row)
+
+        try:
+            for name, partition_rows in by_partition.items():
+                _append_partition(index, shards.setdefault(name, _empty_shard()), name, partition_rows)
+                archived_ids.update(row.get("id") for row in partition_rows)
+                result["partitions"][name] = result["partitions"].get(name, 0) + len(partition_rows)
+                result["archived"] += len(partition_rows)
+            _commit_index(index, shards, by_partition)
+        except Exception as e:
+            result["status"] = "error"
+            result["errors"].append(f"Archive write failed: {e}")
+            break
+
+        deleted = repository.delete_invoices([row["id"] for row in rows])
+        result["deleted"] += deleted
+        if deleted < len(rows):
+            result["status"] = "error"
+            result["errors"].append(f"Deleted {deleted} of {len(rows)} archived invoices")
+            break
+
+    return result
+
+
+def _load_shards(index):
+    """{partition: shard} for every partition, read from the keys files.
+
+    A version 1 index kept the ids in each partition and the hashes and keys
+    in one global list; its partitions are rebuilt from their part files and
+    the index is rewritten in the current layout.
+    """
+    shards = {}
+    legacy = [name for name, partition in index["partitions"].items() if not partition.get("keys_file")]
+    for name, partition in index["partitions"].items():
+        if name not in legacy:
+            shards[name] = _read_shard(partition["keys_file"])
+            continue
+        shard = shards[name] = _empty_shard()
+        shard["ids"].update(partition.get("ids", []))
+        for row in iter_archived_invoices([name]):
+            shard["ids"].add(row.get("id"))
+            if row.get("document_hash"):
+                shard["document_hashes"].add(row["document_hash"])
+            shard["business_keys"].add(
+                tuple(_business_key(row.get("vendor_name"), row.get("invoice_date"), row.get("total_amount")))
+            )
+    if legacy or "document_hashes" in index or "business_keys" in index:
+        for name in legacy:
+            index["partitions"][name].pop("ids", None)
+        index.pop("document_hashes", None)
+        index.pop("business_keys", None)
+        index["version"] = INDEX_VERSION
+        _commit_index(index, shards, legacy)
+    return shards
+
+
+def _commit_index(index, shards, names):
+    """Writes the keys of the given partitions, then the index that points at
+    them; the keys files they replace are removed afterwards."""
+    replaced = [_write_shard(index["partitions"][name], name, shards[name]) for name in names]
+    _write_index(index)
+    for relative in replaced:
+        if relative:
+            try:
+                (archive_dir() / relative).unlink()
+            except OSError as e:
+                print(f"Archive Cleanup Error: {e}")
+
+
+def _append_partition(index, shard, name, rows):
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    relative = f"invoices/{name}/part-{stamp}.jsonl.gz"
+    path = archive_dir() / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as fh:
+            for row in rows:
+                fh.write((json.dumps(row, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+    partition = index["partitions"].setdefault(name, {
+        "files": [], "rows": 0, "stage_counts": {},
+        "first_created_at": None, "last_created_at": None,
+    })
+    partition["files"].append(relative)
+    for row in rows:
+        partition["rows"] += 1
+        shard["ids"].add(row.get("id"))
+        stage = row.get("approval_stage") or ""
+        partition["stage_counts"][stage] = partition["stage_counts"].get(stage, 0) + 1
+        created_at = row.get("created_at")
+        if created_at:
+            if not partition["first_created_at"] or created_at < partition["first_created_at"]:
+                partition["first_created_at"] = created_at
+            if not partition["last_created_at"] or created_at > partition["last_created_at"]:
+                partition["last_created_at"] = created_at
+
+        vendor = row.get("vendor_name")
+        if vendor:
+            totals = index["vendors"].setdefault(vendor, {"count": 0, "total_amount": 0.0})
+            totals["count"] += 1
+            try:
+                totals["total_amount"] += float(row.get("total_amount") or 0)
+            except (TypeError, ValueError):
+                pass
+
+        if row.get("document_hash"):
+            shard["document_hashes"].add(row["document_hash"])
+        shard["business_keys"].add(tuple(_business_key(vendor, row.get("invoice_date"), row.get("total_amount"))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move finished invoices into the cold archive.")
+    parser.add_argument("--older-than-days", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    result = archive_invoices(args.older_than_days, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Memory-bounded attachment buffers for mail ingestion.
+
+Decoded attachments are written to a SpooledTemporaryFile: small ones stay in
+memory, anything above MAIL_SPOOL_MEMORY_MB rolls over to a temp file. The
+SHA-256 is computed while writing, so duplicate checks never read the data
+again, and storage uploads stream from the file.
+
+Spooled bytes that entered the pipeline count against one process-wide
+budget (MAIL_INFLIGHT_BUDGET_MB). The IMAP reader waits for room before it
+hands over another attachment, so the data between fetch and storage stays
+bounded however large the mails are. An attachment larger than the whole
+budget is let through once nothing else is in flight.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+_budget_lock = threading.Lock()
+_budget = None
+
+
+def spool_memory_bytes() -> int:
+    return int(float(os.getenv("MAIL_SPOOL_MEMORY_MB", "1")) * 1024 * 1024)
+
+
+class ByteBudget:
+    """Counting limit on bytes in flight; limit <= 0 means unlimited."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int) -> float:
+        """Blocks until size bytes fit; returns the seconds spent waiting."""
+        started = time.perf_counter()
+        with self.condition:
+            while self.limit > 0 and self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+        return time.perf_counter() - started
+
+    def release(self, size: int) -> None:
+        with self.condition:
+            self.in_flight = max(0, self.in_flight - size)
+            self.condition.notify_all()
+
+
+def inflight_budget() -> ByteBudget:
+    """The budget shared by every ingestion run in this process."""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ByteBudget(int(float(os.getenv("MAIL_INFLIGHT_BUDGET_MB", "256")) * 1024 * 1024))
+        return _budget
+
+
+class SpooledAttachment:
+    """Decoded attachment data: write() while decoding, then open() for
+    streaming readers or read_bytes() where a whole bytes object is needed."""
+
+    def __init__(self, max_memory: Optional[int] = None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_memory_bytes() if max_memory is None else max_memory)
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._budget = None
+        self._reserved = 0
+
+    def write(self, data: bytes) -> None:
+        if data:
+            self.file.write(data)
+            self._digest.update(data)
+            self.size += len(data)
+
+    @property
+    def sha256(self) -> Optional[str]:
+        """Same value as database.compute_document_hash() on the bytes."""
+        return self._digest.hexdigest() if self.size else None
+
+    @property
+    def on_disk(self) -> bool:
+        return bool(getattr(self.file, "_rolled", False))
+
+    def reserve(self, budget: ByteBudget) -> float:
+        """Counts this attachment against budget until close(); returns the wait."""
+        if self._budget is not None:
+            return 0.0
+        waited = budget.acquire(self.size)
+        self._budget, self._reserved = budget, self.size
+        return waited
+
+    def open(self):
+        """The underlying file, rewound; read it, do not close it."""
+        self.file.seek(0)
+        return self.file
+
+    def read_bytes(self) -> bytes:
+        return self.open().read()
+
+    def close(self) -> None:
+        """Deletes the data and gives its share of the budget back (idempotent)."""
+        self.file.close()
+        if self._budget is not None:
+            self._budget.release(self._reserved)
+            self._budget, self._reserved = None, 0
@@ -0,0 +1,88 @@
+"""Cold-start benchmark for the dashboard and the mail ingestion path.
+
+Each measurement runs in a fresh interpreter so nothing is cached in-process:
+
+    python bench_startup.py            # 5 runs per target
+    python bench_startup.py --runs 10
+
+The dashboard is executed headlessly with Streamlit's AppTest against a
+throwaway SQLite database (DB_BACKEND=sqlite), so no credentials or network
+are needed. The report also lists which heavy optional modules got imported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ["google.generativeai", "supabase", "openpyxl", "pandas", "imaplib"]
+
+_IMPORT_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+_APP_SNIPPET = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file("app.py", default_timeout=120).run()
+elapsed = time.perf_counter() - start
+errors = [str(e.value) for e in at.exception]
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules], "errors": errors}}))
+"""
+
+
+def _run_once(snippet, env):
+    proc = subprocess.run(
+        [sys.executable, "-c", snippet],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip() or f"exit code {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _bench(name, snippet, env, runs):
+    samples = [_run_once(snippet, env) for _ in range(runs)]
+    times = [s["seconds"] for s in samples]
+    last = samples[-1]
+    print(f"{name:<22} median {statistics.median(times) * 1000:8.1f} ms"
+          f"   min {min(times) * 1000:8.1f} ms   ({runs} runs)")
+    print(f"{'':<22} heavy modules loaded: {', '.join(last['loaded']) or 'none'}")
+    for error in last.get("errors") or []:
+        print(f"{'':<22} ⚠️ app exception: {error}")
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            "DB_BACKEND": "sqlite",
+            "SQLITE_DB_PATH": os.path.join(tmp, "bench.db"),
+            "LOCAL_STORAGE_DIR": os.path.join(tmp, "storage"),
+            "PYTHONDONTWRITEBYTECODE": "1",
+        })
+
+        print("🚀 Startup benchmark (fresh interpreter per run)\n")
+        _bench("import processor", _IMPORT_SNIPPET.format(module="processor", heavy=HEAVY_MODULES), env, args.runs)
+        _bench("import database", _IMPORT_SNIPPET.format(module="database", heavy=HEAVY_MODULES), env, args.runs)
+        _bench("import mail_ingestion", _IMPORT_SNIPPET.format(module="mail_ingestion", heavy=HEAVY_MODULES), env, args.runs)
+        _bench("app.py first render", _APP_SNIPPET.format(heavy=HEAVY_MODULES), env, args.runs)
+
+
+if __name__ == "__main__":
+    main()
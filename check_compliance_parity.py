@@ -0,0 +1,156 @@
+"""Parity check: compliance_batch against the scalar compliance rules.
+
+Generates clean invoices plus a share with messy values (bad dates, numbers as text,
+"1_000", non-ASCII digits, NaN, negative and zero amounts, odd currencies,
+missing line items ...), evaluates them both ways and fails on the first
+difference in compliant flag, issue text or issue order:
+
+    python check_compliance_parity.py                 # 20000 invoices
+    python check_compliance_parity.py --invoices 100000 --seed 7 --messy 1
+    python check_compliance_parity.py --policy compliance_policy.example.json
+"""
+import argparse
+import random
+import sys
+import time
+from decimal import Decimal
+
+from compliance import evaluate_invoice_compliance
+from compliance_policy import load_policy
+from compliance_batch import evaluate_invoice_compliance_batch, invoices_to_frames
+
+VENDORS = ["Acme Corp", "", None, "  ", 0, "Globex", "Ünïcode GmbH", float("nan"), [], "X"]
+DATES = [
+    "2024-01-15", "2024-1-5", "2024-02-29", "2023-02-29", "2024-13-01", "2024-00-10", "2024-04-31",
+    "2024-01- 5", "2024-01-05\n", " 2024-01-05", "24-01-05", "0000-01-01", "0001-01-01", "9999-12-31",
+    "2024/01/05", "٢٠٢٤-٠١-٠٥", "2024-01-05 00:00:00", "", None, 20240105, float("nan"), "nan",
+]
+ENTITIES = ["acme-eu", "ACME-US ", None, "", "other"]
+CURRENCIES = ["USD", "usd", " eur ", "GBP", "XYZ", "", None, "ß", 0, 840, "inr ", float("nan"), "Jpy"]
+
+
+def _amount(rng):
+    return rng.choice([
+        round(rng.uniform(1, 5000), 2), 0, -5, "120.50", " 99 ", "1_000", "١٢", "abc", "", None,
+        float("nan"), "nan", "inf", True, Decimal("10.25"), rng.randint(1, 500), [1], "1,000",
+    ])
+
+
+def _line_item(rng):
+    quantity = rng.choice([1, 2, 3, 0, -1, "2", "x", None, 1.5, float("nan")])
+    unit_price = rng.choice([round(rng.uniform(0, 500), 2), -3, "15", "bad", None, 0])
+    total_price = rng.choice([
+        round(rng.uniform(0, 1500), 2), -10, "25.5", "n/a", None, float("nan"), "inf", 0.1, 0.2,
+    ])
+    return {
+        "description": rng.choice(["Widget", "", "   ", None, 0, "Service fee", float("nan")]),
+        "quantity": quantity,
+        "unit_price": unit_price,
+        "total_price": total_price,
+    }
+
+
+def make_clean_invoice(rng):
+    line_items = []
+    for _ in range(rng.randint(1, 5)):
+        quantity = rng.randint(1, 10)
+        unit_price = round(rng.uniform(1, 300), 2)
+        line_items.append({
+            "description": "Item", "quantity": quantity, "unit_price": unit_price,
+            "total_price": round(quantity * unit_price, 2),
+        })
+    return {
+        "vendor_name": rng.choice(["Acme Corp", "Globex", "Initech"]),
+        "invoice_date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "total_amount": round(sum(item["total_price"] for item in line_items) + rng.choice([0, 0, 0, 5]), 2),
+        "currency": rng.choice(["USD", "EUR", "INR"]),
+        "entity": rng.choice(ENTITIES),
+        "line_items": line_items,
+    }
+
+
+def make_invoice(rng, messy_share: float = 0.3):
+    if rng.random() >= messy_share:
+        return make_clean_invoice(rng)
+    line_items = rng.choice([None, [], "lines"])
+    if line_items == "lines":
+        line_items = [_line_item(rng) for _ in range(rng.randint(1, 6))]
+    invoice = {
+        "vendor_name": rng.choice(VENDORS),
+        "invoice_date": rng.choice(DATES),
+        "total_amount": _amount(rng),
+        "currency": rng.choice(CURRENCIES),
+        "entity": rng.choice(ENTITIES),
+        "line_items": line_items,
+    }
+    if line_items and rng.random() < 0.5:
+        # Totals that sit right at the 1.0 tolerance
+        computed = 0.0
+        for item in line_items:
+            try:
+                computed += float(item["total_price"])
+            except Exception:
+                pass
+        invoice["total_amount"] = computed + rng.choice([0, 1.0, 1.0000001, -1.0, 0.5])
+    for field in ("vendor_name", "currency", "line_items"):
+        if rng.random() < 0.03:
+            invoice.pop(field)
+    return invoice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--messy", type=float, default=0.3, help="share of invoices with messy values")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs (best one is reported)")
+    parser.add_argument("--policy", help="policy pack file (default: COMPLIANCE_POLICY_FILE or the built-in pack)")
+    args = parser.parse_args()
+    policy = load_policy(args.policy)
+
+    rng = random.Random(args.seed)
+    invoices = [make_invoice(rng, args.messy) for _ in range(args.invoices)]
+    # NaN means "missing" in frames; the scalar function sees None there
+    scalar_input = [
+        {key: None if isinstance(value, float) and value != value else value for key, value in invoice.items()}
+        for invoice in invoices
+    ]
+    for invoice in scalar_input:
+        for item in invoice.get("line_items") or []:
+            for key, value in item.items():
+                if isinstance(value, float) and value != value:
+                    item[key] = None
+
+    started = time.perf_counter()
+    header, lines = invoices_to_frames(invoices, policy)
+    frames_seconds = time.perf_counter() - started
+
+    scalar_seconds = batch_seconds = float("inf")
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        expected = [evaluate_invoice_compliance(invoice, policy) for invoice in scalar_input]
+        scalar_seconds = min(scalar_seconds, time.perf_counter() - started)
+        started = time.perf_counter()
+        actual = evaluate_invoice_compliance_batch(header, lines, policy)
+        batch_seconds = min(batch_seconds, time.perf_counter() - started)
+
+    mismatches = [i for i, (want, got) in enumerate(zip(expected, actual)) if want != got]
+    if len(actual) != len(expected):
+        mismatches.append(min(len(actual), len(expected)))
+    for i in mismatches[:5]:
+        print(f"❌ invoice {i}: {scalar_input[i]!r}")
+        print(f"   scalar: {expected[i]}")
+        print(f"   batch:  {actual[i] if i < len(actual) else None}")
+    flagged = sum(not result["compliant"] for result in expected)
+    print(f"policy {policy.version}")
+    print(f"{len(invoices)} invoices ({flagged} non-compliant), {len(lines)} line items")
+    print(f"scalar {scalar_seconds * 1000:.0f} ms | batch {batch_seconds * 1000:.0f} ms "
+          f"({scalar_seconds / batch_seconds:.1f}x, + {frames_seconds * 1000:.0f} ms building frames from dicts)")
+    if mismatches:
+        print(f"❌ {len(mismatches)} invoice(s) differ")
+        sys.exit(1)
+    print("✅ Batch results identical to evaluate_invoice_compliance")
+
+
+if __name__ == "__main__":
+    main()
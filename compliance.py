@@ -1,9 +1,9 @@
 from datetime import datetime
 
+from compliance_policy import CHECKS, DEFAULT_CURRENCIES, active_policy
 
-ALLOWED_CURRENCIES = {
-    "USD", "EUR", "GBP", "INR", "AED", "SGD", "AUD", "CAD", "JPY", "CNY"
-}
+
+ALLOWED_CURRENCIES = set(DEFAULT_CURRENCIES)
 
 
 def _is_valid_date(date_text):
@@ -16,72 +16,136 @@ def _is_valid_date(date_text):
         return False
 
 
-def evaluate_invoice_compliance(invoice):
-    issues = []
+# --- CHECKS ---
+# Each check gets the invoice, its resolved RuleSet and a per-invoice dict of
+# values parsed so far, and returns its issues.
+def _invoice_total(invoice, state):
+    if "total_value" not in state:
+        try:
+            state["total_value"], state["total_valid"] = float(invoice.get("total_amount")), True
+        except Exception:
+            state["total_value"], state["total_valid"] = 0.0, False
+    return state["total_value"]
 
-    vendor_name = invoice.get("vendor_name")
-    invoice_date = invoice.get("invoice_date")
-    total_amount = invoice.get("total_amount")
-    currency = str(invoice.get("currency") or "").upper().strip()
-    line_items = invoice.get("line_items") or []
 
-    if not vendor_name:
-        issues.append("Missing vendor name")
+def _check_required_fields(invoice, rules, state):
+    return [f"Missing {field.replace('_', ' ')}" for field in rules.required_fields if not invoice.get(field)]
 
-    if not _is_valid_date(invoice_date):
-        issues.append("Invalid invoice date format (expected YYYY-MM-DD)")
 
-    try:
-        total_value = float(total_amount)
-        if total_value <= 0:
-            issues.append("Invoice total must be greater than zero")
-    except Exception:
-        total_value = 0.0
-        issues.append("Invalid invoice total amount")
+def _check_invoice_date(invoice, rules, state):
+    if not _is_valid_date(invoice.get("invoice_date")):
+        return ["Invalid invoice date format (expected YYYY-MM-DD)"]
+    return []
 
-    if currency and currency not in ALLOWED_CURRENCIES:
-        issues.append(f"Unsupported currency: {currency}")
 
-    if not line_items:
-        issues.append("No line items extracted")
-    else:
-        computed_total = 0.0
-        for index, item in enumerate(line_items, start=1):
-            desc = str(item.get("description") or "").strip()
-            quantity = item.get("quantity")
-            unit_price = item.get("unit_price")
-            total_price = item.get("total_price")
-
-            if not desc:
-                issues.append(f"Line {index}: Missing description")
-
-            try:
-                quantity_value = float(quantity)
-                if quantity_value <= 0:
-                    issues.append(f"Line {index}: Quantity must be greater than zero")
-            except Exception:
-                issues.append(f"Line {index}: Invalid quantity")
-
-            try:
-                unit_price_value = float(unit_price)
-                if unit_price_value < 0:
-                    issues.append(f"Line {index}: Unit price cannot be negative")
-            except Exception:
-                issues.append(f"Line {index}: Invalid unit price")
-
-            try:
-                total_price_value = float(total_price)
-                if total_price_value < 0:
-                    issues.append(f"Line {index}: Total price cannot be negative")
-                computed_total += total_price_value
-            except Exception:
-                issues.append(f"Line {index}: Invalid total price")
-
-        if total_value > 0 and abs(total_value - computed_total) > 1.0:
-            issues.append("Line-item total mismatch against invoice total")
+def _check_total_amount(invoice, rules, state):
+    total_value = _invoice_total(invoice, state)
+    if not state["total_valid"]:
+        return ["Invalid invoice total amount"]
+    if total_value <= 0:
+        return ["Invoice total must be greater than zero"]
+    return []
+
 
+def _check_max_amount(invoice, rules, state):
+    total_value = _invoice_total(invoice, state)
+    if total_value > rules.max_amount:
+        return [f"Invoice total {total_value:,.2f} exceeds the limit of {rules.max_amount:,.2f}"]
+    return []
+
+
+def _check_currency(invoice, rules, state):
+    currency = str(invoice.get("currency") or "").upper().strip()
+    if currency and currency not in rules.allowed_currencies:
+        return [f"Unsupported currency: {currency}"]
+    return []
+
+
+def _check_line_items(invoice, rules, state):
+    issues = []
+    line_items = invoice.get("line_items") or []
+    if not line_items:
+        if rules.require_line_items:
+            issues.append("No line items extracted")
+        return issues
+
+    computed_total = 0.0
+    for index, item in enumerate(line_items, start=1):
+        desc = str(item.get("description") or "").strip()
+        quantity = item.get("quantity")
+        unit_price = item.get("unit_price")
+        total_price = item.get("total_price")
+
+        if not desc:
+            issues.append(f"Line {index}: Missing description")
+
+        try:
+            quantity_value = float(quantity)
+            if quantity_value <= 0:
+                issues.append(f"Line {index}: Quantity must be greater than zero")
+        except Exception:
+            issues.append(f"Line {index}: Invalid quantity")
+
+        try:
+            unit_price_value = float(unit_price)
+            if unit_price_value < 0:
+                issues.append(f"Line {index}: Unit price cannot be negative")
+        except Exception:
+            issues.append(f"Line {index}: Invalid unit price")
+
+        try:
+            total_price_value = float(total_price)
+            if total_price_value < 0:
+                issues.append(f"Line {index}: Total price cannot be negative")
+            computed_total += total_price_value
+        except Exception:
+            issues.append(f"Line {index}: Invalid total price")
+
+    state["computed_total"] = computed_total
+    return issues
+
+
+def _check_tolerance(invoice, rules, state):
+    if not invoice.get("line_items"):
+        return []
+    if "computed_total" not in state:
+        _check_line_items(invoice, rules, state)
+    total_value = _invoice_total(invoice, state)
+    if total_value > 0 and abs(total_value - state["computed_total"]) > rules.tolerance:
+        return ["Line-item total mismatch against invoice total"]
+    return []
+
+
+_CHECK_FUNCTIONS = {
+    "required_fields": _check_required_fields,
+    "invoice_date": _check_invoice_date,
+    "total_amount": _check_total_amount,
+    "max_amount": _check_max_amount,
+    "currency": _check_currency,
+    "line_items": _check_line_items,
+    "tolerance": _check_tolerance,
+}
+_REPORT_ORDER = [name for name, _, _ in sorted(CHECKS, key=lambda check: check[1])]
+
+
+def evaluate_invoice_compliance(invoice, policy=None):
+    """Runs the plan of the policy pack (default: the active one) that
+    applies to this invoice's entity, currency and vendor."""
+    policy = policy or active_policy()
+    rules = policy.resolve_invoice(invoice)
+    state = {}
+    found = {}
+    for check in rules.plan:
+        check_issues = _CHECK_FUNCTIONS[check](invoice, rules, state)
+        if check_issues:
+            found[check] = check_issues
+            if policy.mode == "first":
+                break
+
+    issues = [issue for check in _REPORT_ORDER for issue in found.get(check, ())]
     return {
         "compliant": len(issues) == 0,
         "issues": issues,
         "issue_count": len(issues),
+        "policy_version": policy.version,
     }
@@ -0,0 +1,294 @@
+"""Column-wise version of compliance.evaluate_invoice_compliance().
+
+Re-validating a whole invoice history one dict at a time is slow, so this
+applies the same rules to whole columns with pandas/NumPy:
+
+    header, lines = invoices_to_frames(invoices)
+    results = evaluate_invoice_compliance_batch(header, lines)
+
+Header frame: one row per invoice with vendor_name, invoice_date,
+total_amount, currency, the policy pack's entity field and any other field
+it requires. Line-item frame: one row per item with "invoice"
+(the header row's index label), description, quantity, unit_price,
+total_price and optionally "line" (1-based position), in list order.
+NaN and None both mean "missing", as in frames read from the database.
+
+The policy pack is resolved once per distinct entity/currency/vendor, and
+its settings become per-row columns (tolerance, limit, currency whitelist
+...). Results are identical to the scalar function, issue text and order
+included; check_compliance_parity.py verifies that on generated invoices.
+"""
+import gc
+
+import numpy as np
+import pandas as pd
+
+from compliance import _is_valid_date
+from compliance_policy import CHECKS, active_policy
+
+HEADER_FIELDS = ("vendor_name", "invoice_date", "total_amount", "currency")
+LINE_ITEM_FIELDS = ("description", "quantity", "unit_price", "total_price")
+
+_DATE_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9]
+_DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+_RANKS = {name: rank for name, rank, _ in CHECKS}
+# Position of each check in a plan: in "first" mode only the issues of the
+# earliest failing check are kept
+_RUN_ORDER = {name: order for order, (name, _, _) in enumerate(sorted(CHECKS, key=lambda check: (check[2], check[1])))}
+
+
+def _column(frame: pd.DataFrame, name: str) -> np.ndarray:
+    """The column as Python objects with NaN/NA turned into None (all None if absent)."""
+    if name not in frame:
+        return np.full(len(frame), None, dtype=object)
+    values = frame[name].astype(object)
+    column = values.to_numpy(dtype=object, copy=True)
+    column[values.isna().to_numpy()] = None
+    return column
+
+
+def _is_missing(column: np.ndarray) -> np.ndarray:
+    """`not value` for every row (None, "", 0, [] ...)."""
+    return ~column.astype(bool)
+
+
+def _texts(column: np.ndarray) -> np.ndarray:
+    """str(value or "") for every row."""
+    column = column.copy()
+    column[_is_missing(column)] = ""
+    return np.fromiter(map(str, column), dtype=object, count=len(column))
+
+
+def _as_float(frame: pd.DataFrame, name: str):
+    """float(value) for every row: (numbers, converted). If some value does not
+    convert, pandas parses the column and whatever it rejects ("1_000",
+    non-ASCII digits, ...) is retried with float() itself."""
+    if name in frame and pd.api.types.is_numeric_dtype(frame[name]):
+        numbers = frame[name].to_numpy(dtype=float, na_value=np.nan)
+        return numbers, ~np.isnan(numbers)
+    column = _column(frame, name)
+    present = column != None  # noqa: E711 (elementwise)
+    try:
+        # NumPy calls float() on each object, so this is exact when nothing fails
+        return np.where(present, column, np.nan).astype(float), present
+    except Exception:
+        pass
+    numbers = pd.to_numeric(pd.Series(column, dtype=object), errors="coerce").to_numpy(
+        dtype=float, na_value=np.nan, copy=True
+    )
+    converted = ~np.isnan(numbers)
+    for position in np.flatnonzero(~converted & present):
+        try:
+            value = float(column[position])
+        except Exception:
+            continue
+        numbers[position] = value
+        converted[position] = True
+    return numbers, converted
+
+
+def _valid_dates(column: np.ndarray) -> np.ndarray:
+    """_is_valid_date() for every row. Plain "YYYY-MM-DD" strings are checked
+    on their code points; anything else goes through strptime itself."""
+    texts = np.fromiter(map(str, column), dtype=object, count=len(column))
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    valid = np.zeros(len(column), dtype=bool)
+    plain = lengths == 10
+    if plain.any():
+        codes = texts[plain].astype("<U10").view(np.uint32).reshape(-1, 10).astype(np.int64)
+        digits = codes - 48
+        shaped = ((digits[:, _DATE_DIGITS] >= 0) & (digits[:, _DATE_DIGITS] <= 9)).all(axis=1)
+        shaped &= (codes[:, 4] == 45) & (codes[:, 7] == 45)
+        year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+        month = np.where(shaped, digits[:, 5] * 10 + digits[:, 6], 0)
+        day = digits[:, 8] * 10 + digits[:, 9]
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        in_calendar = (month >= 1) & (month <= 12) & (year >= 1) & (day >= 1)
+        in_calendar &= day <= _DAYS_IN_MONTH[np.clip(month, 0, 12)] + ((month == 2) & leap)
+        valid[plain] = shaped & in_calendar
+        plain[plain] = shaped
+    # "2024-1-5", " 5" days, non-ASCII digits ...: rare, so strptime decides
+    others = np.flatnonzero(~plain)
+    valid[others] = [_is_valid_date(value) for value in column[others]]
+    return valid
+
+
+def explode_line_items(invoices: pd.DataFrame) -> pd.DataFrame:
+    """Line-item frame from a header frame whose "line_items" column holds lists of dicts."""
+    rows = []
+    for label, items in zip(invoices.index, _column(invoices, "line_items")):
+        if not isinstance(items, (list, tuple)):
+            continue
+        for line, item in enumerate(items, start=1):
+            rows.append((label, line, *(item.get(field) for field in LINE_ITEM_FIELDS)))
+    return pd.DataFrame(rows, columns=["invoice", "line", *LINE_ITEM_FIELDS], dtype=object)
+
+
+def _header_fields(policy):
+    fields = {field: None for field in (*HEADER_FIELDS, policy.entity_field)}
+    for rules in [policy.defaults, *(settings for scope in policy.scopes.values() for settings in scope.values())]:
+        fields.update(dict.fromkeys(rules.get("required_fields", ())))
+    return list(fields)
+
+
+def invoices_to_frames(invoices, policy=None):
+    """(header frame, line-item frame) for a list of invoice dicts."""
+    policy = policy or active_policy()
+    header = pd.DataFrame(
+        {field: pd.Series([invoice.get(field) for invoice in invoices], dtype=object)
+         for field in (*_header_fields(policy), "line_items")}
+    )
+    return header, explode_line_items(header)
+
+
+def _rule_sets(header: pd.DataFrame, policy):
+    """(distinct RuleSets, per-row index into them) for the header rows."""
+    if not any(policy.scopes.values()):
+        return [policy.resolve()], np.zeros(len(header), dtype=np.int64)
+    rule_sets, seen = [], {}
+    codes = np.empty(len(header), dtype=np.int64)
+    rows = zip(_column(header, policy.entity_field), _column(header, "currency"), _column(header, "vendor_name"))
+    for position, (entity, currency, vendor) in enumerate(rows):
+        rule_set = policy.resolve(entity, currency, vendor)
+        code = seen.get(id(rule_set))
+        if code is None:
+            code = seen[id(rule_set)] = len(rule_sets)
+            rule_sets.append(rule_set)
+        codes[position] = code
+    return rule_sets, codes
+
+
+def evaluate_invoice_compliance_batch(invoices, line_items=None, policy=None):
+    """evaluate_invoice_compliance() for every row of invoices (a DataFrame
+    or a dict of columns), computed column-wise. line_items defaults to the
+    exploded "line_items" column. Returns one result dict per invoice, in
+    row order, identical to the scalar function's."""
+    policy = policy or active_policy()
+    header = invoices if isinstance(invoices, pd.DataFrame) else pd.DataFrame(dict(invoices))
+    if line_items is None:
+        line_items = explode_line_items(header)
+    count = len(header)
+    rule_sets, codes = _rule_sets(header, policy)
+
+    def setting(value_of, dtype=float):
+        return np.array([value_of(rule_set) for rule_set in rule_sets], dtype=dtype)[codes]
+
+    # Issues as (invoice position, check rank, line order, sub-order, run
+    # order, message), sorted into the scalar function's order at the end.
+    # Messages are only built for the rows that fail.
+    found = []
+
+    def add(mask, check, message, positions=None, line_order=None, sub_order=0):
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            return
+        found.append((
+            rows if positions is None else positions[rows],
+            np.full(len(rows), _RANKS[check]),
+            np.zeros(len(rows), dtype=np.int64) if line_order is None else line_order[rows],
+            sub_order[rows] if isinstance(sub_order, np.ndarray) else np.full(len(rows), sub_order),
+            np.full(len(rows), _RUN_ORDER[check]),
+            np.array(message(rows) if callable(message) else [message] * len(rows), dtype=object),
+        ))
+
+    # --- header ---
+    required = list(dict.fromkeys(field for rule_set in rule_sets for field in rule_set.required_fields))
+    for field in required:
+        field_order = setting(
+            lambda rule_set: rule_set.required_fields.index(field) if field in rule_set.required_fields else -1,
+            np.int64,
+        )
+        add(_is_missing(_column(header, field)) & (field_order >= 0), "required_fields",
+            f"Missing {field.replace('_', ' ')}", sub_order=field_order)
+    add(~_valid_dates(_column(header, "invoice_date")), "invoice_date",
+        "Invalid invoice date format (expected YYYY-MM-DD)")
+
+    total, total_ok = _as_float(header, "total_amount")
+    with np.errstate(invalid="ignore"):
+        add(total_ok & (total <= 0), "total_amount", "Invoice total must be greater than zero")
+    add(~total_ok, "total_amount", "Invalid invoice total amount")
+    total_value = np.where(total_ok, total, 0.0)
+
+    # NaN settings switch a comparison off, like None does in the scalar plan
+    max_amount = setting(lambda rule_set: np.nan if rule_set.max_amount is None else rule_set.max_amount)
+    with np.errstate(invalid="ignore"):
+        over_limit = total_value > max_amount
+    add(over_limit, "max_amount", lambda rows: [
+        f"Invoice total {value:,.2f} exceeds the limit of {limit:,.2f}"
+        for value, limit in zip(total_value[rows].tolist(), max_amount[rows].tolist())
+    ])
+
+    currency = _texts(_column(header, "currency"))
+    currency = np.fromiter(map(str.strip, map(str.upper, currency)), dtype=object, count=count)
+    unsupported = np.zeros(count, dtype=bool)
+    for code, rule_set in enumerate(rule_sets):
+        if rule_set.allowed_currencies is None:
+            continue
+        rows = codes == code
+        unsupported[rows] = ~pd.Series(currency[rows], dtype=object).isin(rule_set.allowed_currencies).to_numpy()
+    unsupported &= currency != ""
+    add(unsupported, "currency", lambda rows: [f"Unsupported currency: {code}" for code in currency[rows]])
+
+    # --- line items ---
+    positions = header.index.get_indexer(line_items["invoice"]) if len(line_items) else np.array([], dtype=np.int64)
+    lines = line_items[positions >= 0]
+    positions = positions[positions >= 0]
+    has_lines = np.bincount(positions, minlength=count) > 0
+    add(~has_lines & setting(lambda rule_set: rule_set.require_line_items, bool), "line_items",
+        "No line items extracted")
+
+    if len(lines):
+        line_order = pd.Series(positions).groupby(positions, sort=False).cumcount().to_numpy()
+        numbers = lines["line"].astype(int).to_numpy() if "line" in lines else line_order + 1
+
+        def line_issue(mask, sub_order, text):
+            add(mask, "line_items", lambda rows: [f"Line {number}: {text}" for number in numbers[rows]],
+                positions=positions, line_order=line_order, sub_order=sub_order)
+
+        descriptions = _texts(_column(lines, "description"))
+        line_issue(np.fromiter(map(str.strip, descriptions), dtype=object, count=len(lines)) == "", 0,
+                   "Missing description")
+
+        quantity, quantity_ok = _as_float(lines, "quantity")
+        unit_price, unit_price_ok = _as_float(lines, "unit_price")
+        total_price, total_price_ok = _as_float(lines, "total_price")
+        with np.errstate(invalid="ignore"):
+            line_issue(quantity_ok & (quantity <= 0), 1, "Quantity must be greater than zero")
+            line_issue(~quantity_ok, 1, "Invalid quantity")
+            line_issue(unit_price_ok & (unit_price < 0), 2, "Unit price cannot be negative")
+            line_issue(~unit_price_ok, 2, "Invalid unit price")
+            line_issue(total_price_ok & (total_price < 0), 3, "Total price cannot be negative")
+            line_issue(~total_price_ok, 3, "Invalid total price")
+
+        # Added one by one in line order, so rounding matches the scalar loop
+        computed_total = np.zeros(count)
+        np.add.at(computed_total, positions, np.where(total_price_ok, total_price, 0.0))
+        tolerance = setting(lambda rule_set: np.nan if rule_set.tolerance is None else rule_set.tolerance)
+        with np.errstate(invalid="ignore"):
+            mismatch = has_lines & (total_value > 0) & (np.abs(total_value - computed_total) > tolerance)
+        add(mismatch, "tolerance", "Line-item total mismatch against invoice total")
+
+    # One list and dict per invoice: with the cyclic GC running, building
+    # them rescans everything the caller holds, over and over
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        issues = [[] for _ in range(count)]
+        if found:
+            invoice_pos, rank, order, sub_order, run, messages = (np.concatenate(column) for column in zip(*found))
+            if policy.mode == "first":
+                first_failed = np.full(count, len(_RUN_ORDER))
+                np.minimum.at(first_failed, invoice_pos, run)
+                keep = run == first_failed[invoice_pos]
+                invoice_pos, rank, order, sub_order, messages = (
+                    column[keep] for column in (invoice_pos, rank, order, sub_order, messages)
+                )
+            ranked = np.lexsort((sub_order, order, rank, invoice_pos))
+            for position, message in zip(invoice_pos[ranked].tolist(), messages[ranked].tolist()):
+                issues[position].append(message)
+        return [{"compliant": not found_issues, "issues": found_issues, "issue_count": len(found_issues),
+                 "policy_version": policy.version}
+                for found_issues in issues]
+    finally:
+        if gc_enabled:
+            gc.enable()
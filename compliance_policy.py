@@ -0,0 +1,221 @@
+"""Compliance policy packs, compiled once into evaluation plans.
+
+COMPLIANCE_POLICY_FILE (default compliance_policy.json, see
+compliance_policy.example.json):
+
+    {"name": "acme-group",
+     "defaults":   {"tolerance": 1.0, "allowed_currencies": ["USD", "EUR"], "max_amount": 250000},
+     "currencies": {"JPY": {"tolerance": 100}},
+     "entities":   {"acme-eu": {"allowed_currencies": ["EUR"], "required_fields": ["vendor_name", "currency"]}},
+     "vendors":    {"Globex": {"max_amount": 10000}}}
+
+Rule settings: required_fields, allowed_currencies (null = any),
+max_amount (null = no limit), tolerance (line items vs. total; null = not
+checked) and require_line_items. They are merged defaults -> entity ->
+currency -> vendor, so the most specific scope wins. Vendor names match
+case-insensitively; the entity is read from the invoice's entity_field
+(default "entity", e.g. a mail rule tag).
+
+Each distinct scope combination is compiled once into a plan: only enabled
+checks, cheapest first. With "mode": "first" the plan stops at the first
+failing check; the default "all" reports every issue. Issues are always
+listed in the same order, whatever order the checks ran in.
+
+Without a file the built-in pack reproduces the original hard-coded rules.
+Every pack has a version hash of its normalized content; results carry
+it, so invoices checked under another version can be found and re-evaluated.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+PACK_FIELDS = {"name", "description", "mode", "entity_field", "defaults", "currencies", "entities", "vendors"}
+RULE_FIELDS = {"required_fields", "allowed_currencies", "max_amount", "tolerance", "require_line_items"}
+MODES = {"all", "first"}
+
+DEFAULT_CURRENCIES = ("USD", "EUR", "GBP", "INR", "AED", "SGD", "AUD", "CAD", "JPY", "CNY")
+DEFAULT_RULES = {
+    "required_fields": ["vendor_name"],
+    "allowed_currencies": list(DEFAULT_CURRENCIES),
+    "max_amount": None,
+    "tolerance": 1.0,
+    "require_line_items": True,
+}
+DEFAULT_PACK = {"name": "default", "defaults": DEFAULT_RULES}
+
+# Checks as (name, report rank, cost). The rank fixes where a check's issues
+# appear in the result; the cost decides when it runs (cheap ones first).
+CHECKS = (
+    ("required_fields", 0, 1),
+    ("invoice_date", 1, 4),
+    ("total_amount", 2, 2),
+    ("max_amount", 3, 2),
+    ("currency", 4, 1),
+    ("line_items", 5, 5),
+    ("tolerance", 6, 6),
+)
+CHECK_RANKS = {name: rank for name, rank, _ in CHECKS}
+
+_cache_lock = threading.Lock()
+_cache = {"key": None, "pack": None}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def policy_path() -> Path:
+    return Path(os.getenv("COMPLIANCE_POLICY_FILE", "compliance_policy.json"))
+
+
+def _number(value, where: str, minimum: float = 0.0) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum:
+        raise PolicyError(f"{where}: expected a number >= {minimum:g} or null")
+    return float(value)
+
+
+def _rules(spec, where: str) -> Dict:
+    """Validated and normalized rule settings of one scope (only the keys it sets)."""
+    if not isinstance(spec, dict):
+        raise PolicyError(f"{where}: expected an object")
+    unknown = set(spec) - RULE_FIELDS
+    if unknown:
+        raise PolicyError(f"{where}: unknown setting(s) {', '.join(sorted(unknown))}")
+    rules = {}
+    if "required_fields" in spec:
+        fields = spec["required_fields"]
+        if not isinstance(fields, list) or not all(isinstance(field, str) and field for field in fields):
+            raise PolicyError(f"{where}: required_fields must be a list of field names")
+        rules["required_fields"] = list(dict.fromkeys(fields))
+    if "allowed_currencies" in spec:
+        currencies = spec["allowed_currencies"]
+        if currencies is not None and (not isinstance(currencies, list) or not all(isinstance(c, str) for c in currencies)):
+            raise PolicyError(f"{where}: allowed_currencies must be a list of codes or null")
+        rules["allowed_currencies"] = None if currencies is None else sorted({c.upper().strip() for c in currencies})
+    if "max_amount" in spec:
+        rules["max_amount"] = _number(spec["max_amount"], f"{where}: max_amount")
+    if "tolerance" in spec:
+        rules["tolerance"] = _number(spec["tolerance"], f"{where}: tolerance")
+    if "require_line_items" in spec:
+        if not isinstance(spec["require_line_items"], bool):
+            raise PolicyError(f"{where}: require_line_items must be true or false")
+        rules["require_line_items"] = spec["require_line_items"]
+    return rules
+
+
+class RuleSet:
+    """Effective settings for one scope combination plus its compiled plan."""
+
+    def __init__(self, settings: Dict):
+        self.required_fields: Tuple[str, ...] = tuple(settings["required_fields"])
+        currencies = settings["allowed_currencies"]
+        self.allowed_currencies = None if currencies is None else frozenset(currencies)
+        self.max_amount: Optional[float] = settings["max_amount"]
+        self.tolerance: Optional[float] = settings["tolerance"]
+        self.require_line_items: bool = settings["require_line_items"]
+
+        enabled = {
+            "required_fields": bool(self.required_fields),
+            "invoice_date": True,
+            "total_amount": True,
+            "max_amount": self.max_amount is not None,
+            "currency": self.allowed_currencies is not None,
+            "line_items": True,
+            "tolerance": self.tolerance is not None,
+        }
+        self.plan: List[str] = [name for name, _, _ in sorted(CHECKS, key=lambda check: (check[2], check[1]))
+                                if enabled[name]]
+
+
+class PolicyPack:
+    """resolve(entity, currency, vendor) -> RuleSet, cached per combination."""
+
+    def __init__(self, spec: Dict, source: str = "built-in"):
+        if not isinstance(spec, dict):
+            raise PolicyError(f"{source}: expected an object")
+        unknown = set(spec) - PACK_FIELDS
+        if unknown:
+            raise PolicyError(f"{source}: unknown field(s) {', '.join(sorted(unknown))}")
+        self.name = str(spec.get("name") or "policy")
+        self.mode = str(spec.get("mode", "all")).lower()
+        if self.mode not in MODES:
+            raise PolicyError(f"{source}: mode must be one of {', '.join(sorted(MODES))}")
+        self.entity_field = str(spec.get("entity_field") or "entity")
+
+        self.defaults = {**DEFAULT_RULES, **_rules(spec.get("defaults") or {}, "defaults")}
+        self.scopes: Dict[str, Dict[str, Dict]] = {}
+        for scope in ("entities", "currencies", "vendors"):
+            entries = spec.get(scope) or {}
+            if not isinstance(entries, dict):
+                raise PolicyError(f"{source}: {scope} must map names to settings")
+            self.scopes[scope] = {
+                self._scope_key(scope, key): _rules(value, f"{scope}.{key}") for key, value in entries.items()
+            }
+
+        normalized = {"mode": self.mode, "entity_field": self.entity_field, "defaults": self.defaults, **self.scopes}
+        digest = hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+        self.version = f"{self.name}@{digest[:12]}"
+        self._resolved: Dict[Tuple, RuleSet] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _scope_key(scope: str, value) -> str:
+        text = str(value or "").strip()
+        return text.upper() if scope == "currencies" else text.lower()
+
+    def resolve(self, entity=None, currency=None, vendor=None) -> RuleSet:
+        key = (
+            self._scope_key("entities", entity) if entity else "",
+            self._scope_key("currencies", currency) if currency else "",
+            self._scope_key("vendors", vendor) if vendor else "",
+        )
+        rule_set = self._resolved.get(key)
+        if rule_set is None:
+            settings = dict(self.defaults)
+            for scope, scope_key in zip(("entities", "currencies", "vendors"), key):
+                settings.update(self.scopes[scope].get(scope_key, {}))
+            with self._lock:
+                rule_set = self._resolved.setdefault(key, RuleSet(settings))
+        return rule_set
+
+    def resolve_invoice(self, invoice: Dict) -> RuleSet:
+        return self.resolve(invoice.get(self.entity_field), invoice.get("currency"), invoice.get("vendor_name"))
+
+
+def load_policy(path: Optional[Path] = None) -> PolicyPack:
+    """Compiles COMPLIANCE_POLICY_FILE, or the built-in pack when there is none.
+    Raises PolicyError for an unusable file."""
+    path = Path(path) if path else policy_path()
+    if not path.exists():
+        return PolicyPack(DEFAULT_PACK)
+    try:
+        spec = json.loads(path.read_text(encoding="utf-8"))
+    except json.JSONDecodeError as e:
+        raise PolicyError(f"{path}: invalid JSON ({e})")
+    return PolicyPack(spec, source=str(path))
+
+
+def active_policy() -> PolicyPack:
+    """The current pack, compiled again only when the file changes. A broken
+    file is reported and the built-in pack is used until it is fixed."""
+    path = policy_path()
+    try:
+        stat = path.stat()
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        key = (str(path), None, None)
+    with _cache_lock:
+        if _cache["key"] == key:
+            return _cache["pack"]
+        try:
+            pack = load_policy(path)
+        except PolicyError as e:
+            print(f"Compliance Policy Error: {e}")
+            pack = PolicyPack(DEFAULT_PACK)
+        _cache.update({"key": key, "pack": pack})
+        return pack
@@ -0,0 +1,145 @@
+"""Local stand-in for the CRM webhook, for trying out crm_sync.py.
+
+    python crm_stub.py --port 8765 --fail-rate 0.2 --latency-ms 50
+    CRM_SYNC_ENABLED=true CRM_WEBHOOK_URL=http://127.0.0.1:8765/webhook python crm_sync.py flush
+
+Accepts the outbox's batch POSTs over keep-alive HTTP/1.1 (idle
+connections are dropped after --idle-timeout seconds, like a real server),
+answers a share of them with 503 (--fail-rate, with Retry-After when
+--retry-after is set), appends every accepted event to --log as JSON Lines,
+and reports its counters on GET /stats: requests, accepted and failed batches, events,
+distinct TCP connections and any per-invoice ordering violations (an event
+id lower than one already accepted for the same invoice; retries of a
+batch that was already accepted are counted as duplicates instead).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, fail_rate=0.0, latency_ms=0, retry_after=None, log_path=None, idle_timeout=30.0):
+        self.fail_rate = fail_rate
+        self.idle_timeout = idle_timeout
+        self.latency = latency_ms / 1000.0
+        self.retry_after = retry_after
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.last_event = {}  # invoice key -> highest accepted event id
+        self.seen = set()
+        self.counters = {"requests": 0, "accepted": 0, "failed": 0, "events": 0, "duplicates": 0,
+                         "connections": 0, "order_violations": 0}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def accept(self, events):
+        with self.lock:
+            self.counters["accepted"] += 1
+            lines = []
+            for event in events:
+                if event["event_id"] in self.seen:
+                    self.counters["duplicates"] += 1
+                    continue
+                self.seen.add(event["event_id"])
+                invoice = event.get("invoice") or {}
+                key = str(invoice.get("id") or invoice.get("document_hash"))
+                if event["event_id"] < self.last_event.get(key, 0):
+                    self.counters["order_violations"] += 1
+                self.last_event[key] = max(event["event_id"], self.last_event.get(key, 0))
+                self.counters["events"] += 1
+                lines.append(json.dumps(event, ensure_ascii=False))
+            if self.log_path and lines:
+                with open(self.log_path, "a", encoding="utf-8") as log:
+                    log.write("\n".join(lines) + "\n")
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+        timeout = state.idle_timeout
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.counters["connections"] += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                self._reply(200, state.snapshot())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with state.lock:
+                state.counters["requests"] += 1
+            if state.latency:
+                time.sleep(state.latency)
+            try:
+                events = json.loads(body)["events"]
+            except (ValueError, KeyError, TypeError):
+                self._reply(400, {"error": "expected {\"events\": [...]}"})
+                return
+            if random.random() < state.fail_rate:
+                with state.lock:
+                    state.counters["failed"] += 1
+                headers = {"Retry-After": str(state.retry_after)} if state.retry_after is not None else None
+                self._reply(503, {"error": "simulated outage"}, headers)
+                return
+            state.accept(events)
+            self._reply(200, {"accepted": len(events)})
+
+    return Handler
+
+
+def serve(port=8765, host="127.0.0.1", **options):
+    """Starts the stub on a background thread; returns (server, state)."""
+    state = StubState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="crm-stub", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the CRM webhook.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of batches answered with 503")
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--retry-after", type=int, default=None, help="Retry-After seconds sent with a 503")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="close keep-alive connections idle this long")
+    parser.add_argument("--log", default=None, help="append accepted events to this JSON Lines file")
+    args = parser.parse_args()
+
+    server, state = serve(args.port, args.host, fail_rate=args.fail_rate, latency_ms=args.latency_ms,
+                          retry_after=args.retry_after, log_path=args.log, idle_timeout=args.idle_timeout)
+    print(f"CRM stub listening on http://{args.host}:{server.server_port}/webhook")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(state.snapshot()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
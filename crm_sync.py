@@ -1,6 +1,73 @@
+"""Outbox for CRM webhook events.
+
+Saving an invoice never waits for the CRM. database.py records one event per
+saved invoice in a local SQLite outbox (CRM_OUTBOX_DB), and a delivery worker
+posts the events in batches to CRM_WEBHOOK_URL:
+
+    POST {"source": "AI_INVOICE_AUDITOR",
+          "events": [{"event_id": 17, "event": "UPSERT", "invoice": {...}, "enqueued_at": "..."}]}
+
+- Up to CRM_BATCH_SIZE events (default 50) per request, over one keep-alive
+  connection that is reused across batches
+- Events of the same invoice are delivered in order: a batch only takes the
+  oldest undelivered event of each invoice, so a later event waits until
+  the earlier one went through
+- A non-2xx answer or a network error reschedules the whole batch with
+  exponential backoff from CRM_RETRY_BASE_SECONDS up to
+  CRM_RETRY_MAX_SECONDS (Retry-After is honoured). After CRM_MAX_ATTEMPTS an
+  event becomes a dead letter and holds back that invoice's later events
+  until it is re-queued
+- event_id is unique per event, so the CRM can drop a batch it already
+  applied when a retry follows a lost response
+
+With CRM_OUTBOX_WORKER=true (default) every process that enqueues starts a
+background worker thread. It can also run on its own:
+
+    python crm_sync.py serve       # deliver until interrupted
+    python crm_sync.py flush       # deliver what is due, then exit
+    python crm_sync.py stats       # backlog, delivery lag and failure counters
+    python crm_sync.py requeue     # give dead letters a fresh set of attempts
+
+crm_stub.py is a local stand-in for the CRM endpoint.
+"""
+import argparse
 import json
 import os
-import urllib.request
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+SOURCE = "AI_INVOICE_AUDITOR"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crm_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_key TEXT NOT NULL,
+    event TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_crm_outbox_due ON crm_outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_crm_outbox_invoice ON crm_outbox (invoice_key, id);
+
+CREATE TABLE IF NOT EXISTS crm_outbox_metrics (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL DEFAULT 0
+);
+"""
+
+_local = threading.local()
+_worker_lock = threading.Lock()
+_worker = None
 
 
 def _env_bool(name, default=False):
@@ -10,30 +77,438 @@ def _env_bool(name, default=False):
     return value.strip().lower() in {"1", "true", "yes", "y", "on"}
 
 
+def is_enabled():
+    return _env_bool("CRM_SYNC_ENABLED", False) and bool((os.getenv("CRM_WEBHOOK_URL") or "").strip())
+
+
+def outbox_db_path() -> Path:
+    return Path(os.getenv("CRM_OUTBOX_DB", "local_data/crm_outbox.db"))
+
+
+def batch_size() -> int:
+    return max(1, int(os.getenv("CRM_BATCH_SIZE", "50")))
+
+
+def max_attempts() -> int:
+    return max(1, int(os.getenv("CRM_MAX_ATTEMPTS", "12")))
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before attempt attempts + 1: base, 2x base, 4x base, ... capped."""
+    base = float(os.getenv("CRM_RETRY_BASE_SECONDS", "5"))
+    cap = float(os.getenv("CRM_RETRY_MAX_SECONDS", "3600"))
+    return min(cap, base * (2 ** max(0, attempts - 1)))
+
+
+def _connection() -> sqlite3.Connection:
+    """One connection per thread and file, like the mail retry queue."""
+    path = outbox_db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _bump(conn, values: Dict[str, float], maximum: Iterable[str] = ()) -> None:
+    """Adds to the counters (or keeps the larger value for names in maximum)."""
+    maximum = set(maximum)
+    for name, value in values.items():
+        update = "max(value, excluded.value)" if name in maximum else "value + excluded.value"
+        conn.execute(
+            f"INSERT INTO crm_outbox_metrics (name, value) VALUES (?, ?) "
+            f"ON CONFLICT (name) DO UPDATE SET value = {update}",
+            (name, value),
+        )
+
+
+# --- OUTBOX ---
+def enqueue_invoices(records: List[Dict], event: str = "UPSERT") -> int:
+    """Records one event per saved invoice row in a single transaction and
+    wakes the worker. Returns the number queued (0 when disabled or on error)."""
+    if not is_enabled():
+        return 0
+    now = time.time()
+    rows = []
+    for record in records or []:
+        key = (record or {}).get("id") or (record or {}).get("document_hash")
+        if key is None:
+            continue
+        rows.append((str(key), event, json.dumps(record, ensure_ascii=False, default=str), now, now, now))
+    if not rows:
+        return 0
+    try:
+        conn = _connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO crm_outbox (invoice_key, event, payload, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            _bump(conn, {"enqueued": len(rows)})
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    except Exception as e:
+        print(f"CRM Outbox Error: {e}")
+        return 0
+    if _env_bool("CRM_OUTBOX_WORKER", True):
+        ensure_worker().wake()
+    return len(rows)
+
+
 def sync_invoice_to_crm(invoice_record, event="UPSERT"):
-    enabled = _env_bool("CRM_SYNC_ENABLED", False)
-    webhook_url = (os.getenv("CRM_WEBHOOK_URL") or "").strip()
+    """Queues one invoice for the CRM; delivery happens in the background."""
+    if not is_enabled():
+        return {"queued": False, "reason": "disabled_or_missing_webhook"}
+    queued = enqueue_invoices([invoice_record], event)
+    return {"queued": bool(queued)} if queued else {"queued": False, "reason": "outbox_error"}
 
-    if not enabled or not webhook_url:
-        return {"sent": False, "reason": "disabled_or_missing_webhook"}
 
-    payload = {
-        "event": event,
-        "source": "AI_INVOICE_AUDITOR",
-        "invoice": invoice_record,
-    }
+def lease_batch(limit: int, lease_seconds: Optional[float] = None) -> List[Dict]:
+    """Takes up to limit due events, at most the oldest pending one per
+    invoice. Leased events are hidden for lease_seconds, so another worker
+    neither sends them nor overtakes them with a later event."""
+    lease_seconds = lease_seconds or float(os.getenv("CRM_LEASE_SECONDS", "120"))
+    now = time.time()
+    leased = []
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            """
+            SELECT o.* FROM crm_outbox o
+            WHERE o.status = 'pending' AND o.next_attempt_at <= ?
+              AND NOT EXISTS (SELECT 1 FROM crm_outbox e WHERE e.invoice_key = o.invoice_key AND e.id < o.id)
+            ORDER BY o.id LIMIT ?
+            """,
+            (now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE crm_outbox SET next_attempt_at = ? WHERE id = ?", [(now + lease_seconds, row["id"]) for row in rows]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for row in rows:
+        entry = dict(row)
+        entry["payload"] = json.loads(entry["payload"])
+        leased.append(entry)
+    return leased
+
+
+def _complete(events: List[Dict]) -> None:
+    now = time.time()
+    lags = [now - event["created_at"] for event in events]
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("DELETE FROM crm_outbox WHERE id = ?", [(event["id"],) for event in events])
+        _bump(conn, {"delivered": len(events), "batches": 1, "lag_seconds_total": sum(lags)})
+        _bump(conn, {"lag_seconds_max": max(lags)}, maximum={"lag_seconds_max"})
+        conn.execute(
+            "INSERT INTO crm_outbox_metrics (name, value) VALUES ('last_delivered_at', ?), ('last_lag_seconds', ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (now, max(lags)),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
 
+def _reschedule(events: List[Dict], error: str, retry_after: Optional[float] = None) -> int:
+    """Puts a failed batch back with backoff; returns how many became dead letters."""
+    now = time.time()
+    dead = 0
+    updates = []
+    for event in events:
+        attempts = event["attempts"] + 1
+        status = "dead" if attempts >= max_attempts() else "pending"
+        dead += status == "dead"
+        delay = max(backoff_seconds(attempts), retry_after or 0.0)
+        updates.append((status, attempts, error[:500], now + delay, now, event["id"]))
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        body = json.dumps(payload).encode("utf-8")
-        request = urllib.request.Request(
-            webhook_url,
-            data=body,
-            headers={"Content-Type": "application/json"},
-            method="POST",
+        conn.executemany(
+            "UPDATE crm_outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?, updated_at = ? "
+            "WHERE id = ?",
+            updates,
         )
-        with urllib.request.urlopen(request, timeout=10) as response:
-            status = getattr(response, "status", 200)
+        _bump(conn, {"failed_batches": 1, "failed_attempts": len(events), "dead_lettered": dead})
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return dead
+
+
+def requeue_dead() -> int:
+    """Gives every dead letter a fresh set of attempts, due now."""
+    try:
+        now = time.time()
+        cursor = _connection().execute(
+            "UPDATE crm_outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+            "WHERE status = 'dead'",
+            (now, now),
+        )
+        return cursor.rowcount
+    except Exception as e:
+        print(f"CRM Outbox Error: {e}")
+        return 0
+
+
+def next_due_in() -> Optional[float]:
+    """Seconds until the next pending event is due (0 if overdue), None if there is none."""
+    row = _connection().execute("SELECT MIN(next_attempt_at) FROM crm_outbox WHERE status = 'pending'").fetchone()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+# --- METRICS ---
+def outbox_stats() -> Dict:
+    """Backlog and delivery metrics:
+    pending / due / dead events, oldest_pending_seconds (current delivery lag),
+    delivered, batches, avg_lag_seconds / max_lag_seconds / last_lag_seconds
+    (enqueue -> delivery), failed_batches, failed_attempts, dead_lettered,
+    last_delivered_at and last_error."""
+    stats = {
+        "pending": 0, "due": 0, "dead": 0, "oldest_pending_seconds": None,
+        "enqueued": 0, "delivered": 0, "batches": 0, "avg_lag_seconds": None, "max_lag_seconds": None,
+        "last_lag_seconds": None, "failed_batches": 0, "failed_attempts": 0, "dead_lettered": 0,
+        "last_delivered_at": None, "last_error": None,
+    }
+    if not outbox_db_path().exists():
+        return stats
+    try:
+        conn = _connection()
+        now = time.time()
+        for row in conn.execute("SELECT status, COUNT(*) AS n, MIN(created_at) AS oldest FROM crm_outbox GROUP BY status"):
+            stats[row["status"]] = row["n"]
+            if row["status"] == "pending":
+                stats["oldest_pending_seconds"] = round(now - row["oldest"], 3)
+        stats["due"] = conn.execute(
+            "SELECT COUNT(*) FROM crm_outbox WHERE status = 'pending' AND next_attempt_at <= ?", (now,)
+        ).fetchone()[0]
+        metrics = {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM crm_outbox_metrics")}
+        for name in ("enqueued", "delivered", "batches", "failed_batches", "failed_attempts", "dead_lettered"):
+            stats[name] = int(metrics.get(name, 0))
+        if stats["delivered"]:
+            stats["avg_lag_seconds"] = round(metrics.get("lag_seconds_total", 0.0) / stats["delivered"], 3)
+            stats["max_lag_seconds"] = round(metrics.get("lag_seconds_max", 0.0), 3)
+            stats["last_lag_seconds"] = round(metrics.get("last_lag_seconds", 0.0), 3)
+        if metrics.get("last_delivered_at"):
+            stats["last_delivered_at"] = _iso(metrics["last_delivered_at"])
+        row = conn.execute(
+            "SELECT last_error FROM crm_outbox WHERE last_error IS NOT NULL ORDER BY updated_at DESC LIMIT 1"
+        ).fetchone()
+        stats["last_error"] = row["last_error"] if row else None
+    except Exception as e:
+        print(f"CRM Outbox Error: {e}")
+    return stats
+
+
+# --- DELIVERY ---
+class WebhookClient:
+    """POSTs JSON bodies over one keep-alive HTTP(S) connection, reopened
+    only when the server closes it."""
+
+    def __init__(self, url: Optional[str] = None, timeout: Optional[float] = None):
+        self.url = (url or os.getenv("CRM_WEBHOOK_URL") or "").strip()
+        parts = urlsplit(self.url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid CRM_WEBHOOK_URL: {self.url!r}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.timeout = timeout or float(os.getenv("CRM_TIMEOUT_SECONDS", "10"))
+        self.headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        token = (os.getenv("CRM_WEBHOOK_TOKEN") or "").strip()
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+        self._conn = None
+        self.connections_opened = 0
+
+    def _connection(self):
+        if self._conn is None:
+            import http.client
+
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self._conn = cls(self.host, self.port, timeout=self.timeout)
+            self.connections_opened += 1
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def post(self, body: bytes):
+        """(status, Retry-After seconds or None). A connection the server
+        dropped while idle is retried once on a fresh one."""
+        import http.client
+
+        for attempt in range(2):
+            reused = self._conn is not None
+            conn = self._connection()
+            try:
+                conn.request("POST", self.path, body=body, headers=self.headers)
+                response = conn.getresponse()
+                response.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError,
+                    ConnectionResetError) as e:
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                raise e
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            retry_after = response.getheader("Retry-After")
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            return response.status, retry_after
+
+
+def deliver_batch(client: WebhookClient, limit: Optional[int] = None) -> Dict:
+    """Leases and posts one batch. {"sent", "failed", "dead", "error"}."""
+    result = {"sent": 0, "failed": 0, "dead": 0, "error": None}
+    events = lease_batch(limit or batch_size())
+    if not events:
+        return result
+    body = json.dumps({
+        "source": SOURCE,
+        "events": [
+            {"event_id": event["id"], "event": event["event"], "invoice": event["payload"],
+             "enqueued_at": _iso(event["created_at"])}
+            for event in events
+        ],
+    }, ensure_ascii=False).encode("utf-8")
+
+    retry_after = None
+    try:
+        status, retry_after = client.post(body)
+        error = None if 200 <= status < 300 else f"HTTP {status}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    if error is None:
+        _complete(events)
+        result["sent"] = len(events)
+    else:
+        result["dead"] = _reschedule(events, error, retry_after)
+        result["failed"] = len(events)
+        result["error"] = error
+    return result
+
+
+def flush(max_batches: Optional[int] = None, client: Optional[WebhookClient] = None) -> Dict:
+    """Delivers due events until none are left (or a batch fails)."""
+    totals = {"sent": 0, "failed": 0, "dead": 0, "batches": 0, "error": None}
+    own_client = client is None
+    client = client or WebhookClient()
+    try:
+        while max_batches is None or totals["batches"] < max_batches:
+            result = deliver_batch(client)
+            if not (result["sent"] or result["failed"]):
+                break
+            totals["batches"] += 1
+            for key in ("sent", "failed", "dead"):
+                totals[key] += result[key]
+            if result["error"]:
+                totals["error"] = result["error"]
+                break
+    finally:
+        if own_client:
+            client.close()
+    return totals
+
+
+class DeliveryWorker(threading.Thread):
+    """Background thread that drains the outbox; enqueue_invoices() wakes it,
+    otherwise it sleeps until the next event is due (at most CRM_POLL_SECONDS)."""
+
+    def __init__(self, url: Optional[str] = None):
+        super().__init__(name="crm-outbox", daemon=True)
+        self.url = url
+        self.poll_seconds = float(os.getenv("CRM_POLL_SECONDS", "5"))
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopping.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def run(self):
+        client = None
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                client = client or WebhookClient(self.url)
+                flush(client=client)
+                due_in = next_due_in()
+            except Exception as e:
+                print(f"CRM Delivery Error: {e}")
+                due_in = None
+            wait = self.poll_seconds if due_in is None else min(self.poll_seconds, max(due_in, 0.05))
+            self._wake.wait(wait)
+        if client:
+            client.close()
+
+
+def ensure_worker() -> DeliveryWorker:
+    """The process-wide delivery worker, started on first use."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = DeliveryWorker()
+            _worker.start()
+        return _worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deliver queued CRM webhook events.")
+    parser.add_argument("command", choices=("serve", "flush", "stats", "requeue"))
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(json.dumps(outbox_stats(), indent=2))
+    elif args.command == "requeue":
+        print(json.dumps({"requeued": requeue_dead()}))
+    elif args.command == "flush":
+        print(json.dumps(flush(), indent=2))
+    else:
+        worker = DeliveryWorker()
+        worker.start()
+        try:
+            while worker.is_alive():
+                worker.join(60)
+                print(json.dumps(outbox_stats()))
+        except KeyboardInterrupt:
+            worker.stop(timeout=30)
+
 
-        return {"sent": 200 <= status < 300, "status": status}
-    except Exception as ex:
-        return {"sent": False, "reason": str(ex)}
+if __name__ == "__main__":
+    main()
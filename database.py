@@ -1,136 +1,92 @@
 import os
 import hashlib
-from supabase import create_client, Client
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+import archive
+import crm_sync
+from repository_base import build_invoice_payload, empty_dashboard_metrics, hash_file_data
+
 # Load keys from .env file
 load_dotenv()
 
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-
-if not url or not key:
-    raise ValueError("Missing Supabase keys in .env file")
-
-supabase: Client = create_client(url, key)
-
-
-def _is_allowed_stage_transition(previous_stage, next_stage, user_role, is_new_record=False):
-    prev = str(previous_stage or "UPLOADED").upper()
-    nxt = str(next_stage or "UPLOADED").upper()
-    role = str(user_role or "").upper()
-
-    if is_new_record:
-        if role == "MAIL_BOT":
-            return nxt == "UPLOADED"
-        if role == "AP_CLERK":
-            return nxt in {"UPLOADED", "REVIEWED"}
-        return False
-
-    if prev == nxt:
-        if nxt == "UPLOADED":
-            return role == "AP_CLERK"
-        if nxt == "REVIEWED":
-            return role in {"AP_CLERK", "FINANCE_MANAGER"}
-        if nxt == "APPROVED":
-            return role == "FINANCE_MANAGER"
-        if nxt == "AUDITED":
-            return role == "AUDITOR"
-        return False
-
-    if prev == "UPLOADED" and nxt == "REVIEWED":
-        return role == "AP_CLERK"
-    if prev == "REVIEWED" and nxt in {"APPROVED", "REJECTED"}:
-        return role == "FINANCE_MANAGER"
-    if prev == "APPROVED" and nxt == "AUDITED":
-        return role == "AUDITOR"
-
-    return False
+# Storage backend: "supabase" (default) or "sqlite" (embedded, offline).
+# The repository is created on first use, so importing this module never
+# needs credentials or network access.
+_repository = None
+_repository_lock = threading.Lock()
+_read_executor = None
+
+
+def get_repository():
+    """Returns the storage backend selected by DB_BACKEND"""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                backend = (os.environ.get("DB_BACKEND") or "supabase").strip().lower()
+                if backend == "sqlite":
+                    from sqlite_repository import SQLiteRepository
+                    _repository = SQLiteRepository()
+                elif backend == "supabase":
+                    from supabase_repository import SupabaseRepository
+                    _repository = SupabaseRepository()
+                else:
+                    raise ValueError(f"Unknown DB_BACKEND: {backend}")
+    return _repository
+
+
+def set_repository(repository):
+    """Overrides the active backend (e.g. an SQLiteRepository for tests)"""
+    global _repository
+    with _repository_lock:
+        _repository = repository
 
 
 def compute_document_hash(file_bytes):
-    """Computes a deterministic hash for duplicate document detection."""
-    if not file_bytes:
+    """Computes a deterministic hash for duplicate document detection.
+    Accepts bytes or a binary file object (hashed in chunks)."""
+    if file_bytes is None:
         return None
-    return hashlib.sha256(file_bytes).hexdigest()
+    if isinstance(file_bytes, (bytes, bytearray, memoryview)):
+        if not file_bytes:
+            return None
+        return hashlib.sha256(file_bytes).hexdigest()
+    return hash_file_data(file_bytes)
 
 
 def is_duplicate_hash(document_hash, exclude_id=None):
-    """Checks if an invoice with the same document hash already exists."""
-    if not document_hash:
-        return False
-
-    try:
-        query = supabase.table("invoices").select("id").eq("document_hash", document_hash)
-        if exclude_id:
-            query = query.neq("id", exclude_id)
-        response = query.execute()
-        return len(response.data) > 0
-    except Exception as e:
-        print(f"Document Hash Duplicate Check Error: {e}")
-        return False
+    """Checks if an invoice with the same document hash already exists (live or archived)."""
+    return get_repository().is_duplicate_hash(document_hash, exclude_id=exclude_id) or archive.is_archived_hash(document_hash)
 
 def upload_file(file_bytes, file_name, content_type):
-    """Uploads file to Supabase Storage and returns the Public URL"""
-    bucket_name = "invoices"
-    try:
-        # Upload file (overwrite if exists)
-        response = supabase.storage.from_(bucket_name).upload(
-            path=file_name,
-            file=file_bytes,
-            file_options={"content-type": content_type, "upsert": "true"}
-        )
-        # Get Public URL
-        public_url = supabase.storage.from_(bucket_name).get_public_url(file_name)
-        return public_url
-    except Exception as e:
-        print(f"Upload Error: {e}")
-        return None
+    """Uploads file to the storage backend and returns the Public URL"""
+    return get_repository().upload_file(file_bytes, file_name, content_type)
+
+def upload_blob(file_data, content_type, file_name=None, document_hash=None):
+    """Uploads a document once per SHA-256 (blobs/<aa>/<hash>.<ext>) and returns its URL.
+    file_data may be bytes or a file object; document_hash doubles as the blob key.
+    """
+    return get_repository().upload_blob(file_data, content_type, file_name=file_name, document_hash=document_hash)
 
 # --- VENDOR MEMORY LOGIC ---
-def update_vendor_profile(vendor_name, total_amount, invoice_date):
-    """Updates the historical profile for a specific vendor"""
-    try:
-        # 1. Check if vendor exists
-        existing = supabase.table("vendors").select("*").eq("vendor_name", vendor_name).execute().data
-        
-        if existing:
-            record = existing[0]
-            old_count = record["invoice_count"]
-            old_avg = float(record["avg_invoice_value"])
-            
-            # Calculate new running average
-            new_count = old_count + 1
-            new_avg = ((old_avg * old_count) + float(total_amount)) / new_count
-            
-            # Update existing record
-            supabase.table("vendors").update({
-                "avg_invoice_value": new_avg,
-                "invoice_count": new_count,
-                "last_invoice_date": invoice_date
-            }).eq("vendor_name", vendor_name).execute()
-        else:
-            # Create new record
-            supabase.table("vendors").insert({
-                "vendor_name": vendor_name,
-                "avg_invoice_value": total_amount,
-                "invoice_count": 1,
-                "last_invoice_date": invoice_date
-            }).execute()
-            
-    except Exception as e:
-        print(f"Vendor Update Error: {e}")
+def update_vendor_profile(vendor_name, total_amount, invoice_date, line_items=None):
+    """Updates the historical profile (running average and anomaly stats) for a specific vendor"""
+    return get_repository().update_vendor_profile(vendor_name, total_amount, invoice_date, line_items=line_items)
 
 # --- HELPER: GET VENDOR AVERAGE ---
 def get_vendor_average(vendor_name):
     """Fetches the historical average invoice value for anomaly detection"""
-    try:
-        response = supabase.table("vendors").select("avg_invoice_value").eq("vendor_name", vendor_name).execute()
-        if response.data and len(response.data) > 0:
-            return float(response.data[0]['avg_invoice_value'])
-        return None
-    except Exception as e:
-        return None
+    return get_repository().get_vendor_average(vendor_name)
+
+def fetch_vendor_profiles(vendor_names):
+    """{vendor_name: {"avg_invoice_value", "anomaly_stats"}} for many vendors in one query (None on error)"""
+    return get_repository().fetch_vendor_profiles(vendor_names)
+
+def save_vendor_anomaly_stats(stats_by_vendor):
+    """Replaces the anomaly stats (see vendor_anomaly.py) of existing vendors; returns the number written"""
+    return get_repository().save_vendor_anomaly_stats(stats_by_vendor)
 
 # --- DUPLICATE DETECTION ---
 def is_duplicate(vendor_name, invoice_date, total_amount, exclude_id=None):
@@ -138,180 +94,158 @@ def is_duplicate(vendor_name, invoice_date, total_amount, exclude_id=None):
     Checks if an invoice with the same Vendor, Date, and Amount already exists.
     exclude_id: Optional ID to ignore (useful when editing an existing invoice).
     """
-    try:
-        query = supabase.table("invoices")\
-            .select("id")\
-            .eq("vendor_name", vendor_name)\
-            .eq("invoice_date", invoice_date)\
-            .eq("total_amount", total_amount)
-            
-        # If we are editing a record, don't count itself as a duplicate
-        if exclude_id:
-            query = query.neq("id", exclude_id)
-            
-        response = query.execute()
-        return len(response.data) > 0
-    except Exception as e:
-        print(f"Duplicate Check Error: {e}")
-        return False
+    return (
+        get_repository().is_duplicate(vendor_name, invoice_date, total_amount, exclude_id=exclude_id)
+        or archive.is_archived_duplicate(vendor_name, invoice_date, total_amount)
+    )
 
 # --- AUDIT LOGGING ---
 def log_edit(invoice_id, field_name, old_val, new_val):
     """Records a specific change made by the human reviewer"""
-    try:
-        supabase.table("invoice_edits").insert({
-            "invoice_id": invoice_id,
-            "field_name": field_name,
-            "old_value": str(old_val),
-            "new_value": str(new_val)
-        }).execute()
-    except Exception as e:
-        print(f"Audit Log Error: {e}")
+    return get_repository().log_edit(invoice_id, field_name, old_val, new_val)
+
+
+def log_edits(invoice_id, edits):
+    """Records all changes of one save in a single batched insert"""
+    return get_repository().log_edits(invoice_id, edits)
 
 # --- UPDATED SAVE FUNCTION ---
 def save_invoice_record(data, file_url, user_role="Unknown", invoice_id=None):
     """Saves invoice and returns the entire record (including ID)
     If invoice_id is provided, UPDATE the existing record instead of INSERT.
     """
-    try:
-        requested_stage = data.get("approval_stage", "UPLOADED")
-
-        if invoice_id:
-            existing_resp = supabase.table("invoices").select("approval_stage").eq("id", invoice_id).limit(1).execute()
-            existing_rows = existing_resp.data or []
-            if not existing_rows:
-                print(f"DB Error: Invoice {invoice_id} not found for update")
-                return None
-
-            current_stage = existing_rows[0].get("approval_stage")
-            if not _is_allowed_stage_transition(current_stage, requested_stage, user_role, is_new_record=False):
-                print(
-                    f"Pipeline Guard: Transition blocked for role={user_role}, "
-                    f"{current_stage} -> {requested_stage}"
-                )
-                return None
-        else:
-            if not _is_allowed_stage_transition(None, requested_stage, user_role, is_new_record=True):
-                print(
-                    f"Pipeline Guard: Insert blocked for role={user_role}, "
-                    f"stage={requested_stage}"
-                )
-                return None
-
-        payload = {
-            "vendor_name": data.get("vendor_name"),
-            "invoice_date": data.get("invoice_date"),
-            "total_amount": data.get("total_amount"),
-            "currency": data.get("currency"),
-            "status": data.get("validation_status"),
-            "processing_status": data.get("processing_status", "COMPLETED"),
-            "confidence_score": data.get("confidence_score", 0.0),
-            "flag_reason": data.get("flag_reason"),
-            "file_url": file_url,
-            "ai_raw_data": data.get("ai_raw_data"),
-            "ai_structured_output": data.get("ai_structured_output"),
-            "document_hash": data.get("document_hash"),
-            
-            # --- FIX: Preserve Creator & Track Reviewer Correctly ---
-            "created_by": data.get("created_by", user_role),
-            "last_reviewed_by": data.get("reviewed_by", user_role),
-            # ------------------------------------------------------
-            
-            "ai_explanations": data.get("ai_explanations"),
-            
-            # Risk
-            "risk_score": data.get("risk_score", 0),
-            "risk_level": data.get("risk_level", "LOW"),
-            
-            # Workflow
-            "approval_stage": data.get("approval_stage", "UPLOADED"),
-            "reviewed_by": data.get("reviewed_by"),
-            "approved_by": data.get("approved_by"),
-            "approval_timestamp": data.get("approval_timestamp"),
-            "audited": data.get("approval_stage") == "AUDITED",  # ✅ FIX: Track audit status
-            
-            # Versioning
-            "ai_version": data.get("ai_version"),
-            "reprocessed_at": data.get("reprocessed_at")
-        }
-        
-        # ✅ FIX: UPDATE if invoice_id exists, otherwise INSERT
-        if invoice_id:
-            response = supabase.table("invoices").update(payload).eq("id", invoice_id).execute()
-        else:
-            response = supabase.table("invoices").insert(payload).execute()
-        
-        # Update Vendor Memory only if fully Approved
-        if data.get("approval_stage") == "APPROVED":
-             update_vendor_profile(
-                data.get("vendor_name"), 
-                data.get("total_amount"), 
-                data.get("invoice_date")
-            )
-        
-        # ✅ FIX: Log audit if marked as AUDITED
-        if data.get("approval_stage") == "AUDITED" and response.data:
-            try:
-                saved_id = response.data[0].get("id")
-                supabase.table("invoice_audits").insert({
-                    "invoice_id": saved_id,
-                    "audited_by": data.get("reviewed_by", "AUDITOR"),
-                    "audit_note": data.get("flag_reason", "Audited and Verified")
-                }).execute()
-                print(f"✅ Audit logged for invoice {saved_id}")
-            except Exception as e:
-                print(f"Audit Log Error: {e}")
-            
-        return response.data[0] if response.data else None
-    except Exception as e:
-        print(f"DB Error: {e}")
-        return None
+    saved = get_repository().save_invoice_record(data, file_url, user_role, invoice_id=invoice_id)
+    if saved:
+        crm_sync.enqueue_invoices([saved])
+    return saved
+
+# --- TRANSACTIONAL SAVE ---
+# Saved invoices are queued for the CRM webhook (crm_sync.py) when
+# CRM_SYNC_ENABLED is set; delivery never blocks the save.
+def save_invoice_transaction(data, file_url, user_role="Unknown", invoice_id=None, edits=None):
+    """Saves invoice, vendor stats, audit row and edit rows in one atomic call.
+    edits: list of {"field_name", "old_value", "new_value"} dicts.
+    """
+    saved = get_repository().save_invoice_transaction(
+        data, file_url, user_role, invoice_id=invoice_id, edits=edits
+    )
+    if saved:
+        crm_sync.enqueue_invoices([saved])
+    return saved
+
+# --- BULK SAVE ---
+def save_invoice_records_batch(records, user_role="Unknown", chunk_size=None):
+    """Saves many invoices with one read and at most two writes per chunk.
+
+    records: list of {"data": dict, "file_url": str, "invoice_id": optional}.
+    Every row goes through the same stage guard as save_invoice_record.
+    Returns one {"index", "ok", "id", "action", "error"} dict per input row,
+    in input order.
+    """
+    results = get_repository().save_invoice_records_batch(records, user_role, chunk_size=chunk_size)
+    if crm_sync.is_enabled():
+        crm_sync.enqueue_invoices([
+            {**build_invoice_payload(records[result["index"]].get("data") or {},
+                                     records[result["index"]].get("file_url"), user_role), "id": result["id"]}
+            for result in results if result["ok"]
+        ])
+    return results
 
 # --- FETCH INVOICE EDITS ---
 def fetch_invoice_edits(invoice_id):
     """Fetches all edit records for a specific invoice"""
-    try:
-        response = supabase.table("invoice_edits").select("*").eq("invoice_id", invoice_id).execute()
-        return response.data if response.data else []
-    except Exception as e:
-        print(f"Fetch Invoice Edits Error: {e}")
-        return []
+    return get_repository().fetch_invoice_edits(invoice_id)
 
 
 def fetch_all_invoice_edits():
     """Fetches all invoice edit records for transparency exports."""
-    try:
-        response = supabase.table("invoice_edits").select("*").order("edited_at", desc=True).execute()
-        return response.data if response.data else []
-    except Exception as e:
-        print(f"Fetch All Invoice Edits Error: {e}")
-        return []
+    return get_repository().fetch_all_invoice_edits()
 
 
 def fetch_all_invoice_audits():
     """Fetches all invoice audit records for transparency exports."""
-    try:
-        response = supabase.table("invoice_audits").select("*").order("audited_at", desc=True).execute()
-        return response.data if response.data else []
-    except Exception as e:
-        print(f"Fetch All Invoice Audits Error: {e}")
-        return []
+    return get_repository().fetch_all_invoice_audits()
 
 
 def fetch_all_vendors():
     """Fetches all vendor profile records used by anomaly logic."""
-    try:
-        response = supabase.table("vendors").select("*").order("vendor_name").execute()
-        return response.data if response.data else []
-    except Exception as e:
-        print(f"Fetch All Vendors Error: {e}")
-        return []
-
-def fetch_all_invoices():
-    """Fetches all invoices for the dashboard"""
-    try:
-        response = supabase.table("invoices").select("*").order("created_at", desc=True).execute()
-        return response.data
-    except Exception as e:
-        print(f"Fetch Error: {e}")
-        return []
\ No newline at end of file
+    return get_repository().fetch_all_vendors()
+
+def fetch_all_invoices(include_archived=False):
+    """Fetches all invoices for the dashboard
+    include_archived: also return cold-tier rows (newest first overall), for exports.
+    """
+    invoices = get_repository().fetch_all_invoices()
+    if not include_archived:
+        return invoices
+    archived = archive.fetch_archived_invoices()
+    return invoices + sorted(archived, key=lambda row: str(row.get("created_at") or ""), reverse=True)
+
+# --- RE-EVALUATION ---
+def fetch_invoices_for_evaluation(after_id=None, limit=500):
+    """Next invoices by id after after_id, with the inputs of risk and compliance"""
+    return get_repository().fetch_invoices_for_evaluation(after_id=after_id, limit=limit)
+
+
+def fetch_invoices_by_business_keys(keys):
+    """Live invoices (id, vendor_name, invoice_date, total_amount) matching any
+    (vendor_name, invoice_date, total_amount) key, in one query per chunk"""
+    return get_repository().fetch_invoices_by_business_keys(keys)
+
+
+def apply_invoice_evaluations(evaluations):
+    """Writes a batch of re-evaluation results; returns the number of rows updated"""
+    return get_repository().apply_invoice_evaluations(evaluations)
+
+# --- DASHBOARD METRICS ---
+def fetch_dashboard_metrics():
+    """Returns pre-aggregated dashboard numbers (see repository_base.compute_dashboard_metrics):
+    stage/source/risk counts, high-risk pending, confidence, approval hours,
+    SLA breaches, top vendors and the daily confidence trend.
+    """
+    return get_repository().fetch_dashboard_metrics()
+
+
+# --- CONCURRENT READS ---
+def _get_read_executor():
+    global _read_executor
+    if _read_executor is None:
+        with _repository_lock:
+            if _read_executor is None:
+                _read_executor = ThreadPoolExecutor(
+                    max_workers=max(1, int(os.environ.get("DB_READ_WORKERS", "4"))),
+                    thread_name_prefix="db-read",
+                )
+    return _read_executor
+
+
+def submit_read(func, *args, **kwargs):
+    """Runs a read function of this module on the shared pool and returns a Future.
+    All workers share the backend's pooled keep-alive HTTP client (or per-thread
+    SQLite connections), so independent queries overlap instead of queueing.
+    """
+    get_repository()  # create the backend once, before fanning out
+    return _get_read_executor().submit(func, *args, **kwargs)
+
+
+def load_dashboard_context():
+    """Fetches the invoices and metrics the dashboard renders, in parallel"""
+    invoices = submit_read(fetch_all_invoices)
+    metrics = submit_read(fetch_dashboard_metrics)
+    return {
+        "invoices": invoices.result() or [],
+        "metrics": metrics.result() or empty_dashboard_metrics(),
+    }
+
+
+def load_transparency_export():
+    """Fetches everything the full transparency workbook needs, in parallel.
+    Only called when the export is downloaded, never on a page render.
+    """
+    futures = {
+        "invoices": submit_read(fetch_all_invoices, include_archived=True),
+        "invoice_edits": submit_read(fetch_all_invoice_edits),
+        "invoice_audits": submit_read(fetch_all_invoice_audits),
+        "vendors": submit_read(fetch_all_vendors),
+    }
+    return {name: future.result() or [] for name, future in futures.items()}
@@ -0,0 +1,276 @@
+"""Parsing helpers for ranged IMAP fetches.
+
+imaplib hands FETCH responses back as a list mixing plain bytes lines and
+(prefix, literal) tuples, e.g. [(b'1 (UID 5 BODY[2] {3}', b'abc'), b')']. parse_fetch_response rebuilds the wire format and
+parses it into {message number: {item name: value}}; flatten_bodystructure
+turns a BODYSTRUCTURE value into leaf parts with their IMAP part numbers, so
+individual attachments can be fetched with BODY.PEEK[<part>].
+"""
+import base64
+import binascii
+import quopri
+import re
+from typing import Dict, List, Optional
+from urllib.parse import unquote_to_bytes
+
+
+class IMAPParseError(ValueError):
+    pass
+
+
+def _wire_bytes(fetch_data) -> bytes:
+    """Reassembles imaplib's fetch() data into one buffer with inline literals."""
+    chunks = []
+    for item in fetch_data or []:
+        if isinstance(item, tuple):
+            prefix, literal = item[0], item[1]
+            chunks.append(prefix + b"\r\n" + (literal or b""))
+        elif item is not None:
+            chunks.append(item + b"\r\n")
+    return b"".join(chunks)
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def skip_space(self):
+        while self.pos < len(self.data) and self.data[self.pos] in b" \r\n":
+            self.pos += 1
+
+    def at_end(self):
+        self.skip_space()
+        return self.pos >= len(self.data)
+
+    def peek(self) -> bytes:
+        return self.data[self.pos:self.pos + 1]
+
+    def value(self):
+        """Reads one value: list, quoted string, literal, NIL or atom."""
+        self.skip_space()
+        char = self.peek()
+        if char == b"(":
+            self.pos += 1
+            items = []
+            while True:
+                self.skip_space()
+                if self.peek() == b")":
+                    self.pos += 1
+                    return items
+                if not self.peek():
+                    raise IMAPParseError("Unterminated list")
+                items.append(self.value())
+        if char == b'"':
+            return self._quoted()
+        if char == b"{":
+            return self._literal()
+        return self._atom()
+
+    def _quoted(self) -> str:
+        self.pos += 1
+        out = bytearray()
+        while self.pos < len(self.data):
+            char = self.data[self.pos]
+            if char == 0x5C:  # backslash escape
+                out.append(self.data[self.pos + 1])
+                self.pos += 2
+                continue
+            if char == 0x22:
+                self.pos += 1
+                return out.decode("utf-8", errors="replace")
+            out.append(char)
+            self.pos += 1
+        raise IMAPParseError("Unterminated quoted string")
+
+    def _literal(self) -> bytes:
+        end = self.data.index(b"}", self.pos)
+        size = int(self.data[self.pos + 1:end])
+        start = end + 1
+        if self.data[start:start + 2] == b"\r\n":
+            start += 2
+        self.pos = start + size
+        return self.data[start:self.pos]
+
+    def _atom(self):
+        start = self.pos
+        while self.pos < len(self.data):
+            char = self.data[self.pos:self.pos + 1]
+            if char == b"[":
+                # Section specs such as BODY[HEADER.FIELDS (FROM)] contain spaces
+                self.pos = self.data.index(b"]", self.pos) + 1
+                continue
+            if char in (b" ", b"(", b")", b"\r", b"\n"):
+                break
+            self.pos += 1
+        atom = self.data[start:self.pos].decode("ascii", errors="replace")
+        if not atom:
+            raise IMAPParseError(f"Unexpected byte at {self.pos}")
+        return None if atom.upper() == "NIL" else atom
+
+
+def parse_fetch_response(fetch_data) -> Dict[str, Dict]:
+    """{message number: {"UID": "12", "BODYSTRUCTURE": [...], "BODY[2]": b"..."}}.
+    Item names are upper-cased; a trailing <origin> on BODY items is dropped."""
+    reader = _Reader(_wire_bytes(fetch_data))
+    messages = {}
+    while not reader.at_end():
+        number = reader.value()
+        items = reader.value()
+        # imaplib strips the FETCH keyword ("1 (UID 5 ...)"); raw lines keep it
+        if isinstance(items, str) and items.upper() == "FETCH":
+            items = reader.value()
+        if not isinstance(items, list) or len(items) % 2:
+            raise IMAPParseError("Malformed FETCH item list")
+        parsed = messages.setdefault(str(number), {})
+        for name, value in zip(items[0::2], items[1::2]):
+            key = re.sub(r"<\d+>$", "", str(name)).upper()
+            parsed[key] = value
+    return messages
+
+
+# --- BODYSTRUCTURE ---
+def _params(value) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    params = {}
+    for key, val in zip(value[0::2], value[1::2]):
+        if key is not None:
+            params[str(key).lower()] = val.decode(errors="replace") if isinstance(val, bytes) else (val or "")
+    return params
+
+
+def _param_value(params: Dict[str, str], name: str) -> str:
+    """Plain, RFC 2231 encoded (name*) and continued (name*0*, name*1) parameters."""
+    if name in params:
+        return params[name]
+    pieces = sorted(
+        (key for key in params if key == f"{name}*" or re.fullmatch(rf"{re.escape(name)}\*\d+\*?", key)),
+        key=lambda key: int(re.sub(r"\D", "", key) or 0),
+    )
+    if not pieces:
+        return ""
+    encoded = any(key.endswith("*") for key in pieces)
+    joined = "".join(params[key] for key in pieces)
+    if not encoded:
+        return joined
+    charset, _, text = joined.split("'", 2) if joined.count("'") >= 2 else ("", "", joined)
+    try:
+        return unquote_to_bytes(text).decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return unquote_to_bytes(text).decode("utf-8", errors="replace")
+
+
+def _text(value) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode(errors="replace") if isinstance(value, bytes) else str(value)
+
+
+def flatten_bodystructure(structure, prefix: str = "") -> List[Dict]:
+    """Parts in document order, like Message.walk() minus multipart containers.
+
+    Each part: {"part", "mime_type", "params", "encoding", "size",
+    "disposition", "disposition_params"}. Attached message/rfc822 mails are
+    listed, followed by their own parts numbered as in RFC 3501 (e.g. "2.1").
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    if isinstance(structure[0], list):  # multipart: children, then subtype
+        parts = []
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            parts.extend(flatten_bodystructure(child, f"{prefix}.{index}" if prefix else str(index)))
+        return parts
+
+    part_number = prefix or "1"
+    main_type = (_text(structure[0]) or "").lower()
+    sub_type = (_text(structure[1]) or "").lower() if len(structure) > 1 else ""
+    mime_type = f"{main_type}/{sub_type}"
+
+    # Extension data starts after the basic fields (plus envelope, body and
+    # lines for message/rfc822, or lines for text/*)
+    if mime_type == "message/rfc822":
+        extension_start = 10
+    elif main_type == "text":
+        extension_start = 8
+    else:
+        extension_start = 7
+    disposition = structure[extension_start + 1] if len(structure) > extension_start + 1 else None
+    size = _text(structure[6]) if len(structure) > 6 else None
+
+    parts = [{
+        "part": part_number,
+        "mime_type": mime_type,
+        "params": _params(structure[2] if len(structure) > 2 else None),
+        "encoding": (_text(structure[5]) or "7bit").lower() if len(structure) > 5 else "7bit",
+        "size": int(size) if size and size.isdigit() else 0,
+        "disposition": (_text(disposition[0]) or "").lower() if isinstance(disposition, list) and disposition else "",
+        "disposition_params": _params(disposition[1]) if isinstance(disposition, list) and len(disposition) > 1 else {},
+    }]
+
+    if mime_type == "message/rfc822" and len(structure) > 8:
+        # Encapsulated mail: walk() yields the container, then its parts,
+        # which IMAP numbers below this one
+        nested = structure[8]
+        if isinstance(nested, list) and nested and isinstance(nested[0], list):
+            parts.extend(flatten_bodystructure(nested, part_number))
+        else:
+            parts.extend(flatten_bodystructure(nested, f"{part_number}.1"))
+    return parts
+
+
+def part_filename(part: Dict) -> str:
+    """Same precedence as Message.get_filename(): disposition filename, then type name."""
+    return _param_value(part["disposition_params"], "filename") or _param_value(part["params"], "name")
+
+
+def min_decoded_size(part: Dict) -> int:
+    """Lower bound of the decoded size, for skipping oversized parts unseen."""
+    size = part.get("size") or 0
+    if part.get("encoding") == "base64":
+        # 4 chars per 3 bytes, at most one CRLF per 78 encoded chars
+        return max(0, (size * 76 // 78) * 3 // 4 - 3)
+    if part.get("encoding") == "quoted-printable":
+        return size // 3
+    return size
+
+
+def decode_transfer_encoding(data: bytes, encoding: str) -> bytes:
+    """Undoes Content-Transfer-Encoding, like get_payload(decode=True)."""
+    encoding = (encoding or "").lower()
+    if encoding == "base64":
+        try:
+            return base64.b64decode(data)
+        except binascii.Error:
+            # Lenient like the email package: ignore junk and fix padding
+            cleaned = re.sub(rb"[^A-Za-z0-9+/]", b"", data)
+            return base64.b64decode(cleaned + b"=" * (-len(cleaned) % 4))
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+_BASE64_JUNK = re.compile(rb"[^A-Za-z0-9+/]")
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+
+def decode_transfer_encoding_into(data: bytes, encoding: str, out) -> None:
+    """decode_transfer_encoding() written to out.write() piece by piece, so
+    base64 parts never exist decoded in memory as a whole."""
+    if (encoding or "").lower() != "base64":
+        out.write(decode_transfer_encoding(data, encoding))
+        return
+    pending = b""
+    for start in range(0, len(data), DECODE_CHUNK_SIZE):
+        cleaned = pending + _BASE64_JUNK.sub(b"", data[start:start + DECODE_CHUNK_SIZE])
+        usable = len(cleaned) - len(cleaned) % 4
+        if usable:
+            out.write(binascii.a2b_base64(cleaned[:usable]))
+        pending = cleaned[usable:]
+    if pending:
+        out.write(base64.b64decode(pending + b"=" * (-len(pending) % 4)))
@@ -0,0 +1,142 @@
+import json
+import math
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional
+
+
+LINE_ITEM_COLUMNS = ["description", "quantity", "unit_price", "total_price"]
+
+
+def _normalize(value):
+    """Makes data_editor cells (NaN, numpy numbers, padded strings) comparable."""
+    if value is None:
+        return None
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        try:
+            value = value.item()
+        except Exception:
+            pass
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _display(value):
+    value = _normalize(value)
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _row_key(row: Dict) -> str:
+    return str(_normalize(row.get("description")) or "").lower()
+
+
+def _row_text(row: Dict, columns: List[str]) -> str:
+    return json.dumps({col: _display(row.get(col)) for col in columns}, ensure_ascii=False)
+
+
+def _columns_for(original_items: List[Dict], edited_items: List[Dict]) -> List[str]:
+    columns = list(LINE_ITEM_COLUMNS)
+    for row in list(original_items) + list(edited_items):
+        for col in row.keys():
+            if col not in columns:
+                columns.append(col)
+    return columns
+
+
+def diff_line_items(original_items: Optional[List[Dict]], edited_items: Optional[List[Dict]]) -> List[Dict]:
+    """Matches rows between the AI table and the edited table and returns
+    cell-level changes: {"row", "column", "old", "new", "change"}.
+
+    Rows are aligned on their description (so inserting or deleting a row does
+    not shift every row below it); unmatched stretches are paired by position.
+    "row" is 1-based and refers to the edited table, or to the original table
+    for removed rows.
+    """
+    original_items = [dict(r or {}) for r in (original_items or [])]
+    edited_items = [dict(r or {}) for r in (edited_items or [])]
+    columns = _columns_for(original_items, edited_items)
+    changes: List[Dict] = []
+
+    def compare(orig_idx: int, new_idx: int):
+        orig, new = original_items[orig_idx], edited_items[new_idx]
+        for col in columns:
+            if _normalize(orig.get(col)) != _normalize(new.get(col)):
+                changes.append({
+                    "row": new_idx + 1,
+                    "column": col,
+                    "old": _display(orig.get(col)),
+                    "new": _display(new.get(col)),
+                    "change": "modified",
+                })
+
+    def added(new_idx: int):
+        changes.append({
+            "row": new_idx + 1,
+            "column": None,
+            "old": "",
+            "new": _row_text(edited_items[new_idx], columns),
+            "change": "added",
+        })
+
+    def removed(orig_idx: int):
+        changes.append({
+            "row": orig_idx + 1,
+            "column": None,
+            "old": _row_text(original_items[orig_idx], columns),
+            "new": "",
+            "change": "removed",
+        })
+
+    matcher = SequenceMatcher(
+        a=[_row_key(r) for r in original_items],
+        b=[_row_key(r) for r in edited_items],
+        autojunk=False,
+    )
+    for tag, a0, a1, b0, b1 in matcher.get_opcodes():
+        if tag == "equal":
+            for offset in range(a1 - a0):
+                compare(a0 + offset, b0 + offset)
+            continue
+
+        # replace/insert/delete: pair rows by position, rest are adds/removes
+        paired = min(a1 - a0, b1 - b0)
+        for offset in range(paired):
+            compare(a0 + offset, b0 + offset)
+        for orig_idx in range(a0 + paired, a1):
+            removed(orig_idx)
+        for new_idx in range(b0 + paired, b1):
+            added(new_idx)
+
+    return changes
+
+
+def line_item_changes_to_edits(changes: List[Dict]) -> List[Dict]:
+    """Converts diff_line_items output into invoice_edits rows."""
+    edits = []
+    for change in changes:
+        if change["change"] == "modified":
+            field_name = f"Line {change['row']}: {change['column']}"
+        elif change["change"] == "added":
+            field_name = f"Line {change['row']}: added"
+        else:
+            field_name = f"Line {change['row']}: removed"
+        edits.append({
+            "field_name": field_name,
+            "old_value": change["old"],
+            "new_value": change["new"],
+        })
+    return edits
@@ -1,14 +1,39 @@
 import os
 import imaplib
 import email
+import argparse
+import json
+import queue
+import select
+import signal
+import ssl
+import threading
+import time
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
-from datetime import datetime
-from typing import Dict, List, Tuple
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
+import mail_journal
+import mail_retry
+import mail_rules
+import mail_state
 import processor
+import shared_limits
+from attachment_spool import SpooledAttachment, inflight_budget
 from compliance import evaluate_invoice_compliance
-from database import upload_file, save_invoice_record, is_duplicate, compute_document_hash, is_duplicate_hash
+from compliance_policy import active_policy
+from risk_engine import score_invoice
+from imap_structure import (
+    IMAPParseError,
+    decode_transfer_encoding_into,
+    flatten_bodystructure,
+    min_decoded_size,
+    parse_fetch_response,
+    part_filename,
+)
+from database import upload_blob, save_invoice_records_batch, is_duplicate, is_duplicate_hash
 
 
 SUPPORTED_MIME_TYPES = {
@@ -48,40 +73,28 @@ def _safe_filename(name: str) -> str:
     return clean[:150] or "invoice.bin"
 
 
-def _allowed_sender(sender_email: str) -> bool:
-    raw = os.getenv("MAIL_ALLOWED_SENDERS", "").strip()
-    if not raw:
-        return True
-
-    allowed = {s.strip().lower() for s in raw.split(",") if s.strip()}
-    return sender_email.lower() in allowed
-
-
-def _subject_matches_filters(subject: str) -> bool:
-    raw = os.getenv("MAIL_SUBJECT_KEYWORDS", "").strip()
-    if not raw:
-        return True
-
-    subject_lower = (subject or "").lower()
-    keywords = [k.strip().lower() for k in raw.split(",") if k.strip()]
-    if not keywords:
-        return True
-
-    return any(keyword in subject_lower for keyword in keywords)
-
-
-def _is_supported_file(filename: str, mime_type: str, strict_mode: bool) -> bool:
+def _is_supported_file(filename: str, mime_type: str, strict_mode: bool, policy: Optional[Dict] = None) -> bool:
+    """policy: attachment overrides of the mail rule that accepted the message."""
     lower_name = (filename or "").lower()
+    mime_types, extensions = SUPPORTED_MIME_TYPES, SUPPORTED_EXTENSIONS
+    if policy and policy.get("mime_types") is not None:
+        mime_types, extensions = policy["mime_types"], policy["extensions"]
 
     if strict_mode:
-        if mime_type in SUPPORTED_MIME_TYPES:
+        if mime_type in mime_types:
             return True
-        return any(lower_name.endswith(ext) for ext in SUPPORTED_EXTENSIONS)
+        return any(lower_name.endswith(ext) for ext in extensions)
 
-    if mime_type in SUPPORTED_MIME_TYPES:
+    if mime_type in mime_types:
         return True
 
-    return any(lower_name.endswith(ext) for ext in SUPPORTED_EXTENSIONS)
+    return any(lower_name.endswith(ext) for ext in extensions)
+
+
+def _max_size_for(policy: Optional[Dict], max_attachment_size_bytes: int) -> int:
+    if policy and policy.get("max_size_bytes") is not None:
+        return policy["max_size_bytes"]
+    return max_attachment_size_bytes
 
 
 def is_mail_ingestion_configured() -> Tuple[bool, str]:
@@ -92,7 +105,27 @@ def is_mail_ingestion_configured() -> Tuple[bool, str]:
     return True, "Configured"
 
 
-def _extract_supported_attachments(msg, strict_mode: bool, max_attachment_size_bytes: int) -> Tuple[List[Dict], Dict]:
+def _spool_part(part) -> SpooledAttachment:
+    """A part's decoded body in a spool. Base64 (ASCII by definition) is
+    decoded piece by piece, as on the ranged path, so a large attachment never
+    exists decoded in memory as a whole; other encodings are not larger than
+    the message text already held and go through the email package."""
+    spool = SpooledAttachment()
+    try:
+        if str(part.get("Content-Transfer-Encoding", "")).strip().lower() == "base64":
+            payload = part.get_payload(decode=False) or ""
+            decode_transfer_encoding_into(payload.encode("ascii", "ignore"), "base64", spool)
+        else:
+            spool.write(part.get_payload(decode=True) or b"")
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
+def _extract_supported_attachments(msg, strict_mode: bool, max_attachment_size_bytes: int,
+                                   policy: Optional[Dict] = None) -> Tuple[List[Dict], Dict]:
+    max_attachment_size_bytes = _max_size_for(policy, max_attachment_size_bytes)
     attachments = []
     skipped = {
         "skipped_by_type": 0,
@@ -110,15 +143,20 @@ def _extract_supported_attachments(msg, strict_mode: bool, max_attachment_size_b
             continue
 
         mime_type = part.get_content_type()
-        if not _is_supported_file(filename, mime_type, strict_mode):
+        if not _is_supported_file(filename, mime_type, strict_mode, policy):
             skipped["skipped_by_type"] += 1
             continue
 
-        file_bytes = part.get_payload(decode=True)
-        if not file_bytes:
+        if part.is_multipart():
             continue
 
-        if max_attachment_size_bytes > 0 and len(file_bytes) > max_attachment_size_bytes:
+        spool = _spool_part(part)
+        if not spool.size:
+            spool.close()
+            continue
+
+        if max_attachment_size_bytes > 0 and spool.size > max_attachment_size_bytes:
+            spool.close()
             skipped["skipped_by_size"] += 1
             continue
 
@@ -126,14 +164,801 @@ def _extract_supported_attachments(msg, strict_mode: bool, max_attachment_size_b
             {
                 "filename": _safe_filename(filename),
                 "mime_type": mime_type,
-                "file_bytes": file_bytes,
+                "file": spool,
             }
         )
 
     return attachments, skipped
 
 
-def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini-flash-lite-latest") -> Dict:
+# --- RANGED FETCH (BODYSTRUCTURE first, then only the wanted parts) ---
+OVERVIEW_HEADER_FIELDS = "FROM SUBJECT MESSAGE-ID"
+MESSAGE_ID_PEEK = "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]"
+FETCH_RETRY_ERRORS = (IMAPParseError, ValueError, IndexError, RuntimeError)
+
+
+def _chunked(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _uid_set(uids: List[str]) -> str:
+    """Compact IMAP message set, e.g. ["1", "2", "3", "7"] -> "1:3,7"."""
+    ranges = []
+    for number in sorted({int(uid) for uid in uids}):
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(low) if low == high else f"{low}:{high}" for low, high in ranges)
+
+
+def _uid_fetch(imap, uids: List[str], items: str) -> Dict[str, Dict]:
+    """One UID FETCH round trip for many messages: {uid: {item: value}}."""
+    status, data = imap.uid("FETCH", _uid_set(uids), items)
+    if status != "OK":
+        raise RuntimeError(f"UID FETCH {_uid_set(uids)} failed")
+
+    fetched = {}
+    for items_by_name in parse_fetch_response(data).values():
+        # Unsolicited FLAGS updates for other messages carry no UID
+        if items_by_name.get("UID"):
+            fetched[str(items_by_name["UID"])] = items_by_name
+    return fetched
+
+
+def _fetch_batch_or_each(fetch, imap, uids: List[str]) -> Tuple[Dict, Dict]:
+    """Runs fetch(imap, uids) once; if that fails, retries message by message
+    so one odd message does not cost the whole chunk. Returns (results, {uid: error})."""
+    if not uids:
+        return {}, {}
+    try:
+        return fetch(imap, uids), {}
+    except FETCH_RETRY_ERRORS as ex:
+        if len(uids) == 1:
+            return {}, {uids[0]: ex}
+
+    results, errors = {}, {}
+    for uid in uids:
+        try:
+            results.update(fetch(imap, [uid]))
+        except FETCH_RETRY_ERRORS as ex:
+            errors[uid] = ex
+    return results, errors
+
+
+def _header_bytes(items: Dict) -> bytes:
+    return next((v for k, v in items.items() if k.startswith("BODY[HEADER")), b"") or b""
+
+
+def _fetch_message_ids(imap, uids: List[str]) -> Dict[str, str]:
+    """Only the Message-ID header of several messages (a few dozen bytes each)."""
+    fetched = _uid_fetch(imap, uids, f"(UID {MESSAGE_ID_PEEK})")
+    return {
+        uid: (BytesHeaderParser().parsebytes(_header_bytes(items)).get("Message-ID") or "").strip()
+        for uid, items in fetched.items()
+    }
+
+
+def _fetch_overviews(imap, uids: List[str]) -> Dict[str, Dict]:
+    """Headers and parts of several messages without downloading any body."""
+    fetched = _uid_fetch(
+        imap, uids, f"(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({OVERVIEW_HEADER_FIELDS})])"
+    )
+    overviews = {}
+    for uid, items in fetched.items():
+        if "BODYSTRUCTURE" not in items:
+            raise IMAPParseError(f"BODYSTRUCTURE missing for UID {uid}")
+        overviews[uid] = {
+            "headers": BytesHeaderParser().parsebytes(_header_bytes(items)),
+            "parts": flatten_bodystructure(items["BODYSTRUCTURE"]),
+        }
+    return overviews
+
+
+def _fetch_full_messages(imap, uids: List[str]) -> Dict:
+    """Complete messages, for servers whose BODYSTRUCTURE cannot be used."""
+    fetched = _uid_fetch(imap, uids, "(UID BODY.PEEK[])")
+    return {uid: email.message_from_bytes(items["BODY[]"]) for uid, items in fetched.items() if items.get("BODY[]")}
+
+
+def _select_attachment_parts(parts: List[Dict], strict_mode: bool, max_attachment_size_bytes: int,
+                             policy: Optional[Dict] = None) -> Tuple[List[Dict], Dict]:
+    """Applies the _extract_supported_attachments filters to BODYSTRUCTURE parts."""
+    max_attachment_size_bytes = _max_size_for(policy, max_attachment_size_bytes)
+    selected = []
+    skipped = {
+        "skipped_by_type": 0,
+        "skipped_by_size": 0,
+    }
+
+    for part in parts:
+        filename = _decode_header_text(part_filename(part))
+        if "attachment" not in part["disposition"] and not filename:
+            continue
+
+        if not _is_supported_file(filename, part["mime_type"], strict_mode, policy):
+            skipped["skipped_by_type"] += 1
+            continue
+
+        if not part["size"]:
+            continue
+
+        if max_attachment_size_bytes > 0 and min_decoded_size(part) > max_attachment_size_bytes:
+            skipped["skipped_by_size"] += 1
+            continue
+
+        selected.append({**part, "filename": filename, "max_size": max_attachment_size_bytes})
+
+    return selected, skipped
+
+
+def _decode_attachment_parts(items: Dict, parts: List[Dict], max_attachment_size_bytes: int) -> Tuple[List[Dict], int]:
+    """Decodes fetched parts straight into spooled files."""
+    attachments = []
+    skipped_by_size = 0
+    for part in parts:
+        spool = SpooledAttachment()
+        try:
+            decode_transfer_encoding_into(items.get(f"BODY[{part['part']}]") or b"", part["encoding"], spool)
+        except Exception:
+            spool.close()
+            raise
+        if not spool.size:
+            spool.close()
+            continue
+
+        # The structure only gave an estimate; the limit applies to decoded bytes
+        max_size = part.get("max_size", max_attachment_size_bytes)
+        if max_size > 0 and spool.size > max_size:
+            spool.close()
+            skipped_by_size += 1
+            continue
+
+        attachments.append(
+            {
+                "filename": _safe_filename(part["filename"]),
+                "mime_type": part["mime_type"],
+                "file": spool,
+            }
+        )
+
+    return attachments, skipped_by_size
+
+
+def _byte_batches(uids: List[str], selections: Dict[str, List[Dict]], max_bytes: int):
+    """Splits uids so the encoded parts of one UID FETCH stay under max_bytes
+    (a single larger message still gets its own fetch)."""
+    batch, batch_bytes = [], 0
+    for uid in uids:
+        size = sum(part["size"] for part in selections[uid])
+        if batch and max_bytes > 0 and batch_bytes + size > max_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _fetch_attachment_parts(imap, selections: Dict[str, List[Dict]], max_attachment_size_bytes: int,
+                            fetch_batch_bytes: int = 0) -> Tuple[Dict, Dict]:
+    """Downloads the selected parts of many messages. Messages whose wanted
+    part numbers match (usually just "2") share one UID FETCH, up to
+    fetch_batch_bytes per round trip; each response is spooled and dropped
+    before the next one is read.
+    Returns ({uid: (attachments, late_size_skips)}, {uid: error})."""
+    groups: Dict[Tuple[str, ...], List[str]] = {}
+    for uid, parts in selections.items():
+        if parts:
+            groups.setdefault(tuple(part["part"] for part in parts), []).append(uid)
+
+    results, errors = {}, {}
+    for part_numbers, group_uids in groups.items():
+        sections = " ".join(f"BODY.PEEK[{number}]" for number in part_numbers)
+        for uids in _byte_batches(group_uids, selections, fetch_batch_bytes):
+            fetched, batch_errors = _fetch_batch_or_each(
+                lambda conn, batch: _uid_fetch(conn, batch, f"(UID {sections})"), imap, uids
+            )
+            errors.update(batch_errors)
+            for uid in uids:
+                if uid in fetched:
+                    results[uid] = _decode_attachment_parts(fetched.pop(uid), selections[uid], max_attachment_size_bytes)
+                elif uid not in errors:
+                    errors[uid] = "no data returned"
+    return results, errors
+
+
+def _message_error(result: Dict, uid: str, error: str) -> None:
+    """Records an error both in the flat list and under its message UID."""
+    result["errors"].append(error)
+    result["message_errors"].setdefault(uid, []).append(error)
+
+
+def _iter_mailbox_messages(imap, uids: List[str], chunk_size: int, ranged_fetch: bool,
+                           strict_mode: bool, max_attachment_size_bytes: int, result: Dict,
+                           journal: Optional[mail_journal.MailJournal] = None, fetch_batch_bytes: int = 0,
+                           rules: Optional[mail_rules.MailRuleSet] = None, precheck: bool = True):
+    """Yields (uid, message_id, attachments) for every message that could be
+    fetched, using a few UID FETCH round trips per chunk instead of one per
+    message. Messages skipped by the mail rules, or whose Message-ID is in
+    the journal, yield no attachments; accepted ones carry the rule's
+    routing on each attachment. With precheck, journaled mail is recognised
+    from its Message-ID header alone, before any structure or body is fetched."""
+    rules = rules or mail_rules.load_rules()
+    for chunk in _chunked(uids, chunk_size):
+        result["messages_scanned"] += len(chunk)
+
+        message_ids = {}
+        fetch_uids = list(chunk)
+        prechecked = set()
+        if journal is not None and precheck and len(journal):
+            try:
+                peeked = _fetch_message_ids(imap, chunk)
+            except FETCH_RETRY_ERRORS:
+                peeked = {}  # the checks after the header fetch still apply
+            known = journal.known(mail_journal.MESSAGE_ID, peeked.values())
+            prechecked = set(peeked)
+            for uid, message_id in peeked.items():
+                if message_id in known:
+                    message_ids[uid] = message_id
+                    result["skipped_known"] += 1
+            fetch_uids = [uid for uid in chunk if uid not in message_ids]
+
+        overviews, full_uids = {}, fetch_uids
+        if ranged_fetch:
+            overviews, overview_errors = _fetch_batch_or_each(_fetch_overviews, imap, fetch_uids)
+            for uid, ex in overview_errors.items():
+                # Unusual server output: fall back to the full download
+                _message_error(result, uid, f"BODYSTRUCTURE unreadable for message UID {uid}, fetched in full: {ex}")
+            full_uids = [uid for uid in fetch_uids if uid not in overviews]
+        messages, fetch_errors = _fetch_batch_or_each(_fetch_full_messages, imap, full_uids)
+
+        selections = {}
+        extracted = {}
+        routing = {}
+        for uid in fetch_uids:
+            overview = overviews.get(uid)
+            msg = overview["headers"] if overview else messages.get(uid)
+            if msg is None:
+                result["failed"] += 1
+                reason = f": {fetch_errors[uid]}" if uid in fetch_errors else ""
+                _message_error(result, uid, f"Failed to fetch message UID {uid}{reason}")
+                continue
+
+            message_ids[uid] = (msg.get("Message-ID") or "").strip()
+            if (
+                journal is not None
+                and uid not in prechecked
+                and journal.contains(mail_journal.MESSAGE_ID, message_ids[uid])
+            ):
+                result["skipped_known"] += 1
+                continue
+
+            decision = rules.evaluate(
+                parseaddr(msg.get("From", ""))[1], _decode_header_text(msg.get("Subject", ""))
+            )
+            if decision["action"] == "skip":
+                rule = decision["rule"]
+                if rule == mail_rules.LEGACY_SENDERS_RULE:
+                    result["skipped_sender"] += 1
+                elif rule == mail_rules.LEGACY_SUBJECT_RULE:
+                    result["skipped_subject"] += 1
+                else:
+                    result["skipped_rule"] += 1
+                result["skipped_by_rule"][rule] = result["skipped_by_rule"].get(rule, 0) + 1
+                continue
+            if decision["rule"]:
+                routing[uid] = {"rule": decision["rule"], "tags": decision["tags"]}
+                result["rule_matches"][decision["rule"]] = result["rule_matches"].get(decision["rule"], 0) + 1
+
+            if overview:
+                selections[uid], skipped = _select_attachment_parts(
+                    overview["parts"],
+                    strict_mode=strict_mode,
+                    max_attachment_size_bytes=max_attachment_size_bytes,
+                    policy=decision["attachments"],
+                )
+            else:
+                extracted[uid], skipped = _extract_supported_attachments(
+                    msg,
+                    strict_mode=strict_mode,
+                    max_attachment_size_bytes=max_attachment_size_bytes,
+                    policy=decision["attachments"],
+                )
+            result["skipped_by_type"] += skipped.get("skipped_by_type", 0)
+            result["skipped_by_size"] += skipped.get("skipped_by_size", 0)
+
+        downloaded, part_errors = _fetch_attachment_parts(imap, selections, max_attachment_size_bytes, fetch_batch_bytes)
+        for uid, error in part_errors.items():
+            result["failed"] += 1
+            _message_error(result, uid, f"Failed to fetch attachments of message UID {uid}: {error}")
+
+        for uid in chunk:
+            if uid not in message_ids or uid in part_errors:
+                continue
+            if uid in downloaded:
+                attachments, late_size_skips = downloaded[uid]
+                result["skipped_by_size"] += late_size_skips
+            else:
+                attachments = extracted.get(uid, [])
+            if uid in routing:
+                for att in attachments:
+                    att["routing"] = routing[uid]
+            result["attachments_found"] += len(attachments)
+            if attachments:
+                result["messages_with_attachments"] += 1
+            yield uid, message_ids[uid], attachments
+
+
+def _uidvalidity(imap) -> Optional[str]:
+    """UIDVALIDITY reported by the last SELECT, if the server sent one."""
+    try:
+        _, data = imap.response("UIDVALIDITY")
+    except Exception:
+        return None
+    value = data[0] if data else None
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _checkpoint_uid(uids: List[str], handled: set, last_uid: int) -> int:
+    """Highest UID up to which every listed message was handled; mail after a
+    failed fetch is looked at again next run (the journal skips it cheaply)."""
+    checkpoint = last_uid
+    for uid in sorted(uids, key=int):
+        if uid not in handled:
+            break
+        checkpoint = max(checkpoint, int(uid))
+    return checkpoint
+
+
+def _mark_seen(imap, uids: List[str], result: Dict) -> None:
+    """Sets \\Seen on all handled messages with a few UID STORE commands."""
+    for chunk in _chunked(uids, 500):
+        try:
+            status, _ = imap.uid("STORE", _uid_set(chunk), "+FLAGS", "(\\Seen)")
+            if status != "OK":
+                result["errors"].append(f"Unable to mark messages as seen: {_uid_set(chunk)}")
+        except Exception as ex:
+            result["errors"].append(f"Unable to mark messages as seen: {ex}")
+
+
+# --- STAGED PIPELINE ---
+PIPELINE_STAGES = ("fetch", "dedupe", "extract", "upload", "save")
+SAVE_IDLE_FLUSH_SECONDS = 1.0
+_STOP = object()
+
+
+class _IngestionPipeline:
+    """Attachment pipeline behind the IMAP reader.
+
+    The reader thread hashes and dedupes each attachment, then hands it to an
+    extraction pool (model + compliance), an upload pool and one batching DB
+    writer. Stages are linked by bounded queues: when one is full the stage
+    feeding it blocks, so a slow model throttles the IMAP reader instead of
+    piling attachments up in memory. Attachments travel as spooled files and
+    hold a share of the process-wide in-flight byte budget until they are
+    stored or dropped.
+
+    A failed item goes to the retry queue (mail_retry) with the stage it
+    failed in; resubmit() puts leased retry entries back at that stage.
+    Hashes of saved and duplicate attachments go to the journal on close(),
+    so the same file arriving again is dropped without a database query.
+
+    Workers never touch the run result directly; merge_into() adds their
+    counters, per-message errors and stage timings once everything drained.
+    """
+
+    def __init__(self, ai_version: str, db_batch_size: int, extract_workers: int,
+                 upload_workers: int, queue_size: int, source: Optional[str] = None,
+                 retry_failures: bool = True, journal: Optional[mail_journal.MailJournal] = None):
+        self.ai_version = ai_version
+        self.db_batch_size = db_batch_size
+        self.source = source
+        self.retry_failures = retry_failures
+        self.lock = threading.Lock()
+        self.counts = {
+            "ingested": 0, "duplicates": 0, "failed": 0,
+            "retried": 0, "retry_recovered": 0, "retry_queued": 0, "dead_lettered": 0,
+        }
+        self.errors: List[Tuple[str, str]] = []
+        self.timings = {stage: {"seconds": 0.0, "items": 0, "workers": 1} for stage in PIPELINE_STAGES}
+        self.timings["extract"]["workers"] = extract_workers
+        self.timings["upload"]["workers"] = upload_workers
+        self.blocked_seconds = 0.0
+        self.budget = inflight_budget()
+        self.spool_stats = {"attachments": 0, "bytes": 0, "on_disk": 0, "budget_wait_seconds": 0.0}
+        self.started = time.perf_counter()
+
+        # Saves are buffered and written in bulk, so duplicates inside one run
+        # have to be caught here before they reach the database.
+        self.run_hashes = set()
+        self.run_business_keys = set()
+        self.journal = journal
+        self.handled_hashes: List[str] = []
+
+        self.extract_queue = queue.Queue(maxsize=queue_size)
+        self.upload_queue = queue.Queue(maxsize=queue_size)
+        self.save_queue = queue.Queue(maxsize=max(queue_size, db_batch_size))
+        self.extract_threads = [
+            self._start(f"mail-extract-{i}", self._work, "extract", self.extract_queue, self.upload_queue, self._extract)
+            for i in range(extract_workers)
+        ]
+        self.upload_threads = [
+            self._start(f"mail-upload-{i}", self._work, "upload", self.upload_queue, self.save_queue, self._upload)
+            for i in range(upload_workers)
+        ]
+        self.writer_thread = self._start("mail-save", self._write)
+
+    @staticmethod
+    def _start(name, target, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def _fail(self, uid: str, error: Optional[str], item: Optional[Dict] = None, stage: Optional[str] = None):
+        """Counts a failure; with a stage the item is kept in the retry queue."""
+        with self.lock:
+            self.counts["failed"] += 1
+            if error:
+                self.errors.append((uid, error))
+        if item:
+            if stage and self.retry_failures:
+                outcome = mail_retry.enqueue(item, stage, error or f"{stage} failed", source=self.source)
+                if outcome:
+                    self._count("dead_lettered" if outcome == "dead" else "retry_queued")
+            self._discard_attachment(item)
+            # Let a later run (or another mailbox worker) take the invoice again
+            for kind, key in item.get("claims", []):
+                shared_limits.release(kind, key)
+
+    def _resolve(self, item: Dict, outcome: str):
+        """Counts a saved or duplicate item; a retry entry is done either way."""
+        self._count(outcome)
+        with self.lock:
+            self.handled_hashes.append(item["document_hash"])
+        if item.get("retry_id"):
+            mail_retry.complete(item["retry_id"])
+            if outcome == "ingested":
+                self._count("retry_recovered")
+
+    @staticmethod
+    def _discard_attachment(item: Dict):
+        """Deletes the spooled data and frees its share of the byte budget."""
+        attachment = item.pop("attachment", None)
+        if attachment:
+            attachment["file"].close()
+
+    def record(self, stage: str, started: float, items: int = 1):
+        with self.lock:
+            self.timings[stage]["seconds"] += time.perf_counter() - started
+            self.timings[stage]["items"] += items
+
+    def timed_messages(self, messages):
+        """Wraps the IMAP reader so the time spent fetching is recorded."""
+        iterator = iter(messages)
+        while True:
+            started = time.perf_counter()
+            try:
+                message = next(iterator)
+            except StopIteration:
+                return
+            self.record("fetch", started)
+            yield message
+
+    # --- reader thread ---
+    def submit(self, uid: str, attachment: Dict):
+        """Duplicate check, then queue for extraction (blocks while the pool is
+        busy or the in-flight byte budget is used up)."""
+        spool = attachment["file"]
+        started = time.perf_counter()
+        try:
+            # Hashed while it was spooled
+            document_hash = spool.sha256
+            if self.journal is not None and self.journal.contains(mail_journal.SHA256, document_hash):
+                duplicate = True
+            elif document_hash in self.run_hashes:
+                duplicate = True
+            elif is_duplicate_hash(document_hash):
+                duplicate = True
+                with self.lock:
+                    self.handled_hashes.append(document_hash)
+            else:
+                # The claim covers other worker processes ingesting the same file right now
+                duplicate = not shared_limits.claim("document_hash", document_hash)
+            if not duplicate:
+                self.run_hashes.add(document_hash)
+        except Exception as ex:
+            # e.g. the database is unreachable: keep the attachment for a retry
+            self._fail(uid, str(ex), {"uid": uid, "attachment": attachment, "document_hash": spool.sha256,
+                                      "routing": attachment.get("routing")}, "extract")
+            return
+        finally:
+            self.record("dedupe", started)
+
+        if duplicate:
+            spool.close()
+            self._count("duplicates")
+            return
+
+        self.spool_stats["attachments"] += 1
+        self.spool_stats["bytes"] += spool.size
+        self.spool_stats["on_disk"] += int(spool.on_disk)
+        started = time.perf_counter()
+        self.spool_stats["budget_wait_seconds"] += spool.reserve(self.budget)
+        self.extract_queue.put({
+            "uid": uid,
+            "attachment": attachment,
+            "document_hash": document_hash,
+            "claims": [("document_hash", document_hash)],
+            "routing": attachment.get("routing"),
+        })
+        self.blocked_seconds += time.perf_counter() - started
+
+    def resubmit(self, entry: Dict):
+        """Feeds a leased retry entry back in at the stage it failed in."""
+        uid = f"retry-{entry['id']}"
+        stage = entry["stage"]
+        document_hash = entry["document_hash"]
+        item = {
+            "uid": uid,
+            "retry_id": entry["id"],
+            "document_hash": document_hash,
+            "claims": [],
+            "routing": entry.get("routing"),
+            "filename": entry.get("filename"),
+            "mime_type": entry.get("mime_type"),
+        }
+        try:
+            if document_hash in self.run_hashes or is_duplicate_hash(document_hash):
+                self._resolve(item, "duplicates")
+                return
+            if not shared_limits.claim("document_hash", document_hash):
+                return  # another worker has it right now; the lease brings it back later
+            self.run_hashes.add(document_hash)
+            item["claims"].append(("document_hash", document_hash))
+
+            if stage != "extract":
+                payload = item["payload"] = entry["payload"]
+                if self._business_duplicate(
+                    item, payload.get("vendor_name"), payload.get("invoice_date"), payload.get("total_amount")
+                ):
+                    self._resolve(item, "duplicates")
+                    return
+            if stage != "save":
+                item["attachment"] = mail_retry.load_attachment(entry)
+        except Exception as ex:
+            self._fail(uid, f"Retry of {entry.get('filename')}: {ex}", item, stage)
+            return
+
+        self._count("retried")
+        if stage == "save":
+            item["public_url"] = entry["public_url"]
+            self.save_queue.put(item)
+            return
+        started = time.perf_counter()
+        self.spool_stats["budget_wait_seconds"] += item["attachment"]["file"].reserve(self.budget)
+        (self.extract_queue if stage == "extract" else self.upload_queue).put(item)
+        self.blocked_seconds += time.perf_counter() - started
+
+    # --- workers ---
+    def _work(self, stage: str, inbox: queue.Queue, outbox: queue.Queue, handler):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                return
+            started = time.perf_counter()
+            try:
+                output = handler(item)
+            except Exception as ex:
+                output = None
+                self._fail(item["uid"], str(ex), item, stage)
+            self.record(stage, started)
+            if output is not None:
+                outbox.put(output)
+
+    def _business_duplicate(self, item: Dict, vendor_name, invoice_date, total_amount) -> bool:
+        """True if vendor/date/amount was already saved, earlier in this run or
+        by another process right now; otherwise the item claims it."""
+        business_key = (vendor_name, invoice_date, total_amount)
+        with self.lock:
+            duplicate = business_key in self.run_business_keys
+            self.run_business_keys.add(business_key)
+        business_claim = json.dumps(business_key, default=str)
+        if (
+            duplicate
+            or is_duplicate(vendor_name, invoice_date, total_amount)
+            or not shared_limits.claim("business_key", business_claim)
+        ):
+            return True
+        item["claims"].append(("business_key", business_claim))
+        return False
+
+    def _extract(self, item: Dict) -> Optional[Dict]:
+        att = item["attachment"]
+        # Gemini takes the document inline, so the bytes are read back here
+        # and only live for the duration of the call
+        extracted = processor.process_invoice(att["file"].read_bytes(), att["mime_type"])
+        if not extracted:
+            self._fail(item["uid"], processor.get_last_processing_error() or "Extraction failed", item, "extract")
+            return None
+
+        extracted["_ingest_source"] = "EMAIL"
+        extracted["_ingested_by"] = "MAIL_BOT"
+        routing = item.get("routing")
+        tags = (routing or {}).get("tags") or {}
+        if routing:
+            extracted["_mail_rule"] = routing["rule"]
+            extracted["_routing_tags"] = tags
+        if tags.get("vendor") and not extracted.get("vendor_name"):
+            # The rule knows the sender when the model could not read a vendor
+            extracted["vendor_name"] = tags["vendor"]
+
+        vendor_name = extracted.get("vendor_name")
+        invoice_date = extracted.get("invoice_date")
+        total_amount = extracted.get("total_amount")
+        policy = active_policy()
+        compliance_result = evaluate_invoice_compliance({
+            "vendor_name": vendor_name,
+            "invoice_date": invoice_date,
+            "total_amount": total_amount,
+            "currency": extracted.get("currency"),
+            "line_items": extracted.get("line_items", []),
+            # e.g. an "entity" tag set by the mailbox rule
+            policy.entity_field: extracted.get(policy.entity_field) or tags.get(policy.entity_field),
+        }, policy)
+        extracted["_compliance_policy"] = compliance_result["policy_version"]
+
+        if self._business_duplicate(item, vendor_name, invoice_date, total_amount):
+            self._discard_attachment(item)
+            self._resolve(item, "duplicates")
+            return None
+
+        confidence_score = extracted.get("confidence_score", extracted.get("overall_confidence", 0.0))
+        # Business duplicates were discarded above; the vendor profile comes
+        # from the risk engine's cache
+        risk = score_invoice({
+            "vendor_name": vendor_name,
+            "invoice_date": invoice_date,
+            "total_amount": total_amount,
+            "confidence_score": confidence_score,
+            "line_items": extracted.get("line_items", []),
+        }, duplicate_found=False)
+        extracted["_risk_reason_codes"] = risk["reason_codes"]
+
+        validation_status = "Pending Review"
+        flag_reason = "Auto-ingested from email"
+        if not compliance_result.get("compliant", True):
+            validation_status = "Flagged"
+            flag_reason = "Compliance: " + "; ".join(compliance_result.get("issues", [])[:3])
+        elif risk["risk_level"] == "HIGH":
+            validation_status = "Flagged"
+            flag_reason = "High Risk: " + ", ".join(risk["risk_reasons"])
+        if tags:
+            flag_reason += " [" + ", ".join(f"{key}: {value}" for key, value in tags.items()) + "]"
+
+        item["payload"] = {
+            "vendor_name": vendor_name,
+            "invoice_date": invoice_date,
+            "total_amount": total_amount,
+            "currency": extracted.get("currency"),
+            "line_items": extracted.get("line_items", []),
+            "validation_status": validation_status,
+            "processing_status": "INGESTED_EMAIL",
+            "confidence_score": confidence_score,
+            "flag_reason": flag_reason,
+            "document_hash": item["document_hash"],
+            "ai_raw_data": extracted,
+            "ai_structured_output": extracted.get("ai_raw_structured"),
+            "ai_explanations": extracted.get("explanations", {}),
+            "risk_score": risk["risk_score"],
+            "risk_level": risk["risk_level"],
+            "approval_stage": "UPLOADED",
+            "reviewed_by": None,
+            "approved_by": None,
+            "approval_timestamp": None,
+            "ai_version": self.ai_version,
+            "created_by": "MAIL_BOT",
+        }
+        return item
+
+    def _upload(self, item: Dict) -> Optional[Dict]:
+        att = item["attachment"]
+        public_url = upload_blob(
+            att["file"].open(), att["mime_type"], file_name=att["filename"], document_hash=item["document_hash"]
+        )
+        if not public_url:
+            self._fail(item["uid"], None, item, "upload")
+            return None
+        item["public_url"] = public_url
+        self._discard_attachment(item)  # stored; do not hold the data until the batch is saved
+        return item
+
+    def _write(self):
+        """Single DB writer: saves in batches of db_batch_size, or whatever is
+        waiting once the queue has been idle for a moment."""
+        pending = []
+        while True:
+            try:
+                item = self.save_queue.get(timeout=SAVE_IDLE_FLUSH_SECONDS)
+            except queue.Empty:
+                item = None
+            if item is not None and item is not _STOP:
+                pending.append(item)
+            if pending and (item is None or item is _STOP or len(pending) >= self.db_batch_size):
+                self._save(pending)
+                pending = []
+            if item is _STOP:
+                return
+
+    def _save(self, pending: List[Dict]):
+        started = time.perf_counter()
+        records = [{"data": item["payload"], "file_url": item["public_url"]} for item in pending]
+        try:
+            rows = save_invoice_records_batch(records, user_role="MAIL_BOT")
+        except Exception as ex:
+            rows = [{"ok": False, "error": str(ex)}] * len(pending)
+        for item, row in zip(pending, rows):
+            if row.get("ok"):
+                self._resolve(item, "ingested")
+            else:
+                self._fail(item["uid"], row.get("error"), item, "save")
+        self.record("save", started, items=len(pending))
+
+    # --- shutdown ---
+    def close(self):
+        """Lets every stage drain, then stops it (reader side first)."""
+        for threads, inbox in ((self.extract_threads, self.extract_queue), (self.upload_threads, self.upload_queue)):
+            for _ in threads:
+                inbox.put(_STOP)
+            for thread in threads:
+                thread.join()
+        self.save_queue.put(_STOP)
+        self.writer_thread.join()
+        if self.journal is not None:
+            self.journal.record(mail_journal.SHA256, self.handled_hashes)
+
+    def merge_into(self, result: Dict):
+        with self.lock:
+            for key, amount in self.counts.items():
+                result[key] += amount
+            for uid, error in self.errors:
+                _message_error(result, uid, error)
+            timings = {
+                stage: {**values, "seconds": round(values["seconds"], 3)}
+                for stage, values in self.timings.items()
+            }
+        timings["fetch"]["blocked_seconds"] = round(self.blocked_seconds, 3)
+        timings["spool"] = {
+            **self.spool_stats,
+            "budget_wait_seconds": round(self.spool_stats["budget_wait_seconds"], 3),
+            "peak_inflight_bytes": self.budget.peak,
+        }
+        timings["wall"] = {"seconds": round(time.perf_counter() - self.started, 3)}
+        result["stage_timings"] = timings
+
+
+def _connect_imap():
+    """Opens and logs into the configured IMAP account."""
+    host = (os.getenv("IMAP_HOST") or "").strip()
+    user = (os.getenv("IMAP_USER") or "").strip()
+    password = (os.getenv("IMAP_PASSWORD") or "").strip().replace(" ", "")
+    # A timeout turns a silently dropped connection into an error instead of a hang
+    timeout = float(os.getenv("MAIL_IMAP_TIMEOUT_SECONDS", "120"))
+    imap = imaplib.IMAP4_SSL(host, int((os.getenv("IMAP_PORT", "993") or "993").strip()), timeout=timeout)
+    imap.login(user, password)
+    return imap
+
+
+def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini-flash-lite-latest", imap=None) -> Dict:
+    """One ingestion pass over the configured mailbox.
+    imap: an already logged-in connection to reuse (the daemon's); it is
+    left open. Without it a connection is opened and closed for this run.
+    """
     result = {
         "status": "SUCCESS",
         "messages_scanned": 0,
@@ -146,7 +971,18 @@ def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini
         "skipped_subject": 0,
         "skipped_by_type": 0,
         "skipped_by_size": 0,
+        "skipped_known": 0,
+        "skipped_rule": 0,
+        "skipped_by_rule": {},
+        "retried": 0,
+        "retry_recovered": 0,
+        "retry_queued": 0,
+        "dead_lettered": 0,
+        "rule_matches": {},
+        "checkpoint_uid": None,
         "errors": [],
+        "message_errors": {},
+        "stage_timings": {},
     }
 
     configured, reason = is_mail_ingestion_configured()
@@ -155,20 +991,47 @@ def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini
         result["errors"].append(reason)
         return result
 
+    try:
+        # Compiled once; evaluating them per message is then a few dict lookups
+        rules = mail_rules.load_rules()
+    except mail_rules.MailRuleError as e:
+        result["status"] = "FAILED"
+        result["errors"].append(f"Mail rules: {e}")
+        return result
+
     host = (os.getenv("IMAP_HOST") or "").strip()
     user = (os.getenv("IMAP_USER") or "").strip()
-    password = (os.getenv("IMAP_PASSWORD") or "").strip().replace(" ", "")
     folder = (os.getenv("IMAP_FOLDER", "INBOX") or "INBOX").strip()
     unseen_only = _env_bool("MAIL_UNSEEN_ONLY", True)
     mark_as_seen = _env_bool("MAIL_MARK_AS_SEEN", True)
     strict_attachment_mode = _env_bool("MAIL_STRICT_ATTACHMENT_MODE", False)
     max_attachment_size_mb = int(os.getenv("MAIL_MAX_ATTACHMENT_SIZE_MB", "15"))
     max_attachment_size_bytes = max_attachment_size_mb * 1024 * 1024
+    db_batch_size = max(1, int(os.getenv("MAIL_DB_BATCH_SIZE", "25")))
+    ranged_fetch = _env_bool("MAIL_RANGED_FETCH", True)
+    fetch_chunk_size = max(1, int(os.getenv("MAIL_FETCH_CHUNK_SIZE", "25")))
+    fetch_batch_bytes = int(float(os.getenv("MAIL_FETCH_BATCH_MB", "32")) * 1024 * 1024)
+    use_checkpoint = _env_bool("MAIL_UID_CHECKPOINT", True)
+    extract_workers = max(1, int(os.getenv("MAIL_EXTRACT_WORKERS", "3")))
+    upload_workers = max(1, int(os.getenv("MAIL_UPLOAD_WORKERS", "2")))
+    pipeline_queue_size = max(1, int(os.getenv("MAIL_PIPELINE_QUEUE_SIZE", "8")))
+    # Retry entries resumed per run (0 disables the retry queue)
+    retry_batch = max(0, int(os.getenv("MAIL_RETRY_BATCH_SIZE", "20")))
+    # Message-IDs and attachment hashes of earlier runs, part of incremental mode
+    journal = mail_journal.get_journal() if use_checkpoint else None
 
-    imap = None
+    pipeline = None
+    # Flagged \\Seen, journaled and checkpointed once the run is over
+    uids: List[str] = []
+    handled_uids: List[str] = []
+    handled_message_ids: List[str] = []
+    uidvalidity = None
+    last_uid = 0
+
+    owns_connection = imap is None
     try:
-        imap = imaplib.IMAP4_SSL(host, int((os.getenv("IMAP_PORT", "993") or "993").strip()))
-        imap.login(user, password)
+        if owns_connection:
+            imap = _connect_imap()
         select_status, _ = imap.select(folder)
         if select_status != "OK":
             result["status"] = "FAILED"
@@ -176,146 +1039,85 @@ def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini
             return result
 
         criteria = "UNSEEN" if unseen_only else "ALL"
-        status, data = imap.search(None, criteria)
+        if use_checkpoint:
+            uidvalidity = _uidvalidity(imap)
+            last_uid = mail_state.load_checkpoint(host, user, folder, uidvalidity)
+            if last_uid:
+                # Everything newer than the checkpoint, read or not
+                criteria = f"UID {last_uid + 1}:*"
+
+        status, data = imap.uid("SEARCH", None, criteria)
         if status != "OK":
             result["status"] = "FAILED"
             result["errors"].append("Unable to search mailbox")
             return result
 
-        message_ids = data[0].split()
-        if not message_ids:
+        uids = [uid.decode() for uid in data[0].split()]
+        if last_uid:
+            # "n:*" always matches the newest message, even when it is below n.
+            # Oldest first, so the checkpoint never jumps over unprocessed mail.
+            uids = sorted((uid for uid in uids if int(uid) > last_uid), key=int)[:max_messages]
+        elif use_checkpoint:
+            # First run: the checkpoint will be set to the highest UID handled,
+            # so take the oldest unread mail; newer backlog follows next run
+            uids = sorted(uids, key=int)[:max_messages]
+        else:
+            uids = uids[-max_messages:]
+        retries_due = retry_batch > 0 and mail_retry.next_due_in() == 0
+        if not uids and not retries_due:
             return result
 
-        message_ids = message_ids[-max_messages:]
-
-        for message_id in message_ids:
-            result["messages_scanned"] += 1
-            message_processing_attempted = False
-
-            fetch_status, msg_data = imap.fetch(message_id, "(RFC822)")
-            if fetch_status != "OK" or not msg_data or not msg_data[0]:
-                result["failed"] += 1
-                result["errors"].append(f"Failed to fetch message {message_id.decode(errors='ignore')}")
-                continue
-
-            raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
-
-            sender = parseaddr(msg.get("From", ""))[1]
-            if not _allowed_sender(sender):
-                result["skipped_sender"] += 1
-                continue
-
-            subject = _decode_header_text(msg.get("Subject", ""))
-            if not _subject_matches_filters(subject):
-                result["skipped_subject"] += 1
-                continue
-
-            attachments, skipped = _extract_supported_attachments(
-                msg,
-                strict_mode=strict_attachment_mode,
-                max_attachment_size_bytes=max_attachment_size_bytes,
-            )
-            result["attachments_found"] += len(attachments)
-            if attachments:
-                result["messages_with_attachments"] += 1
-            result["skipped_by_type"] += skipped.get("skipped_by_type", 0)
-            result["skipped_by_size"] += skipped.get("skipped_by_size", 0)
+        shared_limits.purge_expired_claims()
+        pipeline = _IngestionPipeline(
+            ai_version,
+            db_batch_size=db_batch_size,
+            extract_workers=extract_workers,
+            upload_workers=upload_workers,
+            queue_size=pipeline_queue_size,
+            source=mail_state.mailbox_key(host, user, folder),
+            retry_failures=retry_batch > 0,
+            journal=journal,
+        )
+        messages = _iter_mailbox_messages(
+            imap,
+            uids,
+            chunk_size=fetch_chunk_size,
+            ranged_fetch=ranged_fetch,
+            strict_mode=strict_attachment_mode,
+            max_attachment_size_bytes=max_attachment_size_bytes,
+            result=result,
+            journal=journal,
+            fetch_batch_bytes=fetch_batch_bytes,
+            rules=rules,
+            precheck=_env_bool("MAIL_MESSAGE_ID_PRECHECK", True),
+        )
+        for uid, message_id, attachments in pipeline.timed_messages(messages):
+            handled_uids.append(uid)
+            handled_message_ids.append(message_id)
+            for att in attachments:
+                pipeline.submit(uid, att)
 
-            for idx, att in enumerate(attachments):
-                message_processing_attempted = True
-                try:
-                    document_hash = compute_document_hash(att["file_bytes"])
-                    if is_duplicate_hash(document_hash):
-                        result["duplicates"] += 1
-                        continue
-
-                    extracted = processor.process_invoice(att["file_bytes"], att["mime_type"])
-                    if not extracted:
-                        result["failed"] += 1
-                        result["errors"].append(processor.get_last_processing_error() or "Extraction failed")
-                        continue
-
-                    extracted["_ingest_source"] = "EMAIL"
-                    extracted["_ingested_by"] = "MAIL_BOT"
-
-                    vendor_name = extracted.get("vendor_name")
-                    invoice_date = extracted.get("invoice_date")
-                    total_amount = extracted.get("total_amount")
-                    compliance_result = evaluate_invoice_compliance({
-                        "vendor_name": vendor_name,
-                        "invoice_date": invoice_date,
-                        "total_amount": total_amount,
-                        "currency": extracted.get("currency"),
-                        "line_items": extracted.get("line_items", []),
-                    })
-
-                    if is_duplicate(vendor_name, invoice_date, total_amount):
-                        result["duplicates"] += 1
-                        continue
-
-                    risk_score = 0
-                    risk_level = "LOW"
-                    validation_status = "Pending Review"
-                    flag_reason = "Auto-ingested from email"
-
-                    if not compliance_result.get("compliant", True):
-                        risk_score += 30
-                        risk_level = "MEDIUM"
-                        validation_status = "Flagged"
-                        flag_reason = "Compliance: " + "; ".join(compliance_result.get("issues", [])[:3])
-
-                    storage_name = (
-                        f"mail/{datetime.utcnow().strftime('%Y%m%d')}/"
-                        f"msg_{message_id.decode(errors='ignore')}_{idx}_{att['filename']}"
-                    )
-                    public_url = upload_file(att["file_bytes"], storage_name, att["mime_type"])
-                    if not public_url:
-                        result["failed"] += 1
-                        continue
-
-                    payload = {
-                        "vendor_name": vendor_name,
-                        "invoice_date": invoice_date,
-                        "total_amount": total_amount,
-                        "currency": extracted.get("currency"),
-                        "line_items": extracted.get("line_items", []),
-                        "validation_status": validation_status,
-                        "processing_status": "INGESTED_EMAIL",
-                        "confidence_score": extracted.get("confidence_score", extracted.get("overall_confidence", 0.0)),
-                        "flag_reason": flag_reason,
-                        "document_hash": document_hash,
-                        "ai_raw_data": extracted,
-                        "ai_structured_output": extracted.get("ai_raw_structured"),
-                        "ai_explanations": extracted.get("explanations", {}),
-                        "risk_score": risk_score,
-                        "risk_level": risk_level,
-                        "approval_stage": "UPLOADED",
-                        "reviewed_by": None,
-                        "approved_by": None,
-                        "approval_timestamp": None,
-                        "ai_version": ai_version,
-                        "created_by": "MAIL_BOT",
-                    }
-
-                    saved = save_invoice_record(payload, public_url, user_role="MAIL_BOT")
-                    if saved:
-                        result["ingested"] += 1
-                    else:
-                        result["failed"] += 1
-
-                except Exception as ex:
-                    result["failed"] += 1
-                    result["errors"].append(str(ex))
-
-            if mark_as_seen and message_processing_attempted:
-                imap.store(message_id, "+FLAGS", "\\Seen")
+        # Earlier failures that are due, resumed where they stopped
+        if retries_due:
+            for entry in mail_retry.lease_due(retry_batch):
+                pipeline.resubmit(entry)
 
     except Exception as ex:
         result["status"] = "FAILED"
         result["errors"].append(str(ex))
     finally:
-        if imap:
+        if pipeline:
+            pipeline.close()
+            pipeline.merge_into(result)
+        if imap and mark_as_seen and handled_uids:
+            _mark_seen(imap, handled_uids, result)
+        if use_checkpoint and handled_uids:
+            journal.record(mail_journal.MESSAGE_ID, handled_message_ids)
+            checkpoint = _checkpoint_uid(uids, set(handled_uids), last_uid)
+            if uidvalidity and checkpoint > last_uid:
+                mail_state.save_checkpoint(host, user, folder, uidvalidity, checkpoint)
+            result["checkpoint_uid"] = checkpoint if uidvalidity else None
+        if imap and owns_connection:
             try:
                 imap.close()
             except Exception:
@@ -333,3 +1135,308 @@ def ingest_invoices_from_email(max_messages: int = 20, ai_version: str = "gemini
         result["status"] = "SUCCESS"
 
     return result
+
+
+def process_retry_queue(ai_version: str = "gemini-flash-lite-latest", limit: Optional[int] = None) -> Dict:
+    """Resumes the due retry entries without connecting to the mailbox
+    (python -m mail_ingestion retry)."""
+    result = {
+        "status": "SUCCESS",
+        "ingested": 0,
+        "duplicates": 0,
+        "failed": 0,
+        "retried": 0,
+        "retry_recovered": 0,
+        "retry_queued": 0,
+        "dead_lettered": 0,
+        "errors": [],
+        "message_errors": {},
+        "stage_timings": {},
+    }
+    limit = limit or max(1, int(os.getenv("MAIL_RETRY_BATCH_SIZE", "20")))
+    entries = mail_retry.lease_due(limit)
+    if not entries:
+        return result
+
+    pipeline = _IngestionPipeline(
+        ai_version,
+        db_batch_size=max(1, int(os.getenv("MAIL_DB_BATCH_SIZE", "25"))),
+        extract_workers=max(1, int(os.getenv("MAIL_EXTRACT_WORKERS", "3"))),
+        upload_workers=max(1, int(os.getenv("MAIL_UPLOAD_WORKERS", "2"))),
+        queue_size=max(1, int(os.getenv("MAIL_PIPELINE_QUEUE_SIZE", "8"))),
+        journal=mail_journal.get_journal() if _env_bool("MAIL_UID_CHECKPOINT", True) else None,
+    )
+    try:
+        for entry in entries:
+            pipeline.resubmit(entry)
+    finally:
+        pipeline.close()
+        pipeline.merge_into(result)
+
+    if result["errors"] and result["ingested"] == 0:
+        result["status"] = "FAILED"
+    elif result["errors"] or result["failed"]:
+        result["status"] = "PARTIAL"
+    return result
+
+
+# --- DAEMON (python -m mail_ingestion serve) ---
+class _DaemonStatus:
+    """Status written to MAIL_STATE_DIR/daemon_status.json for the sidebar.
+    A heartbeat thread refreshes it, so a killed daemon shows up as stale."""
+
+    def __init__(self, heartbeat_seconds: float):
+        self.lock = threading.Lock()
+        self.heartbeat_seconds = heartbeat_seconds
+        # Set by mail_supervisor for each mailbox/folder worker process
+        self.worker = os.getenv("MAIL_WORKER_NAME") or None
+        self.status = {
+            "worker": self.worker,
+            "state": "starting",
+            "pid": os.getpid(),
+            "host": (os.getenv("IMAP_HOST") or "").strip(),
+            "folder": (os.getenv("IMAP_FOLDER", "INBOX") or "INBOX").strip(),
+            "mode": None,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "heartbeat_seconds": heartbeat_seconds,
+            "last_run": None,
+            "last_error": None,
+            "reconnects": 0,
+            "totals": {"runs": 0, "ingested": 0, "duplicates": 0, "failed": 0},
+        }
+
+    def update(self, **fields):
+        with self.lock:
+            self.status.update(fields)
+            self._write()
+
+    def record_run(self, result: Dict):
+        with self.lock:
+            totals = self.status["totals"]
+            totals["runs"] += 1
+            for key in ("ingested", "duplicates", "failed"):
+                totals[key] += result.get(key, 0)
+            self.status["last_run"] = {
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "status": result.get("status"),
+                "messages_scanned": result.get("messages_scanned", 0),
+                "ingested": result.get("ingested", 0),
+                "duplicates": result.get("duplicates", 0),
+                "failed": result.get("failed", 0),
+                "errors": result.get("errors", [])[:3],
+                "wall_seconds": (result.get("stage_timings") or {}).get("wall", {}).get("seconds"),
+            }
+            self._write()
+
+    def heartbeat(self, stop_event: threading.Event):
+        while not stop_event.wait(self.heartbeat_seconds):
+            with self.lock:
+                self._write()
+
+    def _write(self):
+        self.status["updated_at"] = datetime.now(timezone.utc).isoformat()
+        mail_state.write_daemon_status(self.status, worker=self.worker)
+
+
+def _buffered_input(imap) -> bool:
+    """True when imaplib's buffered reader already holds unread input.
+
+    select() only sees the socket, so a line that arrived in the same read as
+    an earlier one would otherwise wait for the next packet. The socket is
+    made non-blocking for the peek, which never waits for data.
+    """
+    sock = imap.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(imap.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _idle_wait(imap, timeout: float, stop_event: threading.Event) -> bool:
+    """IMAP IDLE (RFC 2177): blocks until the server announces new mail, the
+    timeout passes or a stop is requested. Returns True when mail arrived.
+
+    imaplib has no IDLE command before Python 3.14, so the exchange is done on
+    the raw connection. Readiness is polled once a second with select() so a
+    stop request is noticed quickly without putting the socket into a
+    timed-out state.
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+    line = imap.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line.strip()!r}")
+
+    new_mail = False
+    error = None
+    deadline = time.monotonic() + timeout
+    try:
+        while not new_mail and not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not _buffered_input(imap):
+                readable, _, _ = select.select([imap.sock], [], [], min(1.0, remaining))
+                if not readable:
+                    continue
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(b"* BYE"):
+                raise imaplib.IMAP4.abort(line.strip().decode(errors="replace"))
+            new_mail = b" EXISTS" in line.upper()
+    except BaseException as e:
+        error = e
+
+    # Leave IDLE in every case; when the wait itself failed, that error is
+    # the one reported, not a follow-up failure of the drain
+    try:
+        imap.send(b"DONE\r\n")
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+            if line.startswith(tag):
+                break
+            new_mail = new_mail or b" EXISTS" in line.upper()
+    except BaseException:
+        if error is None:
+            raise
+    if error is not None:
+        raise error
+    return new_mail
+
+
+def serve(ai_version: str = "gemini-flash-lite-latest", max_messages: Optional[int] = None,
+          stop_event: Optional[threading.Event] = None) -> None:
+    """Runs mail ingestion continuously on one persistent IMAP connection.
+
+    Waits with IDLE when the server supports it (MAIL_IDLE=true), otherwise
+    polls every MAIL_POLL_SECONDS. Lost connections are re-opened with
+    exponential backoff. SIGINT/SIGTERM finish the current pass, then exit.
+    """
+    configured, reason = is_mail_ingestion_configured()
+    if not configured:
+        raise SystemExit(f"Mail ingestion not configured: {reason}")
+
+    max_messages = max_messages or int(os.getenv("MAIL_MAX_MESSAGES_PER_POLL", "20"))
+    use_idle = _env_bool("MAIL_IDLE", True)
+    idle_seconds = float(os.getenv("MAIL_IDLE_SECONDS", "300"))
+    poll_seconds = float(os.getenv("MAIL_POLL_SECONDS", "60"))
+    backoff_min = float(os.getenv("MAIL_RECONNECT_MIN_SECONDS", "5"))
+    backoff_max = float(os.getenv("MAIL_RECONNECT_MAX_SECONDS", "300"))
+
+    stop_event = stop_event or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        def _request_stop(signum, frame):
+            print(f"🛑 Signal {signum} received, finishing the current pass...")
+            stop_event.set()
+            # A second signal stops immediately
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, _request_stop)
+        signal.signal(signal.SIGTERM, _request_stop)
+
+    status = _DaemonStatus(heartbeat_seconds=min(idle_seconds, poll_seconds, 60.0))
+    status.update(state="starting")
+    threading.Thread(target=status.heartbeat, args=(stop_event,), name="mail-daemon-heartbeat", daemon=True).start()
+
+    backoff = backoff_min
+    while not stop_event.is_set():
+        imap = None
+        try:
+            imap = _connect_imap()
+            idle_supported = use_idle and "IDLE" in imap.capabilities
+            status.update(state="connected", mode="idle" if idle_supported else "poll", last_error=None)
+            print(f"📬 Connected to {status.status['host']} ({'IDLE' if idle_supported else f'polling every {poll_seconds:.0f}s'})")
+            backoff = backoff_min
+
+            while not stop_event.is_set():
+                # Unsolicited responses pile up on a long-lived connection
+                imap.untagged_responses.clear()
+                status.update(state="running")
+                result = ingest_invoices_from_email(max_messages=max_messages, ai_version=ai_version, imap=imap)
+                status.record_run(result)
+                if result.get("messages_scanned") or result.get("retried"):
+                    print(
+                        f"📩 {result['status']}: scanned {result['messages_scanned']}, "
+                        f"ingested {result['ingested']}, duplicates {result['duplicates']}, failed {result['failed']}, "
+                        f"retried {result.get('retried', 0)}"
+                    )
+
+                # Raises if the run ended because the connection went away
+                imap.noop()
+                if result.get("messages_scanned", 0) >= max_messages:
+                    continue  # more mail waiting; keep going before waiting
+
+                # Wake up early when a retry entry falls due
+                retry_due_in = mail_retry.next_due_in()
+                retry_wait = max(1.0, retry_due_in) if retry_due_in is not None else float("inf")
+                if idle_supported:
+                    status.update(state="idle")
+                    _idle_wait(imap, min(idle_seconds, retry_wait), stop_event)
+                else:
+                    status.update(state="polling")
+                    stop_event.wait(min(poll_seconds, retry_wait))
+
+        except (imaplib.IMAP4.error, OSError) as ex:
+            if stop_event.is_set():
+                break
+            retry_at = datetime.now(timezone.utc).timestamp() + backoff
+            status.update(
+                state="reconnecting",
+                last_error=str(ex),
+                reconnects=status.status["reconnects"] + 1,
+                next_retry_at=datetime.fromtimestamp(retry_at, timezone.utc).isoformat(),
+            )
+            print(f"⚠️ IMAP connection problem: {ex}. Reconnecting in {backoff:.0f}s")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, backoff_max)
+        finally:
+            if imap:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+
+    status.update(state="stopped")
+    print("👋 Mail ingestion daemon stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Invoice ingestion from an IMAP mailbox.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run continuously (IMAP IDLE or polling)")
+    run_parser = subparsers.add_parser("run", help="Run a single pass and print the result")
+    retry_parser = subparsers.add_parser("retry", help="Resume due entries of the retry queue and print the result")
+    retry_parser.add_argument("--requeue-dead", action="store_true", help="Give dead letters a fresh set of attempts first")
+    retry_parser.add_argument("--ai-version", default=os.getenv("GEMINI_MODEL", "gemini-flash-lite-latest"))
+    subparsers.add_parser(
+        "supervise", add_help=False, help="One worker process per mailbox folder in MAIL_MAILBOXES_FILE (see mail_supervisor.py)"
+    )
+    for sub in (serve_parser, run_parser):
+        sub.add_argument("--max-messages", type=int, default=None)
+        sub.add_argument("--ai-version", default=os.getenv("GEMINI_MODEL", "gemini-flash-lite-latest"))
+    args, extra = parser.parse_known_args()
+
+    if args.command == "supervise":
+        import mail_supervisor
+        mail_supervisor.main(extra)
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    elif args.command == "retry":
+        if args.requeue_dead:
+            print(f"♻️ Re-queued {mail_retry.requeue_dead()} dead letter(s)")
+        print(json.dumps(process_retry_queue(ai_version=args.ai_version), indent=2, default=str))
+    elif args.command == "serve":
+        serve(ai_version=args.ai_version, max_messages=args.max_messages)
+    else:
+        max_messages = args.max_messages or int(os.getenv("MAIL_MAX_MESSAGES_PER_POLL", "20"))
+        print(json.dumps(ingest_invoices_from_email(max_messages, ai_version=args.ai_version), indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
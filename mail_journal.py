@@ -0,0 +1,198 @@
+"""Journal of what mail ingestion has already handled.
+
+    <MAIL_STATE_DIR>/journal.db   Message-IDs of handled mails and SHA-256s of
+                                  saved (or duplicate) attachments
+
+Both are asked before anything expensive happens: a known Message-ID skips
+the mail after a header-only fetch, a known attachment hash skips the
+database duplicate check and extraction. Lookups go through an in-memory
+Bloom filter first, so a key that was never seen (the common case) costs a
+few hash probes and no I/O; only a "maybe" is confirmed in the SQLite set,
+which makes false positives harmless. The newest MAIL_JOURNAL_SIZE entries
+are kept.
+
+The file is shared by supervised worker processes; each one adds the rows
+the others wrote to its filter before it looks anything up. Every function
+fails open: if the journal cannot be used, mail is simply downloaded and
+checked against the database as before.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from mail_state import state_dir
+
+MESSAGE_ID = "message_id"
+SHA256 = "sha256"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    UNIQUE (kind, key)
+);
+"""
+
+_journals: Dict[Path, "MailJournal"] = {}
+_journals_lock = threading.Lock()
+
+
+def journal_path() -> Path:
+    return state_dir() / "journal.db"
+
+
+def journal_limit() -> int:
+    return max(100, int(os.getenv("MAIL_JOURNAL_SIZE", "100000")))
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for capacity keys at error_rate false positives."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(64, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class MailJournal:
+    """Bloom filter in front of the on-disk set; use get_journal()."""
+
+    def __init__(self, path: Path, limit: int):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.conn = None
+        self.bloom = None
+        self.last_id = 0
+        self.entries = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.conn = conn
+            self._import_legacy_log()
+        return self.conn
+
+    def _import_legacy_log(self) -> None:
+        """Takes over the Message-IDs of the old message_ids.log once."""
+        legacy = self.path.with_name("message_ids.log")
+        try:
+            with open(legacy, encoding="utf-8") as fh:
+                message_ids = [line.strip() for line in fh if line.strip()]
+            self._insert(MESSAGE_ID, message_ids)
+            os.replace(legacy, legacy.with_name("message_ids.log.imported"))
+        except FileNotFoundError:
+            pass  # nothing to import, or another worker already did
+
+    def _insert(self, kind: str, keys) -> None:
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO journal (kind, key, recorded_at) VALUES (?, ?, ?)",
+            [(kind, key, now) for key in keys],
+        )
+
+    def _refresh(self) -> None:
+        """Adds rows written since the last look (by any process) to the filter;
+        rebuilds it once pruned keys have filled it up."""
+        conn = self._connection()
+        if self.bloom is None or self.bloom.count > self.bloom.capacity:
+            self.entries = conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+            self.bloom = BloomFilter(2 * max(self.limit, self.entries))
+            self.last_id = 0
+        for row_id, kind, key in conn.execute(
+            "SELECT id, kind, key FROM journal WHERE id > ? ORDER BY id", (self.last_id,)
+        ):
+            self.bloom.add(f"{kind}:{key}")
+            self.last_id = row_id
+            self.entries += 1
+
+    def __len__(self) -> int:
+        with self.lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"Mail Journal Error: {e}")
+            return self.entries
+
+    def contains(self, kind: str, key: Optional[str]) -> bool:
+        return bool(self.known(kind, [key]))
+
+    def known(self, kind: str, keys: Iterable[Optional[str]]) -> set:
+        """The keys that were recorded before; most are ruled out by the filter alone."""
+        with self.lock:
+            try:
+                self._refresh()
+                candidates = [key for key in dict.fromkeys(keys) if key and f"{kind}:{key}" in self.bloom]
+                found = set()
+                for start in range(0, len(candidates), 500):
+                    batch = candidates[start:start + 500]
+                    found.update(
+                        row[0] for row in self.conn.execute(
+                            f"SELECT key FROM journal WHERE kind = ? AND key IN ({','.join('?' * len(batch))})",
+                            [kind, *batch],
+                        )
+                    )
+                return found
+            except Exception as e:
+                print(f"Mail Journal Error: {e}")
+                return set()
+
+    def record(self, kind: str, keys: Iterable[Optional[str]]) -> None:
+        """Adds keys and drops the oldest entries beyond MAIL_JOURNAL_SIZE."""
+        keys = [key for key in dict.fromkeys(keys) if key]
+        if not keys:
+            return
+        with self.lock:
+            try:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._insert(kind, keys)
+                    conn.execute(
+                        "DELETE FROM journal WHERE id <= (SELECT MAX(id) FROM journal) - ?", (self.limit,)
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                self._refresh()
+                self.entries = min(self.entries, self.limit)
+            except Exception as e:
+                print(f"Mail Journal Error: {e}")
+
+
+def get_journal() -> MailJournal:
+    """The journal of the current MAIL_STATE_DIR, shared by every run in this process."""
+    path = journal_path()
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = MailJournal(path, journal_limit())
+        return _journals[path]
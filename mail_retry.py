@@ -0,0 +1,256 @@
+"""Durable retry queue for attachments that failed during mail ingestion.
+
+The mail is flagged \\Seen and checkpointed even when one of its attachments
+fails, so the attachment is kept here instead (SQLite at MAIL_RETRY_DB, the
+bytes under MAIL_RETRY_DIR) together with the stage it failed in:
+
+    extract   model or compliance failed       -> bytes kept, extraction redone
+    upload    storage failed                   -> bytes and extracted payload kept
+    save      database write failed            -> payload and file URL kept
+
+Every ingestion run (and `python -m mail_ingestion retry`) leases the entries
+that are due and feeds them back into the pipeline at that stage. Failures
+back off exponentially from MAIL_RETRY_BASE_SECONDS up to
+MAIL_RETRY_MAX_SECONDS; after MAIL_RETRY_MAX_ATTEMPTS an entry becomes a dead
+letter that stays until it is re-queued by hand.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from attachment_spool import SpooledAttachment
+
+STAGES = ("extract", "upload", "save")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS retry_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    document_hash TEXT NOT NULL UNIQUE,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    source TEXT,
+    uid TEXT,
+    filename TEXT,
+    mime_type TEXT,
+    file_path TEXT,
+    payload TEXT,
+    public_url TEXT,
+    routing TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_retry_items_due ON retry_items (status, next_attempt_at);
+"""
+
+_local = threading.local()
+
+
+def retry_db_path() -> Path:
+    return Path(os.getenv("MAIL_RETRY_DB", "local_data/mail_retry.db"))
+
+
+def retry_dir() -> Path:
+    return Path(os.getenv("MAIL_RETRY_DIR", "local_data/mail_retry"))
+
+
+def max_attempts() -> int:
+    return max(1, int(os.getenv("MAIL_RETRY_MAX_ATTEMPTS", "8")))
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before attempt attempts + 1: base, 2x base, 4x base, ... capped."""
+    base = float(os.getenv("MAIL_RETRY_BASE_SECONDS", "60"))
+    cap = float(os.getenv("MAIL_RETRY_MAX_SECONDS", "21600"))
+    return min(cap, base * (2 ** max(0, attempts - 1)))
+
+
+def _connection() -> sqlite3.Connection:
+    """One connection per thread and file, like the SQLite repository."""
+    path = retry_db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+
+def _store_file(document_hash: str, attachment: Dict) -> str:
+    """Copies the attachment bytes next to the queue once per document."""
+    path = retry_dir() / document_hash[:2] / f"{document_hash}.bin"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as out:
+            source = attachment["file"].open()
+            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                out.write(chunk)
+        os.replace(tmp_path, path)
+    return str(path)
+
+
+# --- QUEUE ---
+def enqueue(item: Dict, stage: str, error: str, source: Optional[str] = None) -> Optional[str]:
+    """Records a failed pipeline item (again). Returns "queued", "dead" (out of
+    attempts) or None when it could not be stored."""
+    document_hash = item.get("document_hash")
+    if not document_hash or stage not in STAGES:
+        return None
+    attachment = item.get("attachment")
+    try:
+        file_path = _store_file(document_hash, attachment) if attachment and stage != "save" else None
+        now = time.time()
+        conn = _connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT attempts FROM retry_items WHERE document_hash = ?", (document_hash,)
+            ).fetchone()
+            attempts = (row["attempts"] if row else 0) + 1
+            status = "dead" if attempts >= max_attempts() else "pending"
+            conn.execute(
+                """
+                INSERT INTO retry_items (document_hash, stage, status, source, uid, filename, mime_type, file_path,
+                                         payload, public_url, routing, attempts, last_error, next_attempt_at,
+                                         created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (document_hash) DO UPDATE SET
+                    stage = excluded.stage, status = excluded.status,
+                    file_path = COALESCE(excluded.file_path, retry_items.file_path),
+                    payload = COALESCE(excluded.payload, retry_items.payload),
+                    public_url = COALESCE(excluded.public_url, retry_items.public_url),
+                    attempts = excluded.attempts, last_error = excluded.last_error,
+                    next_attempt_at = excluded.next_attempt_at, updated_at = excluded.updated_at
+                """,
+                (
+                    document_hash, stage, status, source, item.get("uid"),
+                    (attachment or {}).get("filename") or item.get("filename"),
+                    (attachment or {}).get("mime_type") or item.get("mime_type"),
+                    file_path,
+                    json.dumps(item["payload"], default=str) if item.get("payload") else None,
+                    item.get("public_url"),
+                    json.dumps(item["routing"]) if item.get("routing") else None,
+                    attempts, error, now + backoff_seconds(attempts), now, now,
+                ),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return "dead" if status == "dead" else "queued"
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+        return None
+
+
+def lease_due(limit: int, lease_seconds: Optional[float] = None) -> List[Dict]:
+    """Takes up to limit due entries. Each is hidden for lease_seconds, so
+    other workers skip it; a failure reschedules it, complete() removes it."""
+    lease_seconds = lease_seconds or float(os.getenv("MAIL_RETRY_LEASE_SECONDS", "900"))
+    now = time.time()
+    leased = []
+    try:
+        conn = _connection()
+        rows = conn.execute(
+            "SELECT * FROM retry_items WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (now, limit),
+        ).fetchall()
+        for row in rows:
+            cursor = conn.execute(
+                "UPDATE retry_items SET next_attempt_at = ? WHERE id = ? AND next_attempt_at = ?",
+                (now + lease_seconds, row["id"], row["next_attempt_at"]),
+            )
+            if cursor.rowcount:
+                entry = dict(row)
+                entry["payload"] = json.loads(entry["payload"]) if entry["payload"] else None
+                entry["routing"] = json.loads(entry["routing"]) if entry["routing"] else None
+                leased.append(entry)
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+    return leased
+
+
+def load_attachment(entry: Dict) -> Dict:
+    """The stored bytes as a pipeline attachment (raises if they are gone)."""
+    spool = SpooledAttachment()
+    with open(entry["file_path"], "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            spool.write(chunk)
+    return {"filename": entry["filename"], "mime_type": entry["mime_type"], "file": spool, "routing": entry["routing"]}
+
+
+def complete(retry_id: int) -> None:
+    """Removes an entry that was saved (or turned out to be a duplicate)."""
+    try:
+        conn = _connection()
+        row = conn.execute("SELECT file_path FROM retry_items WHERE id = ?", (retry_id,)).fetchone()
+        conn.execute("DELETE FROM retry_items WHERE id = ?", (retry_id,))
+        if row and row["file_path"]:
+            Path(row["file_path"]).unlink(missing_ok=True)
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+
+
+def requeue_dead() -> int:
+    """Gives every dead letter a fresh set of attempts, due now."""
+    try:
+        cursor = _connection().execute(
+            "UPDATE retry_items SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = 'dead'",
+            (time.time(), time.time()),
+        )
+        return cursor.rowcount
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+        return 0
+
+
+# --- STATUS ---
+def next_due_in() -> Optional[float]:
+    """Seconds until the next pending entry is due (0 if overdue), None if the queue is empty."""
+    if not retry_db_path().exists():
+        return None
+    try:
+        row = _connection().execute(
+            "SELECT MIN(next_attempt_at) FROM retry_items WHERE status = 'pending'"
+        ).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+        return None
+
+
+def queue_stats() -> Dict:
+    """{"pending", "due", "dead", "by_stage": {stage: pending}, "last_error", "dead_error"} for the sidebar."""
+    stats = {"pending": 0, "due": 0, "dead": 0, "by_stage": {}, "last_error": None, "dead_error": None}
+    if not retry_db_path().exists():
+        return stats
+    try:
+        conn = _connection()
+        for row in conn.execute("SELECT status, stage, COUNT(*) AS n FROM retry_items GROUP BY status, stage"):
+            stats[row["status"]] = stats.get(row["status"], 0) + row["n"]
+            if row["status"] == "pending":
+                stats["by_stage"][row["stage"]] = row["n"]
+        stats["due"] = conn.execute(
+            "SELECT COUNT(*) FROM retry_items WHERE status = 'pending' AND next_attempt_at <= ?", (time.time(),)
+        ).fetchone()[0]
+        row = conn.execute("SELECT last_error FROM retry_items ORDER BY updated_at DESC LIMIT 1").fetchone()
+        stats["last_error"] = row["last_error"] if row else None
+        row = conn.execute(
+            "SELECT last_error FROM retry_items WHERE status = 'dead' ORDER BY updated_at DESC LIMIT 1"
+        ).fetchone()
+        stats["dead_error"] = row["last_error"] if row else None
+    except Exception as e:
+        print(f"Mail Retry Queue Error: {e}")
+    return stats
@@ -0,0 +1,247 @@
+"""Mailbox rules, compiled once per ingestion run.
+
+MAIL_RULES_FILE (default mail_rules.json, see mail_rules.example.json):
+
+    {"rules": [
+        {"name": "newsletters", "senders": ["*@news.example.com"], "action": "skip"},
+        {"name": "acme", "senders": ["*@acme.com", "*@*.acme.com"], "subject": ["invoice", "re:^bill\\\\b"],
+         "tags": {"vendor": "ACME Corp", "priority": "high"},
+         "attachments": {"mime_types": ["application/pdf"], "max_size_mb": 40}}
+    ]}
+
+Rules are tried in file order and the first one whose conditions all match
+decides: "accept" (default) or "skip". Accepted mail carries the rule's
+routing tags and attachment overrides. Mail that no rule matches goes
+through MAIL_ALLOWED_SENDERS and MAIL_SUBJECT_KEYWORDS as before.
+
+Sender patterns: an exact address, a glob ("*@acme.com", "*@*.acme.com",
+"billing-*@acme.com"), "@acme.com" for the whole domain, or "re:<regex>".
+Subject patterns: a keyword (case-insensitive substring) or "re:<regex>".
+Exact addresses and domains are looked up in dicts, so only rules that
+can match a sender are tried.
+"""
+import fnmatch
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RULE_FIELDS = {"name", "senders", "subject", "action", "tags", "attachments", "description"}
+ATTACHMENT_FIELDS = {"mime_types", "extensions", "max_size_mb"}
+ACTIONS = {"accept", "skip"}
+LEGACY_SENDERS_RULE = "MAIL_ALLOWED_SENDERS"
+LEGACY_SUBJECT_RULE = "MAIL_SUBJECT_KEYWORDS"
+
+ACCEPT = {"action": "accept", "rule": None, "tags": {}, "attachments": None}
+
+
+class MailRuleError(ValueError):
+    pass
+
+
+def rules_path() -> Path:
+    return Path(os.getenv("MAIL_RULES_FILE", "mail_rules.json"))
+
+
+def _as_list(value) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(",") if "," in value and not value.startswith("re:") else [value]
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def _compile_regex(pattern: str, where: str):
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise MailRuleError(f"{where}: invalid regex {pattern!r} ({e})")
+
+
+class _SenderMatcher:
+    """Exact addresses, whole domains, subdomains and one combined regex."""
+
+    def __init__(self, patterns: List[str], where: str):
+        self.addresses, self.domains, self.parent_domains = set(), set(), set()
+        globs, regexes = [], []
+        for pattern in patterns:
+            if pattern.startswith("re:"):
+                _compile_regex(pattern[3:], where)
+                regexes.append(pattern[3:])
+                continue
+            pattern = pattern.lower()
+            domain = pattern[1:] if pattern.startswith("@") else pattern[2:] if pattern.startswith("*@") else None
+            if domain is not None and domain.startswith("*.") and not re.search(r"[*?\[]", domain[2:]):
+                self.parent_domains.add(domain[2:])
+            elif domain is not None and not re.search(r"[*?\[]", domain):
+                self.domains.add(domain)
+            elif re.search(r"[*?\[]", pattern):
+                globs.append(fnmatch.translate(pattern))
+            else:
+                self.addresses.add(pattern)
+        # Globs must match the whole address, user regexes anywhere in it
+        combined = [f"(?:{glob})" for glob in globs] + [f"(?:.*?(?:{regex}))" for regex in regexes]
+        self.regex = _compile_regex("|".join(combined), where) if combined else None
+
+    @property
+    def indexable(self) -> bool:
+        return self.regex is None
+
+    def matches(self, address: str, domain: str) -> bool:
+        if address in self.addresses or domain in self.domains:
+            return True
+        if self.parent_domains and any(parent in self.parent_domains for parent in _parent_domains(domain)):
+            return True
+        return bool(self.regex and self.regex.match(address))
+
+
+class _SubjectMatcher:
+    """Keywords and regexes folded into one pattern, searched in the lower-cased subject."""
+
+    def __init__(self, patterns: List[str], where: str):
+        parts = [pattern[3:] if pattern.startswith("re:") else re.escape(pattern.lower()) for pattern in patterns]
+        for pattern in patterns:
+            if pattern.startswith("re:"):
+                _compile_regex(pattern[3:], where)
+        self.regex = _compile_regex("|".join(f"(?:{part})" for part in parts), where) if parts else None
+
+    def matches(self, subject_lower: str) -> bool:
+        return self.regex is None or bool(self.regex.search(subject_lower))
+
+
+def _parent_domains(domain: str):
+    """"a.b.acme.com" -> "b.acme.com", "acme.com", "com"."""
+    position = domain.find(".")
+    while position != -1:
+        yield domain[position + 1:]
+        position = domain.find(".", position + 1)
+
+
+def _attachment_policy(spec, where: str) -> Optional[Dict]:
+    """Per-rule overrides: mime_types / extensions replace the built-in lists
+    (together), max_size_mb replaces MAIL_MAX_ATTACHMENT_SIZE_MB."""
+    if not spec:
+        return None
+    if not isinstance(spec, dict) or set(spec) - ATTACHMENT_FIELDS:
+        raise MailRuleError(f"{where}: attachments accepts {', '.join(sorted(ATTACHMENT_FIELDS))}")
+    policy = {"mime_types": None, "extensions": None, "max_size_bytes": None}
+    if "mime_types" in spec or "extensions" in spec:
+        policy["mime_types"] = {mime.lower() for mime in _as_list(spec.get("mime_types"))}
+        policy["extensions"] = tuple(
+            ext.lower() if ext.startswith(".") else f".{ext.lower()}" for ext in _as_list(spec.get("extensions"))
+        )
+    if spec.get("max_size_mb") is not None:
+        policy["max_size_bytes"] = int(float(spec["max_size_mb"]) * 1024 * 1024)
+    return policy
+
+
+class _Rule:
+    def __init__(self, spec: Dict, position: int):
+        if not isinstance(spec, dict):
+            raise MailRuleError(f"rule {position}: expected an object")
+        self.name = str(spec.get("name") or f"rule{position}")
+        where = f"rule '{self.name}'"
+        unknown = set(spec) - RULE_FIELDS
+        if unknown:
+            raise MailRuleError(f"{where}: unknown field(s) {', '.join(sorted(unknown))}")
+        self.action = str(spec.get("action", "accept")).lower()
+        if self.action not in ACTIONS:
+            raise MailRuleError(f"{where}: action must be one of {', '.join(sorted(ACTIONS))}")
+        self.position = position
+        senders = _as_list(spec.get("senders"))
+        self.senders = _SenderMatcher(senders, where) if senders else None
+        self.subject = _SubjectMatcher(_as_list(spec.get("subject")), where)
+        self.decision = {
+            "action": self.action,
+            "rule": self.name,
+            "tags": {str(key): str(value) for key, value in (spec.get("tags") or {}).items()},
+            "attachments": _attachment_policy(spec.get("attachments"), where),
+        }
+
+    def matches(self, address: str, domain: str, subject_lower: str) -> bool:
+        if self.senders and not self.senders.matches(address, domain):
+            return False
+        return self.subject.matches(subject_lower)
+
+
+class MailRuleSet:
+    """evaluate(sender, subject) -> {"action", "rule", "tags", "attachments"}.
+
+    Rules whose senders are only addresses and domains are indexed by them;
+    the others (regexes, globs, no sender condition) are tried for every mail.
+    """
+
+    def __init__(self, rule_specs: List[Dict], allowed_senders: List[str], subject_keywords: List[str]):
+        self.rules = [_Rule(spec, position) for position, spec in enumerate(rule_specs, start=1)]
+        names = [rule.name for rule in self.rules]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise MailRuleError(f"duplicate rule name(s): {', '.join(duplicates)}")
+
+        self.by_address: Dict[str, List[_Rule]] = {}
+        self.by_domain: Dict[str, List[_Rule]] = {}
+        self.by_parent_domain: Dict[str, List[_Rule]] = {}
+        self.unindexed: List[_Rule] = []
+        for rule in self.rules:
+            if rule.senders is None or not rule.senders.indexable:
+                self.unindexed.append(rule)
+                continue
+            for address in rule.senders.addresses:
+                self.by_address.setdefault(address, []).append(rule)
+            for domain in rule.senders.domains:
+                self.by_domain.setdefault(domain, []).append(rule)
+            for domain in rule.senders.parent_domains:
+                self.by_parent_domain.setdefault(domain, []).append(rule)
+
+        self.allowed_senders = _SenderMatcher(allowed_senders, LEGACY_SENDERS_RULE) if allowed_senders else None
+        self.subject_keywords = _SubjectMatcher(subject_keywords, LEGACY_SUBJECT_RULE) if subject_keywords else None
+        self.legacy_skip = {
+            LEGACY_SENDERS_RULE: {**ACCEPT, "action": "skip", "rule": LEGACY_SENDERS_RULE},
+            LEGACY_SUBJECT_RULE: {**ACCEPT, "action": "skip", "rule": LEGACY_SUBJECT_RULE},
+        }
+
+    def _candidates(self, address: str, domain: str) -> List[_Rule]:
+        candidates = self.by_address.get(address, []) + self.by_domain.get(domain, [])
+        if self.by_parent_domain:
+            for parent in _parent_domains(domain):
+                candidates += self.by_parent_domain.get(parent, [])
+        if not candidates:
+            return self.unindexed
+        return sorted(set(candidates + self.unindexed), key=lambda rule: rule.position)
+
+    def evaluate(self, sender: str, subject: str) -> Dict:
+        address = (sender or "").strip().lower()
+        domain = address.rpartition("@")[2]
+        subject_lower = (subject or "").lower()
+
+        for rule in self._candidates(address, domain):
+            if rule.matches(address, domain, subject_lower):
+                return rule.decision
+
+        if self.allowed_senders and not self.allowed_senders.matches(address, domain):
+            return self.legacy_skip[LEGACY_SENDERS_RULE]
+        if self.subject_keywords and not self.subject_keywords.matches(subject_lower):
+            return self.legacy_skip[LEGACY_SUBJECT_RULE]
+        return ACCEPT
+
+
+def load_rules(path: Optional[Path] = None) -> MailRuleSet:
+    """Compiles MAIL_RULES_FILE (if present) plus the MAIL_ALLOWED_SENDERS /
+    MAIL_SUBJECT_KEYWORDS filters. Raises MailRuleError for an unusable file."""
+    path = Path(path) if path else rules_path()
+    rule_specs = []
+    if path.exists():
+        try:
+            config = json.loads(path.read_text(encoding="utf-8"))
+        except json.JSONDecodeError as e:
+            raise MailRuleError(f"{path}: invalid JSON ({e})")
+        rule_specs = config.get("rules", []) if isinstance(config, dict) else config
+        if not isinstance(rule_specs, list):
+            raise MailRuleError(f"{path}: \"rules\" must be a list")
+
+    return MailRuleSet(
+        rule_specs,
+        allowed_senders=_as_list(os.getenv("MAIL_ALLOWED_SENDERS", "").strip() or None),
+        subject_keywords=_as_list(os.getenv("MAIL_SUBJECT_KEYWORDS", "").strip() or None),
+    )
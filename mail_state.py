@@ -0,0 +1,152 @@
+"""Persistent state for incremental mailbox ingestion.
+
+    <MAIL_STATE_DIR>/checkpoints.json   highest handled UID per mailbox
+    <MAIL_STATE_DIR>/daemon_status.json health of `python -m mail_ingestion serve`
+                                        (daemon_status.<worker>.json per supervised mailbox)
+
+A checkpoint is keyed by host, user and folder and is only valid for the
+UIDVALIDITY it was taken under; when the server renumbers the folder the
+checkpoint starts over and the Message-ID journal (mail_journal.py) keeps
+already handled mails from being processed again.
+"""
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+_state_lock = threading.Lock()
+
+
+def state_dir() -> Path:
+    return Path(os.getenv("MAIL_STATE_DIR", "local_data/mail_state"))
+
+
+def mailbox_key(host: str, user: str, folder: str) -> str:
+    return f"{(host or '').lower()}|{(user or '').lower()}|{folder or 'INBOX'}"
+
+
+def _checkpoints_path() -> Path:
+    return state_dir() / "checkpoints.json"
+
+
+@contextmanager
+def _file_lock(name: str):
+    """Thread lock plus an exclusive flock, so supervised worker processes
+    do not overwrite each other's read-modify-write updates."""
+    with _state_lock:
+        if fcntl is None:
+            yield
+            return
+        path = state_dir() / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _read_checkpoints() -> dict:
+    try:
+        return json.loads(_checkpoints_path().read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Mail Checkpoint Error: {e}")
+        return {}
+
+
+# --- CHECKPOINTS ---
+def load_checkpoint(host: str, user: str, folder: str, uidvalidity: Optional[str]) -> int:
+    """Highest handled UID of this mailbox, or 0 when there is none for this UIDVALIDITY."""
+    if not uidvalidity:
+        return 0
+    entry = _read_checkpoints().get(mailbox_key(host, user, folder)) or {}
+    if str(entry.get("uidvalidity")) != str(uidvalidity):
+        return 0
+    return int(entry.get("last_uid") or 0)
+
+
+def save_checkpoint(host: str, user: str, folder: str, uidvalidity: Optional[str], last_uid: int) -> bool:
+    """Stores the highest handled UID (temp file + rename, so a crash never leaves half a file)."""
+    if not uidvalidity:
+        return False
+    try:
+        with _file_lock("checkpoints.lock"):
+            checkpoints = _read_checkpoints()
+            checkpoints[mailbox_key(host, user, folder)] = {
+                "uidvalidity": str(uidvalidity),
+                "last_uid": int(last_uid),
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+            path = _checkpoints_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(checkpoints, indent=2), encoding="utf-8")
+            os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        print(f"Mail Checkpoint Error: {e}")
+        return False
+
+
+# --- DAEMON STATUS ---
+def _status_path(worker: Optional[str] = None) -> Path:
+    if not worker:
+        return state_dir() / "daemon_status.json"
+    return state_dir() / f"daemon_status.{re.sub(r'[^A-Za-z0-9_.-]', '_', worker)}.json"
+
+
+def write_daemon_status(status: dict, worker: Optional[str] = None) -> None:
+    """Replaces a daemon status file (temp file + rename, readers never see half of it).
+    worker: name of a supervised mailbox worker; None for the single daemon."""
+    try:
+        path = _status_path(worker)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(status, indent=2, default=str), encoding="utf-8")
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Mail Daemon Status Error: {e}")
+
+
+def read_daemon_status(worker: Optional[str] = None, path: Optional[Path] = None) -> Optional[dict]:
+    """The last status written by the daemon, with "stale" set when its
+    heartbeat is overdue (daemon hung or killed), or None if it never ran."""
+    try:
+        status = json.loads((path or _status_path(worker)).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Mail Daemon Status Error: {e}")
+        return None
+
+    try:
+        updated_at = datetime.fromisoformat(status.get("updated_at"))
+        age = (datetime.now(timezone.utc) - updated_at).total_seconds()
+    except (TypeError, ValueError):
+        age = None
+    status["age_seconds"] = age
+    allowed = 3 * float(status.get("heartbeat_seconds") or 60) + 30
+    status["stale"] = status.get("state") != "stopped" and (age is None or age > allowed)
+    return status
+
+
+def list_daemon_statuses() -> List[dict]:
+    """Statuses of the single daemon and every supervised mailbox worker."""
+    statuses = []
+    for path in sorted(state_dir().glob("daemon_status*.json")):
+        status = read_daemon_status(path=path)
+        if status:
+            statuses.append(status)
+    return statuses
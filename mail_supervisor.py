@@ -0,0 +1,231 @@
+"""Mail ingestion for several mailboxes at once: one worker process per mailbox folder.
+
+The registry (MAIL_MAILBOXES_FILE, default mailboxes.json) lists the accounts;
+see mailboxes.example.json:
+
+    {"mailboxes": [
+        {"name": "emea", "host": "imap.example.com", "user": "ap-emea@example.com",
+         "password_env": "IMAP_PASSWORD_EMEA", "folders": ["INBOX", "Shared/Invoices"],
+         "env": {"MAIL_ALLOWED_SENDERS": "billing@vendor.com"}}
+    ]}
+
+Each (mailbox, folder) becomes a process with its own IMAP connection and
+ingestion pipeline, configured by turning the entry into IMAP_* / MAIL_*
+variables for that process only. Workers still share the UID checkpoints and
+Message-ID journal (MAIL_STATE_DIR) plus duplicate claims and Gemini key
+quotas (SHARED_STATE_DB). Without a registry file the IMAP_* settings from
+.env form the only worker.
+
+    python -m mail_ingestion supervise          # run every folder continuously
+    python -m mail_ingestion supervise --once   # one pass per folder, results per mailbox
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RESULT_COUNTERS = ("messages_scanned", "attachments_found", "ingested", "duplicates", "failed")
+
+
+def registry_path() -> Path:
+    return Path(os.getenv("MAIL_MAILBOXES_FILE", "mailboxes.json"))
+
+
+def _env_worker() -> Dict:
+    folder = (os.getenv("IMAP_FOLDER", "INBOX") or "INBOX").strip()
+    return {"name": f"default/{folder}", "env": {"MAIL_WORKER_NAME": f"default/{folder}"}}
+
+
+def load_mailbox_registry(path: Optional[Path] = None) -> List[Dict]:
+    """Worker specs [{"name": "emea/INBOX", "env": {...}}], one per mailbox folder.
+    Raises ValueError for an unusable registry."""
+    path = Path(path) if path else registry_path()
+    if not path.exists():
+        return [_env_worker()]
+
+    try:
+        registry = json.loads(path.read_text(encoding="utf-8"))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{path}: invalid JSON ({e})")
+
+    workers = []
+    for position, entry in enumerate(registry.get("mailboxes", []), start=1):
+        name = entry.get("name") or f"mailbox{position}"
+        missing = [field for field in ("host", "user") if not entry.get(field)]
+        if missing:
+            raise ValueError(f"{path}: mailbox '{name}' is missing {', '.join(missing)}")
+        password = os.getenv(entry["password_env"], "") if entry.get("password_env") else entry.get("password", "")
+        if not password:
+            raise ValueError(f"{path}: no password for mailbox '{name}' (set {entry.get('password_env') or 'password'})")
+
+        for folder in entry.get("folders") or ["INBOX"]:
+            worker_name = f"{name}/{folder}"
+            env = {key: str(value) for key, value in (entry.get("env") or {}).items()}
+            env.update({
+                "IMAP_HOST": entry["host"],
+                "IMAP_PORT": str(entry.get("port", 993)),
+                "IMAP_USER": entry["user"],
+                "IMAP_PASSWORD": password,
+                "IMAP_FOLDER": folder,
+                "MAIL_WORKER_NAME": worker_name,
+            })
+            workers.append({"name": worker_name, "env": env})
+
+    if not workers:
+        raise ValueError(f"{path}: no mailboxes configured")
+    names = [worker["name"] for worker in workers]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: duplicate mailbox folders: {', '.join(duplicates)}")
+    return workers
+
+
+# --- WORKER PROCESSES ---
+def _ingest_once(worker: Dict, ai_version: str, max_messages: int) -> Dict:
+    """Child process: a single ingestion pass for one mailbox folder.
+
+    Pool processes can run several mailboxes one after another, so the
+    mailbox's overrides are undone afterwards instead of leaking into the next.
+    """
+    saved_env = dict(os.environ)
+    os.environ.update(worker["env"])
+    try:
+        import mail_ingestion
+        return mail_ingestion.ingest_invoices_from_email(max_messages=max_messages, ai_version=ai_version)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+def _serve(worker: Dict, ai_version: str, max_messages: int) -> None:
+    """Child process: the IDLE/polling daemon for one mailbox folder."""
+    os.environ.update(worker["env"])
+    import mail_ingestion
+    mail_ingestion.serve(ai_version=ai_version, max_messages=max_messages)
+
+
+def _spawn_context():
+    # Fresh interpreters: no inherited threads, locks or SQLite connections
+    return multiprocessing.get_context("spawn")
+
+
+def run_once(workers: List[Dict], ai_version: str, max_messages: int, processes: Optional[int] = None) -> Dict:
+    """One pass over every mailbox folder in parallel.
+    Returns {"mailboxes": {name: result}, "totals": {...}}."""
+    processes = processes or min(len(workers), os.cpu_count() or 1)
+    report = {"mailboxes": {}, "totals": {key: 0 for key in RESULT_COUNTERS}}
+    pool_options = {"max_workers": max(1, processes), "mp_context": _spawn_context()}
+    if sys.version_info >= (3, 11):
+        # A fresh interpreter per mailbox: nothing read from one mailbox's
+        # environment (settings, caches, connections) carries over
+        pool_options["max_tasks_per_child"] = 1
+    with ProcessPoolExecutor(**pool_options) as pool:
+        futures = {worker["name"]: pool.submit(_ingest_once, worker, ai_version, max_messages) for worker in workers}
+        for name, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "FAILED", "errors": [f"Worker crashed: {e}"]}
+            report["mailboxes"][name] = result
+            for key in RESULT_COUNTERS:
+                report["totals"][key] += result.get(key, 0)
+    return report
+
+
+def supervise(workers: List[Dict], ai_version: str, max_messages: int) -> None:
+    """Keeps one daemon process per mailbox folder alive until SIGINT/SIGTERM.
+
+    A worker that exits is restarted after a backoff that doubles up to
+    MAIL_RECONNECT_MAX_SECONDS (reset once it stayed up for a minute). On
+    shutdown every worker gets SIGTERM and finishes its current pass.
+    """
+    context = _spawn_context()
+    backoff_min = float(os.getenv("MAIL_RECONNECT_MIN_SECONDS", "5"))
+    backoff_max = float(os.getenv("MAIL_RECONNECT_MAX_SECONDS", "300"))
+    stop_timeout = float(os.getenv("MAIL_SUPERVISOR_STOP_SECONDS", "120"))
+    stopping = {"flag": False}
+
+    def _request_stop(signum, frame):
+        print(f"🛑 Signal {signum} received, stopping {len(workers)} mailbox worker(s)...")
+        stopping["flag"] = True
+    signal.signal(signal.SIGINT, _request_stop)
+    signal.signal(signal.SIGTERM, _request_stop)
+
+    slots = {worker["name"]: {"worker": worker, "process": None, "started": 0.0, "backoff": backoff_min, "restart_at": 0.0}
+             for worker in workers}
+
+    def _start(slot):
+        process = context.Process(
+            target=_serve, args=(slot["worker"], ai_version, max_messages), name=f"mail-{slot['worker']['name']}"
+        )
+        process.start()
+        slot.update(process=process, started=time.monotonic())
+        print(f"▶️ {slot['worker']['name']}: worker pid {process.pid}")
+
+    for slot in slots.values():
+        _start(slot)
+
+    while not stopping["flag"]:
+        time.sleep(1.0)
+        now = time.monotonic()
+        for name, slot in slots.items():
+            process = slot["process"]
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                # Just exited: schedule a restart
+                if now - slot["started"] > 60:
+                    slot["backoff"] = backoff_min
+                print(f"⚠️ {name}: worker exited with code {process.exitcode}, restarting in {slot['backoff']:.0f}s")
+                slot.update(process=None, restart_at=now + slot["backoff"])
+                slot["backoff"] = min(slot["backoff"] * 2, backoff_max)
+            elif now >= slot["restart_at"] and not stopping["flag"]:
+                _start(slot)
+
+    running = [slot["process"] for slot in slots.values() if slot["process"] is not None]
+    for process in running:
+        if process.is_alive():
+            process.terminate()  # SIGTERM: the worker finishes its pass
+    deadline = time.monotonic() + stop_timeout
+    for process in running:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"⚠️ {process.name} did not stop in time, killing it")
+            process.kill()
+            process.join()
+    print("👋 Mail supervisor stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m mail_ingestion supervise",
+        description="Ingest invoices from every mailbox folder in the registry, one process each.",
+    )
+    parser.add_argument("--registry", default=None, help="Mailbox registry JSON (default: MAIL_MAILBOXES_FILE or mailboxes.json)")
+    parser.add_argument("--once", action="store_true", help="Run one pass per folder and print the results")
+    parser.add_argument("--processes", type=int, default=None, help="Parallel workers for --once (default: CPU count)")
+    parser.add_argument("--max-messages", type=int, default=None)
+    parser.add_argument("--ai-version", default=os.getenv("GEMINI_MODEL", "gemini-flash-lite-latest"))
+    args = parser.parse_args(argv)
+
+    try:
+        workers = load_mailbox_registry(args.registry)
+    except ValueError as e:
+        raise SystemExit(f"❌ Mailbox registry: {e}")
+    max_messages = args.max_messages or int(os.getenv("MAIL_MAX_MESSAGES_PER_POLL", "20"))
+
+    if args.once:
+        report = run_once(workers, args.ai_version, max_messages, processes=args.processes)
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        supervise(workers, args.ai_version, max_messages)
+
+
+if __name__ == "__main__":
+    main()
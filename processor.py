@@ -1,8 +1,8 @@
 import os
-import google.generativeai as genai
 import json
 import copy
 import hashlib
+import threading
 import time
 from datetime import datetime
 from dotenv import load_dotenv
@@ -12,27 +12,139 @@ load_dotenv()
 # Gemini model (override via GEMINI_MODEL in .env)
 model_name = os.environ.get("GEMINI_MODEL", "gemini-flash-lite-latest")
 
-# Round-robin API key management
-API_KEYS = []
-for i in range(1, 10):  # Support up to 9 API keys
-    key = os.environ.get(f"GOOGLE_API_KEY_{i}" if i > 1 else "GOOGLE_API_KEY")
-    if key:
-        API_KEYS.append(key)
+# Round-robin API key management.
+# Keys and the Gemini SDK are loaded on first use, so importing this module
+# (e.g. for a read-only dashboard) costs nothing and never raises.
+_api_keys = None
+_genai = None
+_init_lock = threading.Lock()
 
-if not API_KEYS:
-    raise ValueError("❌ No GOOGLE_API_KEY found in .env file. Add GOOGLE_API_KEY, GOOGLE_API_KEY_2, etc.")
 
-print(f"🔑 Loaded {len(API_KEYS)} API key(s) for round-robin scheduling")
+def get_api_keys():
+    """Returns the configured GOOGLE_API_KEY[_N] values, read once and cached"""
+    global _api_keys
+    if _api_keys is None:
+        with _init_lock:
+            if _api_keys is None:
+                keys = []
+                for i in range(1, 10):  # Support up to 9 API keys
+                    key = os.environ.get(f"GOOGLE_API_KEY_{i}" if i > 1 else "GOOGLE_API_KEY")
+                    if key:
+                        keys.append(key)
+                if keys:
+                    print(f"🔑 Loaded {len(keys)} API key(s) for round-robin scheduling")
+                _api_keys = keys
+    return _api_keys
+
+
+def _get_genai():
+    """Imports google.generativeai on first extraction"""
+    global _genai
+    if _genai is None:
+        with _init_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                _genai = genai
+    return _genai
+
 
 # Track current API key index and failed keys
 current_key_index = 0
 failed_keys = set()  # Track keys that hit quota
 last_reset_date = datetime.utcnow().date()  # Track when keys were last reset
+# Guards the key rotation state; extractions may run on several threads
+_key_lock = threading.Lock()
+_thread_state = threading.local()
 
 # In-memory cache for processed invoices
 CACHE = {}
 
+
+def get_last_processing_error():
+    """Why the last process_invoice call on this thread returned None (or None)"""
+    return getattr(_thread_state, "last_error", None)
+
+
+def _next_api_key(api_keys):
+    """Picks the next key that has not hit its quota; returns (index, key) or (None, None).
+
+    Quotas are shared with other ingestion processes (shared_limits): keys
+    another process saw exhausted today are skipped, and with
+    GEMINI_RPM_PER_KEY set this waits until some key has a free slot.
+    """
+    global current_key_index
+    import shared_limits
+
+    per_minute = int(os.environ.get("GEMINI_RPM_PER_KEY", "0"))
+    today = datetime.utcnow().date().isoformat()
+    while True:
+        shared_exhausted = shared_limits.exhausted_key_ids(today)
+        wait = None
+        with _key_lock:
+            for _ in range(len(api_keys)):
+                index = current_key_index % len(api_keys)
+                current_key_index = (index + 1) % len(api_keys)
+                key_id = shared_limits.key_id(api_keys[index])
+                if index in failed_keys or key_id in shared_exhausted:
+                    continue
+                if per_minute <= 0:
+                    return index, api_keys[index]
+                delay = shared_limits.acquire_call_slot(key_id, per_minute)
+                if delay <= 0:
+                    return index, api_keys[index]
+                wait = delay if wait is None else min(wait, delay)
+        if wait is None:
+            return None, None  # every key hit its daily quota
+        time.sleep(min(wait, 5.0))
+
+
+_models_by_key = {}
+
+
+class _KeyedModel:
+    """A Gemini model bound to one API key through its own client.
+
+    genai.configure() is process-wide, so parallel extractions would swap keys
+    under each other. Each key instead gets a GenerativeServiceClient with the
+    key in its client_options; requests and responses use the SDK's public
+    protos/types helpers, so .text and the "429 ..." quota errors behave as
+    with genai.GenerativeModel. Written against google-generativeai 0.8.x
+    (google-ai-generativelanguage 0.6.x).
+    """
+
+    def __init__(self, genai, api_key, name):
+        from google.ai import generativelanguage
+        from google.generativeai.types import content_types
+
+        self._genai = genai
+        self._to_contents = content_types.to_contents
+        self._client = generativelanguage.GenerativeServiceClient(client_options={"api_key": api_key})
+        self.model_name = name if "/" in name else f"models/{name}"
+
+    def generate_content(self, contents):
+        request = self._genai.protos.GenerateContentRequest(
+            model=self.model_name, contents=self._to_contents(contents)
+        )
+        if request.contents and not request.contents[-1].role:
+            request.contents[-1].role = "user"
+        response = self._client.generate_content(request)
+        return self._genai.types.GenerateContentResponse.from_response(response)
+
+
+def _model_for_key(genai, api_key):
+    """One model per API key and model name, created once and shared by threads"""
+    model = _models_by_key.get((api_key, model_name))
+    if model is None:
+        with _key_lock:
+            model = _models_by_key.get((api_key, model_name))
+            if model is None:
+                model = _KeyedModel(genai, api_key, model_name)
+                _models_by_key[(api_key, model_name)] = model
+    return model
+
+
 def process_invoice(file_bytes, mime_type):
+    _thread_state.last_error = None
     # Generate hash for caching
     file_hash = hashlib.md5(file_bytes).hexdigest()
     
@@ -79,68 +191,69 @@ def process_invoice(file_bytes, mime_type):
     
     content = [prompt, {"mime_type": mime_type, "data": file_bytes}]
     
+    api_keys = get_api_keys()
+    if not api_keys:
+        raise ValueError("❌ No GOOGLE_API_KEY found in .env file. Add GOOGLE_API_KEY, GOOGLE_API_KEY_2, etc.")
+    genai = _get_genai()
+
     # ✅ DAILY RESET: Check if day changed and reset quota
-    global current_key_index, failed_keys, last_reset_date
+    global current_key_index, last_reset_date
     today = datetime.utcnow().date()
-    if today != last_reset_date:
-        print(f"🌅 New day detected (was {last_reset_date}, now {today}) — resetting API key usage")
-        failed_keys.clear()
-        current_key_index = 0
-        last_reset_date = today
-        print(f"✅ API key quota reset. Starting fresh from Key #1")
+    with _key_lock:
+        if today != last_reset_date:
+            print(f"🌅 New day detected (was {last_reset_date}, now {today}) — resetting API key usage")
+            failed_keys.clear()
+            current_key_index = 0
+            last_reset_date = today
+            print(f"✅ API key quota reset. Starting fresh from Key #1")
     
     # Round-robin retry logic across multiple API keys
     response = None
     attempts_per_key = int(os.environ.get("GEMINI_ATTEMPTS_PER_KEY", "1"))  # Keep low for faster demo runs
     
     # Try all available API keys
-    for key_attempt in range(len(API_KEYS)):
-        # Skip keys that already failed
-        if current_key_index in failed_keys:
-            current_key_index = (current_key_index + 1) % len(API_KEYS)
-            continue
-        
-        current_api_key = API_KEYS[current_key_index]
-        print(f"🔑 Using API key #{current_key_index + 1}/{len(API_KEYS)}")
+    for key_attempt in range(len(api_keys)):
+        key_index, current_api_key = _next_api_key(api_keys)
+        if current_api_key is None:
+            break  # every key hit its quota
+        print(f"🔑 Using API key #{key_index + 1}/{len(api_keys)}")
         
-        # Configure with current API key
-        genai.configure(api_key=current_api_key)
-        model = genai.GenerativeModel(model_name)
+        model = _model_for_key(genai, current_api_key)
         
         # Try current key with retries
         for attempt in range(attempts_per_key):
             try:
                 response = model.generate_content(content)
-                print(f"✅ Success with API key #{current_key_index + 1}")
-                # Successful, move to next key for next request (round-robin)
-                current_key_index = (current_key_index + 1) % len(API_KEYS)
+                print(f"✅ Success with API key #{key_index + 1}")
                 break  # Success, exit retry loop
             except Exception as e:
                 error_str = str(e)
-                print(f"⚠️ API key #{current_key_index + 1}, attempt {attempt + 1}/{attempts_per_key}: {error_str[:100]}")
+                print(f"⚠️ API key #{key_index + 1}, attempt {attempt + 1}/{attempts_per_key}: {error_str[:100]}")
                 
                 if "429" in error_str:
                     # Quota exceeded for this key
-                    print(f"❌ API key #{current_key_index + 1} quota exceeded. Trying next key...")
-                    failed_keys.add(current_key_index)
+                    print(f"❌ API key #{key_index + 1} quota exceeded. Trying next key...")
+                    with _key_lock:
+                        failed_keys.add(key_index)
+                    import shared_limits
+                    shared_limits.mark_key_exhausted(
+                        shared_limits.key_id(current_api_key), datetime.utcnow().date().isoformat()
+                    )
                     break  # Move to next key
                 elif attempt < attempts_per_key - 1:
                     # Transient error, retry same key
                     time.sleep(2)
                 else:
                     # Non-quota error on last attempt
-                    print(f"❌ Non-retryable error with API key #{current_key_index + 1}: {e}")
+                    print(f"❌ Non-retryable error with API key #{key_index + 1}: {e}")
                     break
         
         if response:
             break  # Got successful response
-        
-        # Move to next API key
-        current_key_index = (current_key_index + 1) % len(API_KEYS)
     
     # If all keys failed, return demo data
     if not response:
-        if len(failed_keys) >= len(API_KEYS):
+        if len(failed_keys) >= len(api_keys):
             print("❌ All API keys exhausted. Switching to demo fallback.")
         else:
             print("❌ All retry attempts failed. Switching to demo fallback.")
@@ -160,7 +273,7 @@ def process_invoice(file_bytes, mime_type):
             ],
             "confidence_score": 0.5,
             "explanations": {
-                "note": f"⚠️ Fallback demo data. {len(failed_keys)}/{len(API_KEYS)} API keys hit quota limit."
+                "note": f"⚠️ Fallback demo data. {len(failed_keys)}/{len(api_keys)} API keys hit quota limit."
             },
             "ai_raw_structured": {},
             "overall_confidence": 0.5
@@ -205,4 +318,5 @@ def process_invoice(file_bytes, mime_type):
 
     except Exception as e:
         print(f"❌ AI Error during parsing: {e}")
+        _thread_state.last_error = f"AI response could not be parsed: {e}"
         return None
\ No newline at end of file
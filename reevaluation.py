@@ -0,0 +1,230 @@
+"""Background re-evaluation of stored risk scores and compliance results.
+
+risk_score / risk_level are computed when an invoice is saved, and compliance
+when it is ingested, so both go stale when the policy pack or the risk
+thresholds change. This job walks the live invoices in id order and
+recomputes them in batches:
+
+1. Each invoice gets a fingerprint of everything its results depend on:
+   vendor, date, total, currency, line items, confidence, entity, the
+   duplicate flag and vendor profile (average and anomaly stats) in effect,
+   plus the policy pack version and risk_engine.risk_version()
+2. Invoices whose stored eval_fingerprint still matches are skipped
+3. The others are checked with compliance_batch, scored with
+   risk_engine.score_invoices() and written back with one
+   apply_invoice_evaluations() call per batch
+
+After every written batch the last invoice id goes to
+REEVALUATION_STATE_FILE, so an interrupted run resumes where it stopped
+(under the same rule versions; otherwise it starts over).
+
+    python reevaluation.py                  # REEVALUATION_BATCH_SIZE (default 500) per batch
+    python reevaluation.py --restart        # ignore the saved position
+    python reevaluation.py --dry-run        # count what would change, write nothing
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+import database
+import risk_engine
+from compliance_batch import evaluate_invoice_compliance_batch, invoices_to_frames
+from compliance_policy import active_policy
+
+
+def state_path():
+    return Path(os.getenv("REEVALUATION_STATE_FILE", "local_data/reevaluation_state.json"))
+
+
+def default_batch_size():
+    return max(1, int(os.getenv("REEVALUATION_BATCH_SIZE", "500")))
+
+
+def evaluation_version(policy=None, risk_settings=None):
+    """Rule versions every fingerprint includes."""
+    policy = policy or active_policy()
+    return f"{policy.version}+{risk_engine.risk_version(risk_settings)}"
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "+00:00"
+
+
+def _to_float(value, default=None):
+    try:
+        return float(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+# --- STATE ---
+def load_state():
+    try:
+        return json.loads(state_path().read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Re-evaluation State Error: {e}")
+        return None
+
+
+def _save_state(state):
+    path = state_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+# --- INPUTS ---
+def invoice_inputs(row, policy):
+    """The compliance input of a stored invoice row; line items and the entity
+    live in ai_raw_data."""
+    raw = row.get("ai_raw_data")
+    raw = raw if isinstance(raw, dict) else {}
+    entity_field = policy.entity_field
+    return {
+        "vendor_name": row.get("vendor_name"),
+        "invoice_date": row.get("invoice_date"),
+        "total_amount": row.get("total_amount"),
+        "currency": row.get("currency"),
+        "line_items": raw.get("line_items") or [],
+        entity_field: raw.get(entity_field) or (raw.get("_routing_tags") or {}).get(entity_field),
+    }
+
+
+def profile_digest(profile):
+    """Short hash of a vendor profile; computed once per vendor and batch."""
+    if not profile:
+        return None
+    encoded = json.dumps(profile, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+def fingerprint(version, invoice, confidence, duplicate_found, vendor_profile_digest):
+    payload = [version, invoice, confidence, bool(duplicate_found), vendor_profile_digest]
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:32]
+
+
+# --- JOB ---
+def evaluate_rows(rows, policy, risk_settings, version):
+    """(evaluations to write, number of unchanged rows) for one batch."""
+    invoices = [invoice_inputs(row, policy) for row in rows]
+    for row, invoice in zip(rows, invoices):
+        invoice.update({"id": row.get("id"), "confidence_score": row.get("confidence_score")})
+    duplicates = risk_engine.find_duplicates(invoices)
+    profiles = risk_engine.vendor_profiles(invoice["vendor_name"] for invoice in invoices)
+    digests = {name: profile_digest(profile) for name, profile in profiles.items()}
+
+    pending = []
+    for position, (row, invoice) in enumerate(zip(rows, invoices)):
+        confidence = _to_float(row.get("confidence_score"), 1.0)
+        row_fingerprint = fingerprint(
+            version, invoice, confidence, position in duplicates, digests.get(invoice["vendor_name"])
+        )
+        if row_fingerprint != row.get("eval_fingerprint"):
+            pending.append((position, row_fingerprint))
+    if not pending:
+        return [], len(rows)
+
+    changed = [invoices[position] for position, _ in pending]
+    header, lines = invoices_to_frames(changed, policy)
+    compliance_results = evaluate_invoice_compliance_batch(header, lines, policy)
+    risk_results = risk_engine.score_invoices(
+        changed, risk_settings,
+        duplicates={index for index, (position, _) in enumerate(pending) if position in duplicates},
+        profiles=profiles,
+    )
+    evaluated_at = _now()
+    evaluations = []
+    for (position, row_fingerprint), compliance_result, risk in zip(pending, compliance_results, risk_results):
+        evaluations.append({
+            "id": rows[position]["id"],
+            "risk_score": risk["risk_score"],
+            "risk_level": risk["risk_level"],
+            "compliance_issues": compliance_result["issues"],
+            "policy_version": compliance_result["policy_version"],
+            "eval_fingerprint": row_fingerprint,
+            "evaluated_at": evaluated_at,
+        })
+    return evaluations, len(rows) - len(pending)
+
+
+def reevaluate_invoices(batch_size=None, restart=False, dry_run=False):
+    """Recomputes risk and compliance for every invoice whose fingerprint changed.
+
+    Resumes after the last id recorded in REEVALUATION_STATE_FILE unless
+    restart is set or the rule versions changed since that run."""
+    batch_size = batch_size or default_batch_size()
+    policy = active_policy()
+    risk_settings = risk_engine.risk_settings()
+    version = evaluation_version(policy, risk_settings)
+    result = {
+        "status": "ok", "version": version, "resumed_after_id": None,
+        "scanned": 0, "unchanged": 0, "updated": 0, "risk_changed": 0, "errors": [],
+    }
+
+    state = load_state()
+    last_id = None
+    if state and not restart and not dry_run and state.get("version") == version and not state.get("finished"):
+        last_id = state.get("last_id")
+        result["resumed_after_id"] = last_id
+    state = {"version": version, "last_id": last_id, "started_at": _now(), "finished": False}
+
+    while True:
+        rows = database.fetch_invoices_for_evaluation(after_id=last_id, limit=batch_size)
+        if not rows:
+            break
+        evaluations, unchanged = evaluate_rows(rows, policy, risk_settings, version)
+        result["scanned"] += len(rows)
+        result["unchanged"] += unchanged
+        previous = {row["id"]: (row.get("risk_score"), row.get("risk_level")) for row in rows}
+        result["risk_changed"] += sum(
+            previous[evaluation["id"]] != (evaluation["risk_score"], evaluation["risk_level"])
+            for evaluation in evaluations
+        )
+
+        if dry_run:
+            result["updated"] += len(evaluations)
+        elif evaluations:
+            updated = database.apply_invoice_evaluations(evaluations)
+            result["updated"] += updated
+            if updated < len(evaluations):
+                result["status"] = "error"
+                result["errors"].append(f"Updated {updated} of {len(evaluations)} invoices after id {last_id}")
+                break
+
+        last_id = rows[-1]["id"]
+        if not dry_run:
+            state.update({"last_id": last_id, "updated_at": _now()})
+            _save_state(state)
+        if len(rows) < batch_size:
+            break
+
+    if dry_run:
+        result["status"] = "dry_run"
+    elif result["status"] == "ok":
+        state.update({"finished": True, "updated_at": _now(), "result": {
+            key: result[key] for key in ("scanned", "unchanged", "updated", "risk_changed")
+        }})
+        _save_state(state)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute stale risk scores and compliance results.")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--restart", action="store_true", help="ignore the position of an interrupted run")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    result = reevaluate_invoices(batch_size=args.batch_size, restart=args.restart, dry_run=args.dry_run)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Invoice risk model shared by the review screen, mail ingestion and the
+re-evaluation job.
+
+    score = 20 low AI confidence + 30 math mismatch + 40 duplicate
+            + 25 amount anomaly for the vendor + 15 unit price out of range
+    HIGH >= 60, MEDIUM >= 30, LOW below
+
+The amount and unit-price checks use the vendor's incremental statistics
+(robust median/MAD, EWMA, price ranges; see vendor_anomaly.py). Vendors
+with too few approved invoices for those fall back to "amount above the
+vendor average x RISK_VENDOR_AVG_MULTIPLIER".
+
+Thresholds can be tuned with RISK_LOW_CONFIDENCE, RISK_VENDOR_AVG_MULTIPLIER,
+RISK_HIGH_SCORE, RISK_MEDIUM_SCORE and the VENDOR_* settings of
+vendor_anomaly.py. risk_version() hashes the weights and thresholds in
+effect, so stored scores computed under other settings can be recognised
+and recomputed (see reevaluation.py).
+
+score_invoices() scores a whole list with two bulk lookups: vendor profiles
+(average and anomaly stats) for the distinct vendors, cached for
+RISK_VENDOR_CACHE_SECONDS, and one duplicate query per chunk of
+vendor/date/amount keys. score_invoice() is the single-invoice form. Every
+result carries reason codes (REASON_*) next to the readable reasons.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+import archive
+import database
+import vendor_anomaly
+
+REASON_LOW_CONFIDENCE = "LOW_CONFIDENCE"
+REASON_MATH_MISMATCH = "MATH_MISMATCH"
+REASON_DUPLICATE = "DUPLICATE"
+REASON_VENDOR_ANOMALY = "VENDOR_ANOMALY"
+REASON_UNIT_PRICE_ANOMALY = "UNIT_PRICE_ANOMALY"
+
+RISK_WEIGHTS = {
+    "low_confidence": 20,
+    "math_mismatch": 30,
+    "duplicate": 40,
+    "vendor_anomaly": 25,
+    "unit_price_anomaly": 15,
+}
+
+_vendor_cache_lock = threading.Lock()
+_vendor_cache = {}  # vendor_name -> (profile or None, fetched at)
+
+
+def risk_settings():
+    return {
+        "weights": dict(RISK_WEIGHTS),
+        "low_confidence": float(os.getenv("RISK_LOW_CONFIDENCE", "0.7")),
+        "vendor_avg_multiplier": float(os.getenv("RISK_VENDOR_AVG_MULTIPLIER", "2")),
+        "high_score": int(os.getenv("RISK_HIGH_SCORE", "60")),
+        "medium_score": int(os.getenv("RISK_MEDIUM_SCORE", "30")),
+        "anomaly": vendor_anomaly.anomaly_settings(),
+    }
+
+
+def risk_version(settings=None):
+    """"risk@<hash>" of the weights and thresholds."""
+    settings = settings or risk_settings()
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"risk@{digest[:12]}"
+
+
+def _to_float(value, default=None):
+    try:
+        number = float(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+    return default if number is not None and math.isnan(number) else number
+
+
+def line_items_total(line_items):
+    """Sum of the line items' total_price; missing values count as zero."""
+    total = 0.0
+    for item in line_items or []:
+        value = _to_float((item or {}).get("total_price"))
+        if value is not None:
+            total += value
+    return total
+
+
+def check_math(invoice_total, line_items):
+    """(valid, calculated sum, difference): line items must add up to the total exactly."""
+    if not line_items:
+        return False, 0.0, invoice_total
+    calculated_sum = line_items_total(line_items)
+    diff = round(abs(invoice_total - calculated_sum), 2)
+    return diff == 0, calculated_sum, diff
+
+
+def assess_risk(confidence, math_valid, diff, duplicate_found, vendor_avg, total, settings=None, anomaly=None):
+    """{"risk_score", "risk_level", "risk_reasons", "reason_codes"} from the
+    individual findings. anomaly is a vendor_anomaly.score() result; without
+    one the amount is compared to vendor_avg."""
+    settings = settings or risk_settings()
+    weights = settings["weights"]
+    risk_score = 0
+    risk_reasons = []
+    reason_codes = []
+
+    if confidence < settings["low_confidence"]:
+        risk_score += weights["low_confidence"]
+        risk_reasons.append(f"Low AI Confidence ({int(confidence*100)}%)")
+        reason_codes.append(REASON_LOW_CONFIDENCE)
+    if not math_valid:
+        risk_score += weights["math_mismatch"]
+        risk_reasons.append(f"Math Mismatch (Diff: {diff})")
+        reason_codes.append(REASON_MATH_MISMATCH)
+    if duplicate_found:
+        risk_score += weights["duplicate"]
+        risk_reasons.append("Duplicate Invoice Detected")
+        reason_codes.append(REASON_DUPLICATE)
+    multiplier = settings["vendor_avg_multiplier"]
+    if anomaly is not None:
+        if anomaly["amount_anomaly"]:
+            risk_score += weights["vendor_anomaly"]
+            risk_reasons.append(
+                f"Amount Unusual for Vendor (Median ${anomaly['median']:,.2f}, Robust Z {anomaly['robust_z']:g})"
+            )
+            reason_codes.append(REASON_VENDOR_ANOMALY)
+        if anomaly["price_anomalies"]:
+            risk_score += weights["unit_price_anomaly"]
+            first = anomaly["price_anomalies"][0]
+            more = len(anomaly["price_anomalies"]) - 1
+            risk_reasons.append(
+                f"Unit Price Out of Range ({first['description']}: ${first['unit_price']:,.2f}, "
+                f"usual ${first['min']:,.2f}-${first['max']:,.2f})" + (f" +{more} more" if more else "")
+            )
+            reason_codes.append(REASON_UNIT_PRICE_ANOMALY)
+    elif vendor_avg and total > (vendor_avg * multiplier):
+        risk_score += weights["vendor_anomaly"]
+        risk_reasons.append(f"Amount > {multiplier:g}x Vendor Avg (${vendor_avg:.2f})")
+        reason_codes.append(REASON_VENDOR_ANOMALY)
+
+    if risk_score >= settings["high_score"]:
+        risk_level = "HIGH"
+    elif risk_score >= settings["medium_score"]:
+        risk_level = "MEDIUM"
+    else:
+        risk_level = "LOW"
+    return {"risk_score": risk_score, "risk_level": risk_level, "risk_reasons": risk_reasons,
+            "reason_codes": reason_codes}
+
+
+# --- PREFETCH ---
+def vendor_profiles(vendor_names):
+    """{vendor_name: {"avg_invoice_value", "anomaly_stats"}} with one query for
+    the names not cached in the last RISK_VENDOR_CACHE_SECONDS; vendors
+    without history are left out."""
+    ttl = float(os.getenv("RISK_VENDOR_CACHE_SECONDS", "60"))
+    names = {name for name in vendor_names if name}
+    now = time.monotonic()
+    with _vendor_cache_lock:
+        missing = [name for name in names if name not in _vendor_cache or now - _vendor_cache[name][1] > ttl]
+    if missing:
+        fetched = database.fetch_vendor_profiles(missing)
+        if fetched is not None:
+            with _vendor_cache_lock:
+                for name in missing:
+                    _vendor_cache[name] = (fetched.get(name), now)
+    with _vendor_cache_lock:
+        cached = {name: _vendor_cache.get(name, (None, 0))[0] for name in names}
+    return {name: profile for name, profile in cached.items() if profile is not None}
+
+
+def clear_vendor_cache():
+    with _vendor_cache_lock:
+        _vendor_cache.clear()
+
+
+def _business_key(invoice):
+    return (invoice.get("vendor_name"), invoice.get("invoice_date"), _to_float(invoice.get("total_amount")))
+
+
+def find_duplicates(invoices):
+    """Positions of the invoices that share vendor, date and amount with
+    another live invoice (their own "id" excluded) or an archived one."""
+    keys = [_business_key(invoice) for invoice in invoices]
+    lookup = [key for key in dict.fromkeys(keys) if None not in key]
+    if not lookup:
+        return set()
+    matches = {}
+    for row in database.fetch_invoices_by_business_keys(lookup):
+        matches.setdefault(_business_key(row), set()).add(str(row.get("id")))
+    duplicates = set()
+    for position, (invoice, key) in enumerate(zip(invoices, keys)):
+        if None in key:
+            continue
+        own_id = invoice.get("id")
+        others = matches.get(key, set()) - ({str(own_id)} if own_id is not None else set())
+        if others or archive.is_archived_duplicate(*key):
+            duplicates.add(position)
+    return duplicates
+
+
+# --- SCORING ---
+def score_invoices(invoices, settings=None, duplicates=None, profiles=None):
+    """One risk result per invoice dict (vendor_name, invoice_date,
+    total_amount, confidence_score, line_items, optional id), in order.
+    duplicates (positions) and profiles ({vendor: vendor_profiles() entry})
+    are looked up in bulk unless given."""
+    settings = settings or risk_settings()
+    if duplicates is None:
+        duplicates = find_duplicates(invoices)
+    if profiles is None:
+        profiles = vendor_profiles(invoice.get("vendor_name") for invoice in invoices)
+
+    results = []
+    for position, invoice in enumerate(invoices):
+        total = _to_float(invoice.get("total_amount"), 0.0)
+        confidence = _to_float(invoice.get("confidence_score"), 1.0)
+        math_valid, _, diff = check_math(total, invoice.get("line_items"))
+        profile = profiles.get(invoice.get("vendor_name")) or {}
+        anomaly = vendor_anomaly.score(
+            profile.get("anomaly_stats"), total, invoice.get("line_items"), settings["anomaly"]
+        )
+        results.append(assess_risk(
+            confidence, math_valid, diff, position in duplicates, profile.get("avg_invoice_value"),
+            total, settings, anomaly,
+        ))
+    return results
+
+
+def score_invoice(invoice, settings=None, duplicate_found=None, vendor_profile=None):
+    """score_invoices() for one invoice; pass duplicate_found / vendor_profile when already known."""
+    duplicates = None if duplicate_found is None else ({0} if duplicate_found else set())
+    profiles = None if vendor_profile is None else {invoice.get("vendor_name"): vendor_profile}
+    return score_invoices([invoice], settings, duplicates=duplicates, profiles=profiles)[0]
@@ -0,0 +1,162 @@
+"""Limits shared by every ingestion process on this host.
+
+Mailbox workers run in separate processes (see mail_supervisor.py), so
+in-memory sets and counters cannot see each other. This small SQLite file
+(SHARED_STATE_DB) holds what they must agree on:
+
+- claims: document hashes and business keys being ingested right now, so two
+  inboxes that receive the same invoice do not both save it
+- api_key_calls: Gemini calls per key in the last minute (GEMINI_RPM_PER_KEY)
+- api_key_exhausted: keys that hit their daily quota, skipped by everyone
+
+Every function fails open: if the file cannot be used, the caller carries on
+as a single process would and the database duplicate checks still apply.
+"""
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    owner TEXT,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS idx_claims_claimed_at ON claims (claimed_at);
+CREATE TABLE IF NOT EXISTS api_key_calls (
+    key_id TEXT NOT NULL,
+    called_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_api_key_calls ON api_key_calls (key_id, called_at);
+CREATE TABLE IF NOT EXISTS api_key_exhausted (
+    key_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    PRIMARY KEY (key_id, day)
+);
+"""
+
+_local = threading.local()
+
+
+def shared_db_path() -> Path:
+    return Path(os.getenv("SHARED_STATE_DB", "local_data/shared_state.db"))
+
+
+def claim_ttl_seconds() -> float:
+    return float(os.getenv("MAIL_CLAIM_TTL_SECONDS", "3600"))
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _connection() -> sqlite3.Connection:
+    """One connection per thread and file, like the SQLite repository."""
+    path = shared_db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+
+# --- CLAIMS ---
+def claim(kind: str, key: str) -> bool:
+    """True if this process now owns (kind, key); False if another process
+    claimed it within MAIL_CLAIM_TTL_SECONDS."""
+    if not key:
+        return True
+    now = time.time()
+    try:
+        cursor = _connection().execute(
+            """
+            INSERT INTO claims (kind, key, owner, claimed_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET owner = excluded.owner, claimed_at = excluded.claimed_at
+            WHERE claims.claimed_at < ?
+            """,
+            (kind, key, _owner(), now, now - claim_ttl_seconds()),
+        )
+        return cursor.rowcount > 0
+    except Exception as e:
+        print(f"Shared Claim Error: {e}")
+        return True
+
+
+def release(kind: str, key: str) -> None:
+    """Gives a claim back, e.g. after the extraction failed, so a retry can take it."""
+    if not key:
+        return
+    try:
+        _connection().execute("DELETE FROM claims WHERE kind = ? AND key = ? AND owner = ?", (kind, key, _owner()))
+    except Exception as e:
+        print(f"Shared Claim Error: {e}")
+
+
+def purge_expired_claims() -> None:
+    try:
+        _connection().execute("DELETE FROM claims WHERE claimed_at < ?", (time.time() - claim_ttl_seconds(),))
+    except Exception as e:
+        print(f"Shared Claim Error: {e}")
+
+
+# --- API KEY QUOTA ---
+def key_id(api_key: str) -> str:
+    """Stable, non-secret id for an API key."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def acquire_call_slot(api_key_id: str, per_minute: int) -> float:
+    """Books one call for the key if it made fewer than per_minute calls in
+    the last 60 s (across all processes). Returns 0 when booked, otherwise
+    the seconds until a slot frees up."""
+    now = time.time()
+    conn = _connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM api_key_calls WHERE key_id = ? AND called_at <= ?", (api_key_id, now - 60))
+            count, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(called_at) FROM api_key_calls WHERE key_id = ?", (api_key_id,)
+            ).fetchone()
+            if count < per_minute:
+                conn.execute("INSERT INTO api_key_calls (key_id, called_at) VALUES (?, ?)", (api_key_id, now))
+                conn.execute("COMMIT")
+                return 0.0
+            conn.execute("COMMIT")
+            return max(0.05, oldest + 60 - now)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    except Exception as e:
+        print(f"Shared Quota Error: {e}")
+        return 0.0
+
+
+def mark_key_exhausted(api_key_id: str, day: str) -> None:
+    try:
+        _connection().execute(
+            "INSERT OR IGNORE INTO api_key_exhausted (key_id, day) VALUES (?, ?)", (api_key_id, day)
+        )
+    except Exception as e:
+        print(f"Shared Quota Error: {e}")
+
+
+def exhausted_key_ids(day: str) -> set:
+    """Keys any process saw hit their quota on this (UTC) day."""
+    try:
+        rows = _connection().execute("SELECT key_id FROM api_key_exhausted WHERE day = ?", (day,)).fetchall()
+        return {row[0] for row in rows}
+    except Exception as e:
+        print(f"Shared Quota Error: {e}")
+        return set()
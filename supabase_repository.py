@@ -0,0 +1,728 @@
+import io
+import os
+import threading
+
+from repository_base import (
+    InvoiceRepository,
+    batch_chunk_size,
+    blob_path,
+    build_invoice_payload,
+    compute_dashboard_metrics,
+    empty_dashboard_metrics,
+    hash_file_data,
+    is_allowed_stage_transition,
+    normalize_edit_rows,
+)
+import vendor_anomaly
+
+
+def _is_missing_rpc_error(error):
+    """True when PostgREST reports that the stored procedure is not deployed"""
+    return getattr(error, "code", None) == "PGRST202" or "Could not find the function" in str(error)
+
+
+class SupabaseRepository(InvoiceRepository):
+    """Invoice storage on Supabase (Postgres tables + Storage bucket)."""
+
+    def __init__(self, url=None, key=None):
+        import httpx
+        from supabase import ClientOptions, create_client
+
+        url = url or os.environ.get("SUPABASE_URL")
+        key = key or os.environ.get("SUPABASE_KEY")
+        if not url or not key:
+            raise ValueError("Missing Supabase keys in .env file")
+
+        # One pooled keep-alive HTTP client shared by PostgREST and Storage, and
+        # by every thread of database.submit_read (httpx.Client is thread-safe).
+        self.http_client = httpx.Client(
+            http2=True,
+            follow_redirects=True,
+            timeout=float(os.environ.get("DB_HTTP_TIMEOUT_SECONDS", "60")),
+            limits=httpx.Limits(
+                max_connections=int(os.environ.get("DB_HTTP_MAX_CONNECTIONS", "10")),
+                max_keepalive_connections=int(os.environ.get("DB_HTTP_MAX_CONNECTIONS", "10")),
+                keepalive_expiry=float(os.environ.get("DB_HTTP_KEEPALIVE_SECONDS", "60")),
+            ),
+        )
+        self.client = create_client(url, key, options=ClientOptions(httpx_client=self.http_client))
+
+        # Blob keys already confirmed in the bucket by this process
+        self._known_blobs = set()
+        self._known_blobs_lock = threading.Lock()
+
+    def is_duplicate_hash(self, document_hash, exclude_id=None):
+        """Checks if an invoice with the same document hash already exists."""
+        if not document_hash:
+            return False
+
+        try:
+            query = self.client.table("invoices").select("id").eq("document_hash", document_hash)
+            if exclude_id:
+                query = query.neq("id", exclude_id)
+            response = query.execute()
+            return len(response.data) > 0
+        except Exception as e:
+            print(f"Document Hash Duplicate Check Error: {e}")
+            return False
+
+    def upload_file(self, file_bytes, file_name, content_type):
+        """Uploads file to Supabase Storage and returns the Public URL"""
+        bucket_name = "invoices"
+        try:
+            # Upload file (overwrite if exists)
+            response = self.client.storage.from_(bucket_name).upload(
+                path=file_name,
+                file=file_bytes,
+                file_options={"content-type": content_type, "upsert": "true"}
+            )
+            # Get Public URL
+            public_url = self.client.storage.from_(bucket_name).get_public_url(file_name)
+            return public_url
+        except Exception as e:
+            print(f"Upload Error: {e}")
+            return None
+
+    def upload_blob(self, file_data, content_type, file_name=None, document_hash=None):
+        """Stores a document under its SHA-256 key and returns the Public URL.
+        Skips the upload when the blob is already in the bucket."""
+        bucket_name = "invoices"
+        try:
+            document_hash = document_hash or hash_file_data(file_data)
+            path = blob_path(document_hash, content_type, file_name)
+            bucket = self.client.storage.from_(bucket_name)
+
+            with self._known_blobs_lock:
+                known = path in self._known_blobs
+            if not known and not bucket.exists(path):  # single HEAD request
+                file_options = {"content-type": content_type, "upsert": "true"}
+                if isinstance(file_data, (bytes, bytearray, memoryview)):
+                    bucket.upload(path=path, file=bytes(file_data), file_options=file_options)
+                else:
+                    # storage3 streams buffered readers in chunks instead of
+                    # loading them into one bytes object; detach() afterwards
+                    # so the caller's file object is not closed with the wrapper
+                    reader = io.BufferedReader(file_data)
+                    try:
+                        bucket.upload(path=path, file=reader, file_options=file_options)
+                    finally:
+                        reader.detach()
+            with self._known_blobs_lock:
+                self._known_blobs.add(path)
+
+            return bucket.get_public_url(path)
+        except Exception as e:
+            print(f"Upload Error: {e}")
+            return None
+
+    # --- VENDOR MEMORY LOGIC ---
+    def update_vendor_profile(self, vendor_name, total_amount, invoice_date, line_items=None):
+        """Updates the historical profile for a specific vendor"""
+        try:
+            # 1. Check if vendor exists
+            existing = self.client.table("vendors").select("*").eq("vendor_name", vendor_name).execute().data
+
+            if existing:
+                record = existing[0]
+                old_count = record["invoice_count"]
+                old_avg = float(record["avg_invoice_value"])
+
+                # Calculate new running average
+                new_count = old_count + 1
+                new_avg = ((old_avg * old_count) + float(total_amount)) / new_count
+
+                # Update existing record
+                self.client.table("vendors").update({
+                    "avg_invoice_value": new_avg,
+                    "invoice_count": new_count,
+                    "last_invoice_date": invoice_date
+                }).eq("vendor_name", vendor_name).execute()
+            else:
+                # Create new record
+                self.client.table("vendors").insert({
+                    "vendor_name": vendor_name,
+                    "avg_invoice_value": total_amount,
+                    "invoice_count": 1,
+                    "last_invoice_date": invoice_date
+                }).execute()
+
+        except Exception as e:
+            print(f"Vendor Update Error: {e}")
+            return
+        self._update_vendor_anomaly({vendor_name: [(total_amount, line_items)]})
+
+    # --- HELPER: GET VENDOR AVERAGE ---
+    def get_vendor_average(self, vendor_name):
+        """Fetches the historical average invoice value for anomaly detection"""
+        try:
+            response = self.client.table("vendors").select("avg_invoice_value").eq("vendor_name", vendor_name).execute()
+            if response.data and len(response.data) > 0:
+                return float(response.data[0]['avg_invoice_value'])
+            return None
+        except Exception as e:
+            return None
+
+    def fetch_vendor_profiles(self, vendor_names):
+        """{vendor_name: {"avg_invoice_value", "anomaly_stats"}} for the given
+        vendors that have a profile"""
+        try:
+            names = list(dict.fromkeys(vendor_names))
+            profiles = {}
+            size = batch_chunk_size()
+            for start in range(0, len(names), size):
+                response = (
+                    self.client.table("vendors")
+                    .select("vendor_name, avg_invoice_value, anomaly_stats")
+                    .in_("vendor_name", names[start:start + size])
+                    .execute()
+                )
+                for row in response.data or []:
+                    if row.get("avg_invoice_value") is not None:
+                        profiles[row["vendor_name"]] = {
+                            "avg_invoice_value": float(row["avg_invoice_value"]),
+                            "anomaly_stats": row.get("anomaly_stats"),
+                        }
+            return profiles
+        except Exception as e:
+            print(f"Vendor Profile Error: {e}")
+            return None
+
+    def _update_vendor_anomaly(self, observations, attempts=3):
+        """Folds {vendor_name: [(amount, line_items)]} into vendors.anomaly_stats.
+        update_vendor_anomaly_stats() only writes when the stored count is the
+        one the new stats were built on, so concurrent approvals re-read and retry."""
+        observations = {name: rows for name, rows in observations.items() if name and rows}
+        if not observations:
+            return
+        settings = vendor_anomaly.anomaly_settings()
+        try:
+            pending = dict(observations)
+            for _ in range(attempts):
+                response = (
+                    self.client.table("vendors")
+                    .select("vendor_name, anomaly_stats")
+                    .in_("vendor_name", list(pending))
+                    .execute()
+                )
+                current = {row["vendor_name"]: row.get("anomaly_stats") for row in response.data or []}
+                conflicts = {}
+                for vendor_name, vendor_observations in pending.items():
+                    if vendor_name not in current:
+                        continue
+                    stats = current[vendor_name]
+                    expected = int((stats or {}).get("n", 0))
+                    for amount, line_items in vendor_observations:
+                        stats = vendor_anomaly.update_stats(stats, amount, line_items, settings)
+                    try:
+                        written = self.client.rpc("update_vendor_anomaly_stats", {
+                            "p_vendor_name": vendor_name,
+                            "p_expected_count": expected,
+                            "p_stats": stats,
+                        }).execute().data
+                    except Exception as e:
+                        if not _is_missing_rpc_error(e):
+                            raise
+                        self.client.table("vendors").update({"anomaly_stats": stats}).eq(
+                            "vendor_name", vendor_name
+                        ).execute()
+                        written = True
+                    if not written:
+                        conflicts[vendor_name] = vendor_observations
+                if not conflicts:
+                    return
+                pending = conflicts
+            print(f"Vendor Stats Warning: gave up after {attempts} conflicting updates for {', '.join(pending)}")
+        except Exception as e:
+            print(f"Vendor Stats Error: {e}")
+
+    def save_vendor_anomaly_stats(self, stats_by_vendor):
+        """Replaces the anomaly stats of existing vendors; returns the number written"""
+        written = 0
+        try:
+            for vendor_name, stats in stats_by_vendor.items():
+                response = (
+                    self.client.table("vendors")
+                    .update({"anomaly_stats": stats})
+                    .eq("vendor_name", vendor_name)
+                    .execute()
+                )
+                written += len(response.data or [])
+        except Exception as e:
+            print(f"Vendor Stats Error: {e}")
+        return written
+
+    # --- DUPLICATE DETECTION ---
+    def is_duplicate(self, vendor_name, invoice_date, total_amount, exclude_id=None):
+        """
+        Checks if an invoice with the same Vendor, Date, and Amount already exists.
+        exclude_id: Optional ID to ignore (useful when editing an existing invoice).
+        """
+        try:
+            query = self.client.table("invoices")\
+                .select("id")\
+                .eq("vendor_name", vendor_name)\
+                .eq("invoice_date", invoice_date)\
+                .eq("total_amount", total_amount)
+
+            # If we are editing a record, don't count itself as a duplicate
+            if exclude_id:
+                query = query.neq("id", exclude_id)
+
+            response = query.execute()
+            return len(response.data) > 0
+        except Exception as e:
+            print(f"Duplicate Check Error: {e}")
+            return False
+
+    # --- AUDIT LOGGING ---
+    def log_edit(self, invoice_id, field_name, old_val, new_val):
+        """Records a specific change made by the human reviewer"""
+        try:
+            self.client.table("invoice_edits").insert({
+                "invoice_id": invoice_id,
+                "field_name": field_name,
+                "old_value": str(old_val),
+                "new_value": str(new_val)
+            }).execute()
+        except Exception as e:
+            print(f"Audit Log Error: {e}")
+
+    def log_edits(self, invoice_id, edits):
+        """Records all changes of one save in a single batched insert"""
+        if not edits:
+            return
+        try:
+            self.client.table("invoice_edits").insert([
+                {"invoice_id": invoice_id, **edit} for edit in normalize_edit_rows(edits)
+            ]).execute()
+        except Exception as e:
+            print(f"Audit Log Error: {e}")
+
+    # --- UPDATED SAVE FUNCTION ---
+    def save_invoice_record(self, data, file_url, user_role="Unknown", invoice_id=None):
+        """Saves invoice and returns the entire record (including ID)
+        If invoice_id is provided, UPDATE the existing record instead of INSERT.
+        """
+        try:
+            requested_stage = data.get("approval_stage", "UPLOADED")
+
+            if invoice_id:
+                existing_resp = self.client.table("invoices").select("approval_stage").eq("id", invoice_id).limit(1).execute()
+                existing_rows = existing_resp.data or []
+                if not existing_rows:
+                    print(f"DB Error: Invoice {invoice_id} not found for update")
+                    return None
+
+                current_stage = existing_rows[0].get("approval_stage")
+                if not is_allowed_stage_transition(current_stage, requested_stage, user_role, is_new_record=False):
+                    print(
+                        f"Pipeline Guard: Transition blocked for role={user_role}, "
+                        f"{current_stage} -> {requested_stage}"
+                    )
+                    return None
+            else:
+                if not is_allowed_stage_transition(None, requested_stage, user_role, is_new_record=True):
+                    print(
+                        f"Pipeline Guard: Insert blocked for role={user_role}, "
+                        f"stage={requested_stage}"
+                    )
+                    return None
+
+            payload = build_invoice_payload(data, file_url, user_role)
+
+            # ✅ FIX: UPDATE if invoice_id exists, otherwise INSERT
+            if invoice_id:
+                response = self.client.table("invoices").update(payload).eq("id", invoice_id).execute()
+            else:
+                response = self.client.table("invoices").insert(payload).execute()
+
+            # Update Vendor Memory only if fully Approved
+            if data.get("approval_stage") == "APPROVED":
+                 self.update_vendor_profile(
+                    data.get("vendor_name"), 
+                    data.get("total_amount"), 
+                    data.get("invoice_date"),
+                    line_items=vendor_anomaly.invoice_line_items(data),
+                )
+
+            # ✅ FIX: Log audit if marked as AUDITED
+            if data.get("approval_stage") == "AUDITED" and response.data:
+                try:
+                    saved_id = response.data[0].get("id")
+                    self.client.table("invoice_audits").insert({
+                        "invoice_id": saved_id,
+                        "audited_by": data.get("reviewed_by", "AUDITOR"),
+                        "audit_note": data.get("flag_reason", "Audited and Verified")
+                    }).execute()
+                    print(f"✅ Audit logged for invoice {saved_id}")
+                except Exception as e:
+                    print(f"Audit Log Error: {e}")
+
+            return response.data[0] if response.data else None
+        except Exception as e:
+            print(f"DB Error: {e}")
+            return None
+
+    # --- TRANSACTIONAL SAVE ---
+    def save_invoice_transaction(self, data, file_url, user_role="Unknown", invoice_id=None, edits=None):
+        """Saves invoice, vendor stats, audit row and edit rows in one atomic call
+        (the save_invoice_transaction procedure in supabase_setup.sql).
+        edits: list of {"field_name", "old_value", "new_value"} dicts.
+        """
+        edit_rows = normalize_edit_rows(edits)
+
+        try:
+            response = self.client.rpc("save_invoice_transaction", {
+                "p_payload": build_invoice_payload(data, file_url, user_role),
+                "p_user_role": user_role,
+                "p_invoice_id": invoice_id,
+                "p_edits": edit_rows,
+            }).execute()
+            saved = response.data
+            if isinstance(saved, list):
+                saved = saved[0] if saved else None
+            if saved and saved.get("approval_stage") == "APPROVED":
+                self._update_vendor_anomaly({
+                    saved.get("vendor_name"): [(saved.get("total_amount"), vendor_anomaly.invoice_line_items(data))]
+                })
+            return saved or None
+        except Exception as e:
+            if not _is_missing_rpc_error(e):
+                print(f"DB Transaction Error: {e}")
+                return None
+            print("DB Transaction Warning: save_invoice_transaction not deployed, using sequential writes")
+
+        saved = self.save_invoice_record(data, file_url, user_role, invoice_id=invoice_id)
+        if saved:
+            self.log_edits(saved["id"], edit_rows)
+        return saved
+
+    # --- BULK SAVE ---
+    def _update_vendor_profiles_bulk(self, vendor_totals):
+        """Applies aggregated approvals as one upsert row per vendor.
+        vendor_totals: {vendor_name: {"count", "total", "last_invoice_date"}}
+        """
+        if not vendor_totals:
+            return
+        try:
+            names = list(vendor_totals.keys())
+            existing = self.client.table("vendors").select("*").in_("vendor_name", names).execute().data or []
+            existing_by_name = {row["vendor_name"]: row for row in existing}
+
+            rows = []
+            for vendor_name, agg in vendor_totals.items():
+                record = existing_by_name.get(vendor_name)
+                old_count = int(record["invoice_count"]) if record else 0
+                old_avg = float(record["avg_invoice_value"]) if record else 0.0
+                new_count = old_count + agg["count"]
+                rows.append({
+                    "vendor_name": vendor_name,
+                    "avg_invoice_value": ((old_avg * old_count) + agg["total"]) / new_count,
+                    "invoice_count": new_count,
+                    "last_invoice_date": agg["last_invoice_date"],
+                })
+
+            self.client.table("vendors").upsert(rows, on_conflict="vendor_name").execute()
+        except Exception as e:
+            print(f"Vendor Bulk Update Error: {e}")
+
+    def _update_invoices(self, payloads):
+        """Updates existing invoices by id with one update_invoices_batch RPC and
+        returns the updated rows. Ids that no longer exist are skipped, never
+        inserted again."""
+        try:
+            return self.client.rpc("update_invoices_batch", {"p_rows": payloads}).execute().data or []
+        except Exception as e:
+            if not _is_missing_rpc_error(e):
+                raise
+            print("Batch Save Warning: update_invoices_batch not deployed, updating row by row")
+        rows = []
+        for payload in payloads:
+            fields = {key: value for key, value in payload.items() if key != "id"}
+            rows.extend(self.client.table("invoices").update(fields).eq("id", payload["id"]).execute().data or [])
+        return rows
+
+    def save_invoice_records_batch(self, records, user_role="Unknown", chunk_size=None):
+        """Saves many invoices with one read and at most two writes per chunk.
+
+        records: list of {"data": dict, "file_url": str, "invoice_id": optional}.
+        Every row goes through the same stage guard as save_invoice_record.
+        Returns one {"index", "ok", "id", "action", "error"} dict per input row,
+        in input order.
+        """
+        results = [
+            {"index": index, "ok": False, "id": None, "action": None, "error": None}
+            for index in range(len(records or []))
+        ]
+        chunk_size = batch_chunk_size(chunk_size)
+        vendor_totals = {}
+        audit_rows = []
+
+        for start in range(0, len(results), chunk_size):
+            chunk = list(enumerate(records[start:start + chunk_size], start=start))
+
+            # 1. One lookup for the current stage of every row being updated
+            update_ids = [rec.get("invoice_id") for _, rec in chunk if rec.get("invoice_id")]
+            current_stages = {}
+            if update_ids:
+                try:
+                    response = self.client.table("invoices").select("id, approval_stage").in_("id", update_ids).execute()
+                    current_stages = {str(row["id"]): row.get("approval_stage") for row in (response.data or [])}
+                except Exception as e:
+                    for index, _ in chunk:
+                        results[index]["error"] = f"Stage lookup failed: {e}"
+                    continue
+
+            # 2. Stage guard per row
+            inserts, updates = [], []
+            for index, rec in chunk:
+                data = rec.get("data") or {}
+                invoice_id = rec.get("invoice_id")
+                requested_stage = data.get("approval_stage", "UPLOADED")
+                payload = build_invoice_payload(data, rec.get("file_url"), user_role)
+
+                if invoice_id:
+                    if str(invoice_id) not in current_stages:
+                        results[index]["error"] = f"Invoice {invoice_id} not found for update"
+                        continue
+                    current_stage = current_stages[str(invoice_id)]
+                    if not is_allowed_stage_transition(current_stage, requested_stage, user_role, is_new_record=False):
+                        results[index]["error"] = (
+                            f"Pipeline Guard: Transition blocked for role={user_role}, "
+                            f"{current_stage} -> {requested_stage}"
+                        )
+                        continue
+                    payload["id"] = invoice_id
+                    updates.append((index, payload))
+                else:
+                    if not is_allowed_stage_transition(None, requested_stage, user_role, is_new_record=True):
+                        results[index]["error"] = (
+                            f"Pipeline Guard: Insert blocked for role={user_role}, "
+                            f"stage={requested_stage}"
+                        )
+                        continue
+                    inserts.append((index, payload))
+
+            # 3. One write per kind. Inserts come back in request order;
+            # updates are matched by id, and ids that are gone are reported
+            for action, rows in (("INSERT", inserts), ("UPDATE", updates)):
+                if not rows:
+                    continue
+                try:
+                    payloads = [payload for _, payload in rows]
+                    if action == "INSERT":
+                        saved_rows = self.client.table("invoices").insert(payloads).execute().data or []
+                    else:
+                        updated = {str(row.get("id")): row for row in self._update_invoices(payloads)}
+                        saved_rows = [updated.get(str(payload["id"])) for payload in payloads]
+                except Exception as e:
+                    for index, _ in rows:
+                        results[index]["error"] = f"DB Error: {e}"
+                    continue
+
+                for index, _ in rows[len(saved_rows):]:
+                    results[index]["error"] = "DB Error: no row returned"
+                for (index, payload), saved in zip(rows, saved_rows):
+                    if saved is None:
+                        results[index]["error"] = f"Invoice {payload['id']} not found for update"
+                        continue
+                    results[index].update({"ok": True, "id": saved.get("id"), "action": action})
+                    stage = payload.get("approval_stage")
+                    if stage == "APPROVED":
+                        agg = vendor_totals.setdefault(
+                            payload.get("vendor_name"),
+                            {"count": 0, "total": 0.0, "last_invoice_date": None, "observations": []},
+                        )
+                        agg["count"] += 1
+                        agg["total"] += float(payload.get("total_amount") or 0.0)
+                        if str(payload.get("invoice_date") or "") > str(agg["last_invoice_date"] or ""):
+                            agg["last_invoice_date"] = payload.get("invoice_date")
+                        agg["observations"].append(
+                            (payload.get("total_amount"), vendor_anomaly.invoice_line_items(payload))
+                        )
+                    elif stage == "AUDITED":
+                        audit_rows.append({
+                            "invoice_id": saved.get("id"),
+                            "audited_by": payload.get("reviewed_by") or "AUDITOR",
+                            "audit_note": payload.get("flag_reason") or "Audited and Verified",
+                        })
+
+        # 4. Vendor memory and audit log once for the whole batch
+        self._update_vendor_profiles_bulk(vendor_totals)
+        self._update_vendor_anomaly({name: agg["observations"] for name, agg in vendor_totals.items()})
+        if audit_rows:
+            try:
+                self.client.table("invoice_audits").insert(audit_rows).execute()
+            except Exception as e:
+                print(f"Audit Log Error: {e}")
+
+        return results
+
+    # --- FETCH INVOICE EDITS ---
+    def fetch_invoice_edits(self, invoice_id):
+        """Fetches all edit records for a specific invoice"""
+        try:
+            response = self.client.table("invoice_edits").select("*").eq("invoice_id", invoice_id).execute()
+            return response.data if response.data else []
+        except Exception as e:
+            print(f"Fetch Invoice Edits Error: {e}")
+            return []
+
+    def fetch_all_invoice_edits(self):
+        """Fetches all invoice edit records for transparency exports."""
+        try:
+            response = self.client.table("invoice_edits").select("*").order("edited_at", desc=True).execute()
+            return response.data if response.data else []
+        except Exception as e:
+            print(f"Fetch All Invoice Edits Error: {e}")
+            return []
+
+    def fetch_all_invoice_audits(self):
+        """Fetches all invoice audit records for transparency exports."""
+        try:
+            response = self.client.table("invoice_audits").select("*").order("audited_at", desc=True).execute()
+            return response.data if response.data else []
+        except Exception as e:
+            print(f"Fetch All Invoice Audits Error: {e}")
+            return []
+
+    def fetch_all_vendors(self):
+        """Fetches all vendor profile records used by anomaly logic."""
+        try:
+            response = self.client.table("vendors").select("*").order("vendor_name").execute()
+            return response.data if response.data else []
+        except Exception as e:
+            print(f"Fetch All Vendors Error: {e}")
+            return []
+
+    def fetch_all_invoices(self):
+        """Fetches all invoices for the dashboard"""
+        try:
+            response = self.client.table("invoices").select("*").order("created_at", desc=True).execute()
+            return response.data
+        except Exception as e:
+            print(f"Fetch Error: {e}")
+            return []
+
+    # --- ARCHIVAL ---
+    def fetch_archivable_invoices(self, stages, created_before, limit=500):
+        """Oldest invoices in the given stages created before the cutoff"""
+        try:
+            response = (
+                self.client.table("invoices").select("*")
+                .in_("approval_stage", list(stages))
+                .lt("created_at", created_before)
+                .order("created_at")
+                .limit(int(limit))
+                .execute()
+            )
+            return response.data or []
+        except Exception as e:
+            print(f"Archive Fetch Error: {e}")
+            return []
+
+    def delete_invoices(self, invoice_ids):
+        """Removes invoices from the live table; returns the number deleted"""
+        deleted = 0
+        try:
+            ids = list(invoice_ids)
+            size = batch_chunk_size()
+            for start in range(0, len(ids), size):
+                response = self.client.table("invoices").delete().in_("id", ids[start:start + size]).execute()
+                deleted += len(response.data or [])
+            return deleted
+        except Exception as e:
+            print(f"Delete Error: {e}")
+            return deleted
+
+    # --- RE-EVALUATION ---
+    def fetch_invoices_for_evaluation(self, after_id=None, limit=500):
+        """Next invoices by id after after_id, with the columns risk and compliance depend on"""
+        try:
+            response = (
+                self.client.table("invoices")
+                .select("id, vendor_name, invoice_date, total_amount, currency, confidence_score, "
+                        "ai_raw_data, risk_score, risk_level, eval_fingerprint")
+                .gt("id", after_id or 0)
+                .order("id")
+                .limit(int(limit))
+                .execute()
+            )
+            return response.data or []
+        except Exception as e:
+            print(f"Evaluation Fetch Error: {e}")
+            return []
+
+    def fetch_invoices_by_business_keys(self, keys):
+        """id, vendor_name, invoice_date and total_amount of every invoice
+        matching one of the (vendor_name, invoice_date, total_amount) keys"""
+        wanted = {}
+        for vendor_name, invoice_date, total_amount in keys:
+            if vendor_name is None or invoice_date is None or total_amount is None:
+                continue
+            try:
+                wanted.setdefault(vendor_name, set()).add((invoice_date, float(total_amount)))
+            except (TypeError, ValueError):
+                continue
+        rows = []
+        try:
+            vendors = list(wanted)
+            size = batch_chunk_size()
+            for start in range(0, len(vendors), size):
+                chunk = vendors[start:start + size]
+                dates = sorted({invoice_date for vendor in chunk for invoice_date, _ in wanted[vendor]})
+                response = (
+                    self.client.table("invoices")
+                    .select("id, vendor_name, invoice_date, total_amount")
+                    .in_("vendor_name", chunk)
+                    .in_("invoice_date", dates)
+                    .execute()
+                )
+                for row in response.data or []:
+                    try:
+                        key = (row.get("invoice_date"), float(row.get("total_amount")))
+                    except (TypeError, ValueError):
+                        continue
+                    if key in wanted.get(row.get("vendor_name"), ()):
+                        rows.append(row)
+        except Exception as e:
+            print(f"Duplicate Check Error: {e}")
+        return rows
+
+    def apply_invoice_evaluations(self, evaluations):
+        """Writes re-evaluation results in one apply_invoice_evaluations RPC;
+        returns the number of rows updated"""
+        if not evaluations:
+            return 0
+        try:
+            updated = self.client.rpc("apply_invoice_evaluations", {"p_rows": list(evaluations)}).execute().data
+            return int(updated or 0)
+        except Exception as e:
+            if not _is_missing_rpc_error(e):
+                print(f"Evaluation Write Error: {e}")
+                return 0
+            print("Evaluation Warning: apply_invoice_evaluations not deployed, updating row by row")
+        updated = 0
+        for row in evaluations:
+            try:
+                fields = {key: value for key, value in row.items() if key != "id"}
+                response = self.client.table("invoices").update(fields).eq("id", row["id"]).execute()
+                updated += len(response.data or [])
+            except Exception as e:
+                print(f"Evaluation Write Error: {e}")
+        return updated
+
+    # --- DASHBOARD METRICS ---
+    def fetch_dashboard_metrics(self):
+        """Reads the trigger-maintained aggregates through the dashboard_metrics RPC"""
+        try:
+            metrics = self.client.rpc("dashboard_metrics", {}).execute().data
+            if isinstance(metrics, list):
+                metrics = metrics[0] if metrics else None
+            return {**empty_dashboard_metrics(), **(metrics or {})}
+        except Exception as e:
+            if not _is_missing_rpc_error(e):
+                print(f"Dashboard Metrics Error: {e}")
+                return empty_dashboard_metrics()
+            print("Dashboard Metrics Warning: dashboard_metrics not deployed, aggregating all invoices")
+        return compute_dashboard_metrics(self.fetch_all_invoices())
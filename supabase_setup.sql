@@ -0,0 +1,485 @@
+-- Supabase / Postgres objects used by database.py.
+-- Run once in the Supabase SQL editor after creating the base tables
+-- (invoices, vendors, invoice_edits, invoice_audits).
+
+-- The running-average upsert below needs one row per vendor.
+create unique index if not exists vendors_vendor_name_key on vendors (vendor_name);
+
+
+-- Mirrors database._is_allowed_stage_transition. Keep both in sync.
+create or replace function invoice_stage_transition_allowed(
+    p_prev text,
+    p_next text,
+    p_role text,
+    p_is_new boolean
+) returns boolean
+language sql
+immutable
+as $$
+    select case
+        when p_is_new then
+            (p_role = 'MAIL_BOT' and p_next = 'UPLOADED')
+            or (p_role = 'AP_CLERK' and p_next in ('UPLOADED', 'REVIEWED'))
+        when p_prev = p_next then
+            (p_next = 'UPLOADED' and p_role = 'AP_CLERK')
+            or (p_next = 'REVIEWED' and p_role in ('AP_CLERK', 'FINANCE_MANAGER'))
+            or (p_next = 'APPROVED' and p_role = 'FINANCE_MANAGER')
+            or (p_next = 'AUDITED' and p_role = 'AUDITOR')
+        else
+            (p_prev = 'UPLOADED' and p_next = 'REVIEWED' and p_role = 'AP_CLERK')
+            or (p_prev = 'REVIEWED' and p_next in ('APPROVED', 'REJECTED') and p_role = 'FINANCE_MANAGER')
+            or (p_prev = 'APPROVED' and p_next = 'AUDITED' and p_role = 'AUDITOR')
+    end
+$$;
+
+
+-- One round trip for an approval: stage guard, invoice upsert, vendor stats,
+-- audit row and edit rows all commit (or roll back) together.
+create or replace function save_invoice_transaction(
+    p_payload jsonb,
+    p_user_role text,
+    p_invoice_id invoices.id%type default null,
+    p_edits jsonb default '[]'::jsonb
+) returns jsonb
+language plpgsql
+as $$
+declare
+    v_prev_stage text;
+    v_next_stage text := upper(coalesce(p_payload->>'approval_stage', 'UPLOADED'));
+    v_role text := upper(coalesce(p_user_role, ''));
+    v_row invoices%rowtype;
+    v_amount numeric;
+begin
+    if p_invoice_id is not null then
+        select upper(coalesce(approval_stage, 'UPLOADED'))
+          into v_prev_stage
+          from invoices
+         where id = p_invoice_id
+           for update;
+
+        if not found then
+            raise exception 'Invoice % not found for update', p_invoice_id
+                using errcode = 'P0002';
+        end if;
+    end if;
+
+    if not invoice_stage_transition_allowed(v_prev_stage, v_next_stage, v_role, p_invoice_id is null) then
+        raise exception 'Pipeline Guard: transition blocked for role=%, % -> %',
+            p_user_role, coalesce(v_prev_stage, 'NEW'), v_next_stage
+            using errcode = 'P0001';
+    end if;
+
+    if p_invoice_id is null then
+        insert into invoices (
+            vendor_name, invoice_date, total_amount, currency, status,
+            processing_status, confidence_score, flag_reason, file_url,
+            ai_raw_data, ai_structured_output, document_hash, created_by,
+            last_reviewed_by, ai_explanations, risk_score, risk_level,
+            approval_stage, reviewed_by, approved_by, approval_timestamp,
+            audited, ai_version, reprocessed_at
+        )
+        select
+            vendor_name, invoice_date, total_amount, currency, status,
+            processing_status, confidence_score, flag_reason, file_url,
+            ai_raw_data, ai_structured_output, document_hash, created_by,
+            last_reviewed_by, ai_explanations, risk_score, risk_level,
+            approval_stage, reviewed_by, approved_by, approval_timestamp,
+            audited, ai_version, reprocessed_at
+        from jsonb_populate_record(null::invoices, p_payload)
+        returning * into v_row;
+    else
+        update invoices set (
+            vendor_name, invoice_date, total_amount, currency, status,
+            processing_status, confidence_score, flag_reason, file_url,
+            ai_raw_data, ai_structured_output, document_hash, created_by,
+            last_reviewed_by, ai_explanations, risk_score, risk_level,
+            approval_stage, reviewed_by, approved_by, approval_timestamp,
+            audited, ai_version, reprocessed_at
+        ) = (
+            select
+                vendor_name, invoice_date, total_amount, currency, status,
+                processing_status, confidence_score, flag_reason, file_url,
+                ai_raw_data, ai_structured_output, document_hash, created_by,
+                last_reviewed_by, ai_explanations, risk_score, risk_level,
+                approval_stage, reviewed_by, approved_by, approval_timestamp,
+                audited, ai_version, reprocessed_at
+            from jsonb_populate_record(null::invoices, p_payload)
+        )
+        where id = p_invoice_id
+        returning * into v_row;
+    end if;
+
+    if v_next_stage = 'APPROVED' then
+        v_amount := coalesce((p_payload->>'total_amount')::numeric, 0);
+        insert into vendors (vendor_name, avg_invoice_value, invoice_count, last_invoice_date)
+        values (v_row.vendor_name, v_amount, 1, v_row.invoice_date)
+        on conflict (vendor_name) do update set
+            avg_invoice_value = (vendors.avg_invoice_value * vendors.invoice_count + excluded.avg_invoice_value)
+                                / (vendors.invoice_count + 1),
+            invoice_count = vendors.invoice_count + 1,
+            last_invoice_date = excluded.last_invoice_date;
+    end if;
+
+    if v_next_stage = 'AUDITED' then
+        insert into invoice_audits (invoice_id, audited_by, audit_note)
+        values (
+            v_row.id,
+            coalesce(p_payload->>'reviewed_by', 'AUDITOR'),
+            coalesce(p_payload->>'flag_reason', 'Audited and Verified')
+        );
+    end if;
+
+    insert into invoice_edits (invoice_id, field_name, old_value, new_value)
+    select v_row.id, e->>'field_name', e->>'old_value', e->>'new_value'
+      from jsonb_array_elements(coalesce(p_edits, '[]'::jsonb)) as e;
+
+    return to_jsonb(v_row);
+end
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Dashboard metrics: counters kept current by triggers on invoices, read by
+-- dashboard_metrics() in one round trip. Cost depends on the number of
+-- stage/source/risk combinations, days and vendors, not on invoice volume.
+-- ---------------------------------------------------------------------------
+
+alter table invoices add column if not exists approval_hours double precision;
+
+create table if not exists invoice_metric_counts (
+    source text not null,
+    approval_stage text not null,
+    risk_level text not null,
+    invoice_count bigint not null default 0,
+    confidence_sum double precision not null default 0,
+    confidence_count bigint not null default 0,
+    low_confidence_count bigint not null default 0,
+    approval_hours_sum double precision not null default 0,
+    approval_hours_count bigint not null default 0,
+    primary key (source, approval_stage, risk_level)
+);
+
+create table if not exists invoice_metric_daily (
+    day date primary key,
+    confidence_sum double precision not null default 0,
+    confidence_count bigint not null default 0
+);
+
+create table if not exists invoice_vendor_totals (
+    vendor_name text primary key,
+    invoice_count bigint not null default 0,
+    total_amount double precision not null default 0
+);
+
+create index if not exists invoice_vendor_totals_amount_idx on invoice_vendor_totals (total_amount desc);
+create index if not exists invoices_stage_created_at_idx on invoices (approval_stage, created_at);
+create index if not exists invoices_stage_approval_hours_idx on invoices (approval_stage, approval_hours);
+
+
+-- Mirrors repository_base.invoice_source. Keep both in sync.
+create or replace function invoice_source(p_created_by text, p_processing_status text)
+returns text
+language sql
+immutable
+as $$
+    select case
+        when upper(coalesce(p_created_by, '')) = 'MAIL_BOT'
+          or upper(coalesce(p_processing_status, '')) like '%INGEST%'
+        then 'INGESTED_EMAIL'
+        else 'MANUAL_UPLOAD'
+    end
+$$;
+
+
+create or replace function invoice_set_approval_hours()
+returns trigger
+language plpgsql
+as $$
+begin
+    begin
+        new.approval_hours := extract(epoch from (
+            new.approval_timestamp::timestamptz - new.created_at::timestamptz
+        )) / 3600;
+    exception when others then
+        new.approval_hours := null;
+    end;
+    return new;
+end
+$$;
+
+
+-- Adds (p_sign = 1) or removes (p_sign = -1) one invoice row from the counters.
+create or replace function invoice_metrics_apply(r invoices, p_sign integer)
+returns void
+language plpgsql
+as $$
+declare
+    v_confidence double precision := r.confidence_score::double precision;
+begin
+    insert into invoice_metric_counts as c (
+        source, approval_stage, risk_level, invoice_count, confidence_sum, confidence_count,
+        low_confidence_count, approval_hours_sum, approval_hours_count
+    ) values (
+        invoice_source(r.created_by, r.processing_status),
+        coalesce(r.approval_stage, ''),
+        coalesce(r.risk_level, ''),
+        p_sign,
+        p_sign * coalesce(v_confidence, 0),
+        p_sign * (v_confidence is not null)::int,
+        p_sign * coalesce(v_confidence < 0.7, false)::int,
+        p_sign * coalesce(r.approval_hours, 0),
+        p_sign * (r.approval_hours is not null)::int
+    )
+    on conflict (source, approval_stage, risk_level) do update set
+        invoice_count = c.invoice_count + excluded.invoice_count,
+        confidence_sum = c.confidence_sum + excluded.confidence_sum,
+        confidence_count = c.confidence_count + excluded.confidence_count,
+        low_confidence_count = c.low_confidence_count + excluded.low_confidence_count,
+        approval_hours_sum = c.approval_hours_sum + excluded.approval_hours_sum,
+        approval_hours_count = c.approval_hours_count + excluded.approval_hours_count;
+
+    if r.created_at is not null and v_confidence is not null then
+        insert into invoice_metric_daily as d (day, confidence_sum, confidence_count)
+        values ((r.created_at::timestamptz at time zone 'UTC')::date, p_sign * v_confidence, p_sign)
+        on conflict (day) do update set
+            confidence_sum = d.confidence_sum + excluded.confidence_sum,
+            confidence_count = d.confidence_count + excluded.confidence_count;
+    end if;
+
+    if coalesce(r.vendor_name, '') <> '' then
+        insert into invoice_vendor_totals as v (vendor_name, invoice_count, total_amount)
+        values (r.vendor_name, p_sign, p_sign * coalesce(r.total_amount::double precision, 0))
+        on conflict (vendor_name) do update set
+            invoice_count = v.invoice_count + excluded.invoice_count,
+            total_amount = v.total_amount + excluded.total_amount;
+    end if;
+end
+$$;
+
+
+create or replace function invoice_metrics_trigger()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform invoice_metrics_apply(old, -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform invoice_metrics_apply(new, 1);
+    end if;
+    return null;
+end
+$$;
+
+drop trigger if exists invoices_approval_hours on invoices;
+create trigger invoices_approval_hours
+    before insert or update of approval_timestamp, created_at on invoices
+    for each row execute function invoice_set_approval_hours();
+
+drop trigger if exists invoices_metrics on invoices;
+create trigger invoices_metrics
+    after insert or update or delete on invoices
+    for each row execute function invoice_metrics_trigger();
+
+
+-- Rebuilds all counters from invoices; run after deploying or bulk repairs.
+create or replace function rebuild_invoice_metrics()
+returns void
+language plpgsql
+as $$
+begin
+    lock table invoices in share row exclusive mode;
+    -- fires invoices_approval_hours for rows saved before it existed
+    update invoices set approval_timestamp = approval_timestamp
+     where approval_timestamp is not null and approval_hours is null;
+
+    truncate invoice_metric_counts, invoice_metric_daily, invoice_vendor_totals;
+
+    insert into invoice_metric_counts
+    select invoice_source(created_by, processing_status), coalesce(approval_stage, ''), coalesce(risk_level, ''),
+           count(*),
+           coalesce(sum(confidence_score::double precision), 0),
+           count(confidence_score),
+           count(*) filter (where confidence_score::double precision < 0.7),
+           coalesce(sum(approval_hours), 0),
+           count(approval_hours)
+      from invoices
+     group by 1, 2, 3;
+
+    insert into invoice_metric_daily
+    select (created_at::timestamptz at time zone 'UTC')::date, sum(confidence_score::double precision), count(*)
+      from invoices
+     where created_at is not null and confidence_score is not null
+     group by 1;
+
+    insert into invoice_vendor_totals
+    select vendor_name, count(*), coalesce(sum(total_amount::double precision), 0)
+      from invoices
+     where coalesce(vendor_name, '') <> ''
+     group by 1;
+end
+$$;
+
+select rebuild_invoice_metrics();
+
+
+-- Same shape as repository_base.compute_dashboard_metrics.
+create or replace function dashboard_metrics()
+returns jsonb
+language sql
+stable
+as $$
+    with counts as (
+        select * from invoice_metric_counts where invoice_count > 0
+    ),
+    approved as (
+        select sum(approval_hours_sum) as hours_sum, sum(approval_hours_count) as hours_count
+          from counts where approval_stage = 'APPROVED'
+    )
+    select jsonb_build_object(
+        'total_invoices', (select coalesce(sum(invoice_count), 0) from counts),
+        'stage_counts', (
+            select coalesce(jsonb_object_agg(approval_stage, n), '{}'::jsonb)
+              from (select approval_stage, sum(invoice_count) as n from counts
+                     where approval_stage <> '' group by approval_stage) s
+        ),
+        'source_stage_counts', (
+            select coalesce(jsonb_object_agg(source, stages), '{}'::jsonb)
+              from (select source, jsonb_object_agg(approval_stage, n) as stages
+                      from (select source, approval_stage, sum(invoice_count) as n from counts
+                             where approval_stage <> '' group by source, approval_stage) ss
+                     group by source) s
+        ),
+        'risk_counts', (
+            select coalesce(jsonb_object_agg(risk_level, n), '{}'::jsonb)
+              from (select risk_level, sum(invoice_count) as n from counts
+                     where risk_level <> '' group by risk_level) r
+        ),
+        'high_risk_pending', (
+            select coalesce(sum(invoice_count), 0) from counts
+             where risk_level = 'HIGH' and approval_stage in ('UPLOADED', 'REVIEWED')
+        ),
+        'low_confidence', (select coalesce(sum(low_confidence_count), 0) from counts),
+        'avg_confidence', (
+            select sum(confidence_sum) / nullif(sum(confidence_count), 0) from counts
+        ),
+        'approval_hours', (
+            select jsonb_build_object(
+                'count', coalesce(hours_count, 0),
+                'avg', hours_sum / nullif(hours_count, 0),
+                'min', (select min(approval_hours) from invoices where approval_stage = 'APPROVED'),
+                'max', (select max(approval_hours) from invoices where approval_stage = 'APPROVED')
+            ) from approved
+        ),
+        -- more than 3 whole days in review (repository_base.SLA_REVIEW_DAYS)
+        'sla_breaches', (
+            select count(*) from invoices
+             where approval_stage = 'REVIEWED'
+               and created_at <= now() - interval '4 days'
+        ),
+        'top_vendors', (
+            select coalesce(jsonb_agg(jsonb_build_object('vendor_name', vendor_name, 'total_amount', total_amount)
+                                      order by total_amount desc), '[]'::jsonb)
+              from (select vendor_name, total_amount from invoice_vendor_totals
+                     where invoice_count > 0 order by total_amount desc limit 5) v
+        ),
+        'confidence_trend', (
+            select coalesce(jsonb_agg(jsonb_build_object('day', day, 'avg_confidence', confidence_sum / confidence_count)
+                                      order by day), '[]'::jsonb)
+              from invoice_metric_daily where confidence_count > 0
+        )
+    )
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Re-evaluation (reevaluation.py): latest compliance result, the policy pack
+-- it was checked against and a fingerprint of everything risk and
+-- compliance were computed from. Results are written in batches by
+-- apply_invoice_evaluations(); one call updates a whole batch.
+-- ---------------------------------------------------------------------------
+
+alter table invoices add column if not exists compliance_issues jsonb;
+alter table invoices add column if not exists policy_version text;
+alter table invoices add column if not exists eval_fingerprint text;
+alter table invoices add column if not exists evaluated_at timestamptz;
+
+create or replace function apply_invoice_evaluations(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    v_updated integer;
+begin
+    update invoices i
+       set risk_score = r.risk_score,
+           risk_level = r.risk_level,
+           compliance_issues = r.compliance_issues,
+           policy_version = r.policy_version,
+           eval_fingerprint = r.eval_fingerprint,
+           evaluated_at = r.evaluated_at
+      from jsonb_to_recordset(p_rows) as r(
+               id bigint, risk_score integer, risk_level text, compliance_issues jsonb,
+               policy_version text, eval_fingerprint text, evaluated_at timestamptz
+           )
+     where i.id = r.id;
+    get diagnostics v_updated = row_count;
+    return v_updated;
+end
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Vendor anomaly statistics (vendor_anomaly.py): streaming median/MAD, EWMA
+-- and unit-price ranges per vendor, folded forward on every approval.
+-- update_vendor_anomaly_stats() writes only when the stored observation count
+-- is the one the caller started from, so concurrent approvals retry instead
+-- of overwriting each other.
+-- ---------------------------------------------------------------------------
+
+alter table vendors add column if not exists anomaly_stats jsonb;
+
+create or replace function update_vendor_anomaly_stats(p_vendor_name text, p_expected_count integer, p_stats jsonb)
+returns boolean
+language plpgsql
+as $$
+begin
+    update vendors
+       set anomaly_stats = p_stats
+     where vendor_name = p_vendor_name
+       and coalesce((anomaly_stats->>'n')::integer, 0) = p_expected_count;
+    return found;
+end
+$$;
+
+
+-- ---------------------------------------------------------------------------
+-- Batch updates (save_invoice_records_batch): one statement per chunk, keyed
+-- by id. Unlike an upsert, an invoice that was deleted or archived after it
+-- was read is skipped rather than inserted again.
+-- ---------------------------------------------------------------------------
+
+create or replace function update_invoices_batch(p_rows jsonb)
+returns setof invoices
+language sql
+as $$
+    update invoices i set (
+        vendor_name, invoice_date, total_amount, currency, status,
+        processing_status, confidence_score, flag_reason, file_url,
+        ai_raw_data, ai_structured_output, document_hash, created_by,
+        last_reviewed_by, ai_explanations, risk_score, risk_level,
+        approval_stage, reviewed_by, approved_by, approval_timestamp,
+        audited, ai_version, reprocessed_at
+    ) = (
+        r.vendor_name, r.invoice_date, r.total_amount, r.currency, r.status,
+        r.processing_status, r.confidence_score, r.flag_reason, r.file_url,
+        r.ai_raw_data, r.ai_structured_output, r.document_hash, r.created_by,
+        r.last_reviewed_by, r.ai_explanations, r.risk_score, r.risk_level,
+        r.approval_stage, r.reviewed_by, r.approved_by, r.approval_timestamp,
+        r.audited, r.ai_version, r.reprocessed_at
+    )
+    from jsonb_populate_recordset(null::invoices, p_rows) as r
+    where i.id = r.id
+    returning i.*;
+$$;
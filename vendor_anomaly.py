@@ -0,0 +1,268 @@
+"""Incremental per-vendor statistics for amount and unit-price anomalies.
+
+The running mean in vendors.avg_invoice_value is pulled up by a single large
+invoice and knows nothing about line items. Each vendor therefore also keeps
+a small JSON document (vendors.anomaly_stats) that is folded forward once
+per approved invoice, in O(1) per invoice and line item:
+
+- "median" / "mad": P² sketches (Jain & Chlamtac) of the amount and of its
+  absolute deviation from the running median, i.e. a streaming median/MAD
+- "ewma" / "ewmvar": exponentially weighted mean and (outlier-clipped)
+  variance of the amount (VENDOR_EWMA_ALPHA, default 0.2), which follow
+  seasonal level shifts
+- "prices": min / max / count / mean unit price per normalized line-item
+  description, for up to VENDOR_PRICE_DESCRIPTIONS (default 200) descriptions
+
+score() reads only that document, so scoring never scans invoice history.
+An amount is anomalous when it is more than VENDOR_ANOMALY_Z robust z-scores
+(default 3.5) from the median *and* more than VENDOR_EWMA_K (default 3)
+EWMA standard deviations from the recent level, so a vendor whose invoices
+grow seasonally is not flagged once the EWMA has caught up. A unit price is
+anomalous when it falls more than VENDOR_PRICE_TOLERANCE (default 25%)
+outside the range seen for that description. Both need
+VENDOR_ANOMALY_MIN_SAMPLES (default 5) observations first.
+
+    python vendor_anomaly.py --rebuild     # recompute every vendor from the approved history
+"""
+import argparse
+import json
+import math
+import os
+import re
+
+P2_MARKERS = 5
+MAD_SCALE = 1.4826  # MAD -> standard deviation for normal data
+DEFAULT_SETTINGS = {
+    "ewma_alpha": 0.2,
+    "z_threshold": 3.5,
+    "ewma_k": 3.0,
+    "price_tolerance": 0.25,
+    "min_samples": 5,
+    "max_descriptions": 200,
+}
+
+
+def anomaly_settings():
+    return {
+        "ewma_alpha": float(os.getenv("VENDOR_EWMA_ALPHA", DEFAULT_SETTINGS["ewma_alpha"])),
+        "z_threshold": float(os.getenv("VENDOR_ANOMALY_Z", DEFAULT_SETTINGS["z_threshold"])),
+        "ewma_k": float(os.getenv("VENDOR_EWMA_K", DEFAULT_SETTINGS["ewma_k"])),
+        "price_tolerance": float(os.getenv("VENDOR_PRICE_TOLERANCE", DEFAULT_SETTINGS["price_tolerance"])),
+        "min_samples": int(os.getenv("VENDOR_ANOMALY_MIN_SAMPLES", DEFAULT_SETTINGS["min_samples"])),
+        "max_descriptions": int(os.getenv("VENDOR_PRICE_DESCRIPTIONS", DEFAULT_SETTINGS["max_descriptions"])),
+    }
+
+
+def _to_float(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def description_key(description):
+    """Line-item descriptions compared case- and whitespace-insensitively."""
+    return re.sub(r"\s+", " ", str(description or "")).strip().lower()[:120]
+
+
+def unit_price(item):
+    """unit_price of a line item, or total_price / quantity when it is missing."""
+    item = item or {}
+    price = _to_float(item.get("unit_price"))
+    if price is None:
+        total, quantity = _to_float(item.get("total_price")), _to_float(item.get("quantity"))
+        if total is not None and quantity:
+            price = total / quantity
+    return price
+
+
+# --- P² QUANTILE SKETCH ---
+def p2_new(p=0.5):
+    return {"p": p, "q": [], "n": [], "np": []}
+
+
+def p2_add(sketch, x):
+    """Adds one observation. The first five are kept exactly; after that the
+    five markers are moved with the piecewise-parabolic formula."""
+    q, n, np_ = sketch["q"], sketch["n"], sketch["np"]
+    p = sketch["p"]
+    if len(q) < P2_MARKERS:
+        q.append(x)
+        q.sort()
+        if len(q) == P2_MARKERS:
+            sketch["n"] = [0, 1, 2, 3, 4]
+            sketch["np"] = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        return sketch
+
+    if x < q[0]:
+        q[0] = x
+        k = 0
+    elif x >= q[4]:
+        q[4] = x
+        k = 3
+    else:
+        k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+    for i in range(k + 1, P2_MARKERS):
+        n[i] += 1
+    for i, increment in enumerate((0, p / 2, p, (1 + p) / 2, 1)):
+        np_[i] += increment
+
+    for i in (1, 2, 3):
+        d = np_[i] - n[i]
+        if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+            step = 1 if d > 0 else -1
+            candidate = q[i] + step / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+            )
+            if not q[i - 1] < candidate < q[i + 1]:
+                candidate = q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+            q[i] = candidate
+            n[i] += step
+    return sketch
+
+
+def p2_value(sketch):
+    """Current quantile estimate (exact below five observations)."""
+    q = sketch["q"]
+    if not q:
+        return None
+    if len(q) < P2_MARKERS:
+        position = sketch["p"] * (len(q) - 1)
+        lower = int(math.floor(position))
+        upper = min(lower + 1, len(q) - 1)
+        return q[lower] + (q[upper] - q[lower]) * (position - lower)
+    return q[2]
+
+
+# --- VENDOR STATS ---
+def new_stats():
+    return {"n": 0, "median": p2_new(), "mad": p2_new(), "ewma": None, "ewmvar": 0.0, "prices": {}}
+
+
+def update_stats(stats, amount, line_items=None, settings=None):
+    """Folds one approved invoice into a vendor's stats (modified in place and
+    returned). Non-numeric amounts only update the price ranges."""
+    settings = settings or anomaly_settings()
+    stats = stats if isinstance(stats, dict) and "median" in stats else new_stats()
+
+    amount = _to_float(amount)
+    if amount is not None:
+        median = p2_value(stats["median"])
+        if median is not None:
+            p2_add(stats["mad"], abs(amount - median))
+        p2_add(stats["median"], amount)
+        if stats["ewma"] is None:
+            stats["ewma"] = amount
+        else:
+            alpha = settings["ewma_alpha"]
+            diff = amount - stats["ewma"]
+            stats["ewma"] += alpha * diff
+            # The variance sees the deviation clipped to ewma_k standard
+            # deviations, so one approved outlier does not mask the next ones
+            if stats["n"] >= settings["min_samples"]:
+                limit = settings["ewma_k"] * max(math.sqrt(stats["ewmvar"]), 0.05 * abs(stats["ewma"]), 0.01)
+                diff = max(-limit, min(limit, diff))
+            stats["ewmvar"] = (1 - alpha) * (stats["ewmvar"] + alpha * diff * diff)
+        stats["n"] += 1
+
+    prices = stats["prices"]
+    for item in line_items or []:
+        key = description_key((item or {}).get("description"))
+        price = unit_price(item) if key else None
+        if price is None:
+            continue
+        entry = prices.get(key)
+        if entry is None:
+            if len(prices) >= settings["max_descriptions"]:
+                continue
+            prices[key] = [price, price, 1, price]
+        else:
+            entry[0] = min(entry[0], price)
+            entry[1] = max(entry[1], price)
+            entry[2] += 1
+            entry[3] += (price - entry[3]) / entry[2]
+    return stats
+
+
+def score(stats, amount, line_items=None, settings=None):
+    """{"amount_anomaly", "robust_z", "median", "ewma", "price_anomalies"} for
+    a new invoice against a vendor's stats; None when there are too few
+    approved invoices to judge."""
+    settings = settings or anomaly_settings()
+    if not isinstance(stats, dict) or stats.get("n", 0) < settings["min_samples"]:
+        return None
+
+    result = {"amount_anomaly": False, "robust_z": None, "median": None, "ewma": stats.get("ewma"),
+              "price_anomalies": []}
+    amount = _to_float(amount)
+    median = p2_value(stats["median"])
+    mad = p2_value(stats["mad"]) or 0.0
+    if amount is not None and median is not None:
+        # A vendor that always bills the same amount has MAD 0; 5% of the
+        # median keeps small deviations from scoring as infinitely far.
+        spread = max(MAD_SCALE * mad, 0.05 * abs(median), 0.01)
+        robust_z = (amount - median) / spread
+        ewma_spread = max(math.sqrt(max(stats.get("ewmvar") or 0.0, 0.0)), 0.05 * abs(stats["ewma"] or 0.0), 0.01)
+        ewma_z = (amount - stats["ewma"]) / ewma_spread
+        result.update({"robust_z": round(robust_z, 2), "median": round(median, 2)})
+        result["amount_anomaly"] = (
+            abs(robust_z) > settings["z_threshold"] and abs(ewma_z) > settings["ewma_k"]
+        )
+
+    prices = stats.get("prices") or {}
+    tolerance = settings["price_tolerance"]
+    for item in line_items or []:
+        key = description_key((item or {}).get("description"))
+        entry = prices.get(key) if key else None
+        if entry is None or entry[2] < settings["min_samples"]:
+            continue
+        price = unit_price(item)
+        low, high = entry[0], entry[1]
+        if price is not None and (price < low * (1 - tolerance) or price > high * (1 + tolerance)):
+            result["price_anomalies"].append({
+                "description": item.get("description"), "unit_price": price, "min": low, "max": high,
+            })
+    return result
+
+
+def invoice_line_items(data):
+    """Line items of an invoice being saved: top level or inside ai_raw_data."""
+    raw = data.get("ai_raw_data")
+    return data.get("line_items") or (raw.get("line_items") if isinstance(raw, dict) else None) or []
+
+
+# --- REBUILD ---
+def rebuild_all(settings=None):
+    """Recomputes every vendor's stats from its approved and audited invoices
+    (live and archived), oldest approval first. Returns the number of vendors written."""
+    import archive
+    import database
+
+    settings = settings or anomaly_settings()
+    rows = [
+        row for row in database.fetch_all_invoices() + list(archive.fetch_archived_invoices())
+        if row.get("approval_stage") in ("APPROVED", "AUDITED") and row.get("vendor_name")
+    ]
+    rows.sort(key=lambda row: str(row.get("approval_timestamp") or row.get("created_at") or ""))
+    stats_by_vendor = {}
+    for row in rows:
+        stats_by_vendor[row["vendor_name"]] = update_stats(
+            stats_by_vendor.get(row["vendor_name"]), row.get("total_amount"), invoice_line_items(row), settings
+        )
+    return database.save_vendor_anomaly_stats(stats_by_vendor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-vendor anomaly statistics.")
+    parser.add_argument("--rebuild", action="store_true", help="recompute all vendors from the approved history")
+    args = parser.parse_args()
+    if args.rebuild:
+        print(json.dumps({"vendors_written": rebuild_all()}))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()